@@ -3,8 +3,13 @@
 # Read all mom-files in the ./obs_files directory, analyse them, plot them
 # and create power spectral density plots.
 #
-# The JSON file of each analysis is added to a new hector.json file. Simply
-# copying the lines with some added indentation.
+# The JSON file of each analysis is appended, as soon as the station is
+# finished, to the line-delimited stores hector_estimatetrend.jsonl and
+# hector_removeoutliers.jsonl (see results_store.py). At the end these are
+# compacted into hector_estimatetrend.json and hector_removeoutliers.json.
+#
+# With --queue the stations are shared with other nodes running the same
+# command (see job_queue.py) and every node has its own stores.
 #
 #  This script is part of Hector 1.9
 #
@@ -28,9 +33,25 @@ import sys
 import math
 import os
 import re
-import glob
 import json
-import subprocess
+import io
+import asyncio
+
+import analyse_timeseries
+import async_tools
+import checkpoint
+import compressed_io
+import cost_model
+import downsample
+import job_queue
+import profiling
+import progress_metrics
+import results_db
+import results_store
+import station_catalog
+import station_store
+import workspace
+from tool_exec import remove_files, ToolError
 
 # ===============================================================================
 # Subroutines
@@ -69,17 +90,19 @@ def caldat(mjd):
 
 
 # Make plot of Power-Spectrum
-# -----------------------
-def make_PSD_plot(name):
-# -----------------------
+# -----------------------------------------------
+async def make_PSD_plot(name, pool, workdir):
+# -----------------------------------------------
     """ Make a power spectral density plot from the residuals 
     
     Arguments:
         name = name of station and filename without .mom extension
+        pool = async_tools.ToolPool that runs gnuplot, gmt and convert
+        workdir = directory with the output of estimatespectrum
     """
 
     # --- create new gnuplot script file
-    fp = open("plot_spectra.gpl", "w")
+    fp = open(os.path.join(workdir, "plot_spectra.gpl"), "w")
     fp.write("set terminal postscript enhanced size 4,4 color portrait" + \
                                                       " solid \"Helvetica\"\n")
     fp.write("set output './psd_figures/{0:s}_psd.ps'\n".format(name))
@@ -109,24 +132,43 @@ def make_PSD_plot(name):
 
     # --- Call gnuplot
     try:
-        subprocess.call(['gnuplot', 'plot_spectra.gpl'])
-    except OSError:
+        await pool.run(['gnuplot', 'plot_spectra.gpl'], cwd=workdir)
+        await pool.run(['gmt', 'psconvert', '-Te', '-A0.1',
+                  './psd_figures/{0:s}_psd.ps'.format(name)], cwd=workdir)
+        await pool.run(['convert', '-density', '300', '-flatten', '-antialias',
+                  './psd_figures/{0:s}_psd.eps'.format(name),
+                  './psd_figures/{0:s}.png'.format(name)], cwd=workdir)
+    except ToolError as e:
         print('Something seems to have gone wrong with the powerspectrum plot')
-    os.system('gmt psconvert -Te -A0.1 ./psd_figures/{0:s}_psd.ps'.format(name))
-    os.system('convert -density 300 -flatten -antialias ./psd_figures/{0:s}_psd.eps ./psd_figures/{0:s}.png\n'.format(name))
+        print(str(e))
 
 
 
-# ------------------------
-def make_data_plot(name):
-# ------------------------
-    """ Make a time series plot
+# ------------------------------------------------
+async def make_data_plot(name, pool, workdir):
+# ------------------------------------------------
+    """ Make a time series plot. The series are downsampled first (see
+    downsample.py) and the offsets are shown as dashed lines.
 
     Parameters:
         name : station name
+        pool : async_tools.ToolPool that runs gnuplot, gmt and convert
+        workdir : directory in which gnuplot is run
     """  
+    # --- Downsampled observations, model and residuals
+    try:
+        [fnames, offsets] = await pool.call('downsample',
+                downsample.write_plot_files, os.path.join(workdir,
+                'mom_files', '{0:s}.mom'.format(name)), workdir, 'plot')
+    except (IOError, ValueError) as e:
+        print('Something seems to have gone wrong with the time series plot')
+        print(str(e))
+        return
+    [data_file, model_file, res_file] = [os.path.basename(fname) for \
+                                                            fname in fnames]
+
     # --- create new gnuplot script file
-    fp = open("plot_data.gpl", "w")
+    fp = open(os.path.join(workdir, "plot_data.gpl"), "w")
     fp.write("set terminal postscript enhanced size 8,4.8 color portrait solid 'Helvetica'\n")
     fp.write("set output './data_figures/{0:s}_data.ps'\n".format(name))
     fp.write("set border 3;\n")
@@ -144,97 +186,61 @@ def make_data_plot(name):
     fp.write("set style line 1 lt 1 lw 3 pt 7 linecolor rgb '#a6cee3'\n")
     fp.write("set style line 2 lt 1 lw 3 pt 7 linecolor rgb 'red'\n")
     fp.write("set style line 3 lt 1 lw 3 pt 2 linecolor rgb 'black'\n")
-    fp.write("plot './mom_files/{0:s}.mom' u".format(name) + " (($1-51544)/365.25+2000):2 w p ls 1,\\\n")
-    fp.write("     './mom_files/{0:s}.mom' u".format(name) + " (($1-51544)/365.25+2000):3 w l ls 2")
+    for mjd in offsets:
+        fp.write("set arrow from {0:f},graph 0 to {0:f},graph 1 nohead lt 0 lw 2 linecolor rgb 'black'\n".\
+                                        format((mjd-51544)/365.25+2000))
+    fp.write("plot './{0:s}' u".format(data_file) + " (($1-51544)/365.25+2000):2 w p ls 1,\\\n")
+    fp.write("     './{0:s}' u".format(model_file) + " (($1-51544)/365.25+2000):2 w l ls 2")
     fp.write("\n")
 
     # ---- A plot of the residuals is also nice to have
     fp.write("\nset output './data_figures/{0:s}_res.eps'\n".format(name))
-    fp.write("plot './mom_files/{0:s}.mom' u ".format(name) + " (($1-51544)/365.25+2000):($2-$3) w l ls 2\n")
+    fp.write("plot './{0:s}' u ".format(res_file) + " (($1-51544)/365.25+2000):2 w l ls 2\n")
     fp.close()
 
     # --- Call gnuplot
-    os.system('gnuplot plot_data.gpl')
-
-    os.system('gmt psconvert -Te -A0.1 ./data_figures/{0:s}_data.ps'.format(name))
-    os.system('convert -density 300 -flatten -antialias ./data_figures/{0:s}_data.eps ./data_figures/{0:s}.png\n'.format(name))
-
-
-# ===============================================================================
-# Main program
-# ===============================================================================
-
-# --- Read command line arguments
-if len(sys.argv)==2:
-    noisemodel = sys.argv[1]
-    stations = []
-elif len(sys.argv)==3:
-    noisemodel = sys.argv[1]
-    stations = [sys.argv[2]]
-else:
-    print('Correct usage: analyse_and_plot.py station_name {fGGM|GGM|MT|PL|FN|RW|WN|AR1|VA}+ [fraction]')
-    print('Example: analyse_and_plot.py PLWN')
-    sys.exit()
-    
-
-# --- Read station names in directory ./obs_files
-if len(stations)==0:
-    fnames = glob.glob("./obs_files/*.mom")
-    
-    # --- Did we find files?
-    if len(fnames)==0:
-        print('Could not find any mom-file in ./obs_files')
-        sys.exit()
-
-    # --- Extract station names
-    for fname in sorted(fnames):
-        m = re.search('/(\w+)\.mom',fname)
-        if m:
-            station = m.group(1)
-            stations.append(station)
-        else:
-            print('Could not parse station name from: {0:s}'.format(fname))
-            sys.exit()
-
-
-# --- Open new JSON file to store all other JSON results
-fp_json_est = open('hector_estimatetrend.json', 'w')
-fp_json_est.write('{')
-fp_json_rem = open('hector_removeoutliers.json', 'w')
-fp_json_rem.write('{')
-
-# --- Store outliers in dictionary
-outliers = {}
-
-# --- Analyse station
-for station in stations:
-
-    # --- Get sampling period
     try:
-        fp_mom = open("./obs_files/{0:s}.mom".format(station))
-    except IOError:
-        print("Could not open file ./obs_files/{0:s}.mom".format(station))
-        sys.exit()
+        await pool.run(['gnuplot', 'plot_data.gpl'], cwd=workdir)
+        await pool.run(['gmt', 'psconvert', '-Te', '-A0.1',
+                  './data_figures/{0:s}_data.ps'.format(name)], cwd=workdir)
+        await pool.run(['convert', '-density', '300', '-flatten', '-antialias',
+                  './data_figures/{0:s}_data.eps'.format(name),
+                  './data_figures/{0:s}.png'.format(name)], cwd=workdir)
+    except ToolError as e:
+        print('Something seems to have gone wrong with the time series plot')
+        print(str(e))
+
+
+# Analyse, plot and compute the power spectrum of one station
+# -----------------------------------------------------------------------
+async def analyse_station(station, entry, noisemodel, pool, workdir='.'):
+# -----------------------------------------------------------------------
+    """ Run removeoutliers, estimatetrend, estimatespectrum and modelspectrum
+    for one mom-file in ./obs_files and make the plots. The JSON results are
+    left in estimatetrend.json and removeoutliers.json of workdir.
 
-    lines = fp_mom.readlines()
-    m = re.search('# sampling period (\d+\.?\d*)', lines[0])
-    if m:
-        sampling_period = float(m.group(1))
-        fs = 1.0/float(m.group(1))
-        T = 1.0/(365.25*fs)
-    else:
-        print("./obs_files/{0:s}.mom does not have # sampling period!".format(station))
-        sys.exit()
+    Parameters:
+        station : station name (including _0, _1 or _2)
+        entry : catalog entry of ./obs_files/<station>.mom
+        noisemodel : noise model combination, e.g. PLWN
+        pool : async_tools.ToolPool that runs the external tools
+        workdir : directory with links to the data directories in which
+                  the tools are run (see workspace.py)
+
+    Raises RuntimeError if the station could not be analysed.
+    """
 
-    # --- Get first and last observation epoch
-    i =0
-    n = len(lines)
-    while lines[i].startswith('#')==True and i<n:
-        i += 1
-    cols = lines[i].split()  
-    mjd0 = float(cols[0])
-    cols = lines[n-1].split()  
-    mjd1 = float(cols[0])
+    # --- Get sampling period, first and last observation epoch from the
+    #    catalog entry (see station_catalog.py)
+    sampling_period = entry['sampling_period']
+    if sampling_period is None:
+        raise RuntimeError("./obs_files/{0:s}.mom does not have # sampling period!".format(station))
+    fs = 1.0/sampling_period
+    T = 1.0/(365.25*fs)
+    mjd0 = entry['first']
+    mjd1 = entry['last']
+    if mjd0 is None:
+        raise RuntimeError("./obs_files/{0:s}.mom has no observations".format(station))
     n = int((mjd1-mjd0)/sampling_period + 1.0e-6)
     print(mjd0, mjd1, sampling_period, n)
 
@@ -249,8 +255,27 @@ for station in stations:
 
     param = '{0:s} {1:s}'.format(station, noisemodel)
     print('#### {0:s}'.format(param))
-    os.system('analyse_timeseries.py {0:s}'.format(param))
-    fp_dummy = open('estimatetrend.json', 'r')
+    remove_files(os.path.join(workdir, 'estimatetrend.json'))
+    remove_files(os.path.join(workdir, 'removeoutliers.json'))
+
+    # --- Remove outliers (see analyse_timeseries.py)
+    data_directory = compressed_io.scratch_input(workdir, './obs_files',
+                                                    '{0:s}.mom'.format(station))
+    analyse_timeseries.create_removeoutliers_ctl_file(station, workdir,
+                                                            data_directory)
+    output = await pool.run(['removeoutliers'], cwd=workdir)
+    with open(os.path.join(workdir, 'removeoutliers.out'), 'w') as fp:
+        fp.write(output)
+
+    # --- Run estimatetrend
+    noisemodels = analyse_timeseries.parse_noisemodels(noisemodel)
+    analyse_timeseries.create_estimatetrend_ctl_file(station, noisemodels,
+                                                                      workdir)
+    output = await pool.run(['estimatetrend'], cwd=workdir)
+    with open(os.path.join(workdir, 'estimatetrend.out'), 'w') as fp:
+        fp.write(output)
+
+    fp_dummy = open(os.path.join(workdir, 'estimatetrend.json'), 'r')
     results = json.load(fp_dummy)
     fp_dummy.close()
 
@@ -263,7 +288,7 @@ for station in stations:
         os.mkdir('./psd_figures')
 
     # --- Create control file to estimate power spectrum of residuals
-    fp = open("estimatespectrum.ctl", "w")
+    fp = open(os.path.join(workdir, "estimatespectrum.ctl"), "w")
     fp.write("DataFile            {0:s}.mom\n".format(station))
     fp.write("DataDirectory       ./mom_files\n")
     fp.write("interpolate         no\n")
@@ -274,8 +299,8 @@ for station in stations:
     fp.close()
 
     # --- Run estimatespectrum
-    output = subprocess.check_output('estimatespectrum 4', shell=True)
-    estimatespectrum_cols = output.decode().split()
+    output = await pool.run(['estimatespectrum', '4'], cwd=workdir)
+    estimatespectrum_cols = output.split()
     freq0 = estimatespectrum_cols[-5]
     freq1 = estimatespectrum_cols[-3]
 
@@ -284,7 +309,7 @@ for station in stations:
     GGM_1mphi_needed = True
     lambda_needed = True
     kappa_needed = True
-    with open('estimatetrend.ctl', 'r') as fp:
+    with open(os.path.join(workdir, 'estimatetrend.ctl'), 'r') as fp:
         for line in fp:
             m = re.match('GGM_1mphi', line)
             if m:
@@ -303,7 +328,7 @@ for station in stations:
                 lambda_fixed = float(cols[1])
 
     # --- Create control file for modelspectrum
-    fp = open("modelspectrum.ctl", "w")
+    fp = open(os.path.join(workdir, "modelspectrum.ctl"), "w")
     fp.write("DataFile                {0:s}.mom\n".format(station))
     fp.write("DataDirectory           ./mom_files\n")
     fp.write("ScaleFactor             1.0\n")
@@ -333,7 +358,7 @@ for station in stations:
     fp.close()
 
     # --- Create input for modelspectrum
-    fp = open("modelspectrum.txt", "w")
+    fp = io.StringIO()
     sigma = results['driving_noise']
     fp.write("{0:f}\n{1:f}\n".format(sigma, 24.0/fs))
     # --- Select NoiseModel section from json structure
@@ -374,37 +399,318 @@ for station in stations:
 
     # --- Finally, write information about lowest and highest frequency
     fp.write("2\n{0:s} {1:s}\n".format(freq0, freq1))
-    fp.close()
 
     # --- Make modelled psd line
-    os.system('modelspectrum < modelspectrum.txt > /dev/null')
+    await pool.run(['modelspectrum'], cwd=workdir, input=fp.getvalue())
 
     # --- Make plot of power-spectrum and data
-    make_PSD_plot(station)
+    await make_PSD_plot(station, pool, workdir)
 
     # --- Make time series plot
-    make_data_plot(station)
-
-    # --- update json file
-    if station!=stations[0]:
-        fp_json_est.write(',')
-        fp_json_rem.write(',')
-    fp_json_est.write('\n  "{0:s}" : {{\n'.format(station))
-    fp_json_rem.write('\n  "{0:s}" : {{\n'.format(station))
-    fp_dummy = open('estimatetrend.json', 'r')
-    lines = fp_dummy.readlines()
-    fp_dummy.close()
-    for i in range(1,len(lines)-1):
-        fp_json_est.write('  ' + lines[i])
-    fp_json_est.write('  ' + lines[-1].rstrip("\n"))
-    fp_dummy = open('removeoutliers.json', 'r')
-    lines = fp_dummy.readlines()
-    fp_dummy.close()
-    for i in range(1, len(lines)-1):
-        fp_json_rem.write('  ' + lines[i])
-    fp_json_rem.write('  ' + lines[-1].rstrip("\n"))
-
-fp_json_est.write('\n}\n')
-fp_json_est.close()
-fp_json_rem.write('\n}\n')        
-fp_json_rem.close()
+    await make_data_plot(station, pool, workdir)
+
+
+# Analyse all stations, several at the same time
+# -------------------------------------------------------------------------
+async def analyse_all(stations, catalog, noisemodel, n_jobs, limits,
+                      checkpoint_dir, store_est, store_rem, containers=None,
+                      queue=None, schedule=None):
+# -------------------------------------------------------------------------
+    """ Analyse the stations with at most n_jobs stations in progress. The
+    external tools of all stations share one ToolPool so the limit of each
+    tool holds for the whole run. With more than one job, each station is
+    processed in its own working directory below ./work.
+
+    Parameters:
+        stations : list of station names
+        catalog : dictionary file name -> entry of ./obs_files
+        noisemodel : noise model combination, e.g. PLWN
+        n_jobs : maximum number of stations in progress
+        limits : dictionary tool -> maximum number of running instances
+        checkpoint_dir : directory with the completion markers
+        store_est, store_rem : line-delimited stores of the JSON results
+        containers : None, or dictionary with the StationStore of obs_files,
+                     pre_files and mom_files (see station_store.py). Each
+                     station is then exported to and imported from private
+                     directories in its working directory.
+        queue : None, or the job_queue.JobQueue shared with other nodes.
+                Only the stations claimed in the queue are analysed.
+        schedule : None, or the cost_model.Schedule that records the run
+                   times and shows the expected end of the run.
+    """
+
+    pool = async_tools.ToolPool(limits)
+    slots = asyncio.Semaphore(n_jobs)
+    if queue is None:
+        done_elsewhere = None
+    else:
+        done_elsewhere = lambda station: checkpoint.is_done(checkpoint_dir,
+                                                                    station)
+    metrics = progress_metrics.Metrics('analyse_and_plot_' + noisemodel,
+                stations, n_jobs, pool,
+                None if queue is None else queue.node,
+                None if schedule is None else schedule.eta, done_elsewhere)
+    writer = asyncio.ensure_future(metrics.run())
+
+    async def analyse_one(station):
+        async with slots:
+            name = station + '.mom'
+            if containers is not None:
+                workdir = workspace.make_workdir(station, local=STAGES)
+            elif n_jobs == 1 and queue is None:
+                workdir = '.'
+            else:
+                workdir = workspace.make_workdir(station)
+            if schedule is not None:
+                schedule.start(station)
+            metrics.start(station)
+            try:
+                if containers is not None:
+                    entry = catalog[name]
+                    containers['obs_files'].export_file(name,
+                                            os.path.join(workdir, 'obs_files'))
+                else:
+                    entry = station_catalog.lookup(catalog, './obs_files', name)
+                await analyse_station(station, entry, noisemodel, pool, workdir)
+
+                # --- Move the series into the containers
+                if containers is not None:
+                    for dirname in STAGES:
+                        fname = os.path.join(workdir, dirname, name)
+                        if dirname != 'obs_files':
+                            containers[dirname].import_file(fname)
+                        os.remove(fname)
+
+                # --- Append results of this station to the stores
+                results_store.append_json_file(store_est, station,
+                                os.path.join(workdir, 'estimatetrend.json'))
+                results_store.append_json_file(store_rem, station,
+                                os.path.join(workdir, 'removeoutliers.json'))
+
+            except (IOError, ValueError, KeyError, RuntimeError) as e:
+                print('{0:s} failed: {1:s}'.format(station, str(e)))
+                node = None if queue is None else queue.node
+                checkpoint.record_failure(checkpoint_dir, station, str(e),
+                                                                        node)
+                if schedule is not None:
+                    schedule.finish(station, False)
+                metrics.finish(station, False)
+                return
+            except asyncio.CancelledError:
+                if schedule is not None:
+                    schedule.finish(station, False)
+                metrics.finish(station, False)
+                raise
+
+            if schedule is not None:
+                schedule.finish(station)
+            metrics.finish(station)
+            checkpoint.mark_done(checkpoint_dir, station)
+
+    if queue is None:
+        await asyncio.gather(*[analyse_one(station) for station in stations])
+    else:
+        await job_queue.process_queue(queue, stations, analyse_one,
+                lambda station: checkpoint.is_done(checkpoint_dir, station),
+                n_jobs)
+    writer.cancel()
+    metrics.write()
+
+
+# ===============================================================================
+# Main program
+# ===============================================================================
+
+# --- Optional profiling with --profile or HECTOR_PROFILE (see profiling.py)
+profiling.setup('analyse_and_plot')
+
+# --- Directories that are read from and written to containers with --store
+STAGES = ['obs_files', 'pre_files', 'mom_files']
+
+# --- Optional flag to read ./obs_files.db and write ./pre_files.db and
+#    ./mom_files.db instead of the directories (see station_store.py)
+use_store = '--store' in sys.argv
+sys.argv = [arg for arg in sys.argv if arg != '--store']
+
+# --- Optional flag to skip stations finished in a previous run
+resume = '--resume' in sys.argv
+sys.argv = [arg for arg in sys.argv if arg != '--resume']
+
+# --- Optional flag to share the stations with other nodes that run the
+#    same command (see job_queue.py)
+use_queue = '--queue' in sys.argv
+sys.argv = [arg for arg in sys.argv if arg != '--queue']
+
+# --- Optional flag for the first node of a new --queue batch: the markers,
+#    locks and stores of the previous batch are removed
+new_batch = '--new-batch' in sys.argv
+sys.argv = [arg for arg in sys.argv if arg != '--new-batch']
+
+# --- Optional number of stations analysed at the same time, limits of
+#    the number of running instances of each tool and lease of the
+#    stations claimed in the queue
+n_jobs = 1
+limits = None
+lease = job_queue.DEFAULT_LEASE
+for option in ['--jobs', '--limits', '--lease']:
+    if option in sys.argv:
+        i = sys.argv.index(option)
+        if i+1 >= len(sys.argv):
+            print('{0:s} needs a value'.format(option))
+            sys.exit(1)
+        if option == '--jobs':
+            n_jobs = max(1, int(sys.argv[i+1]))
+        elif option == '--lease':
+            lease = float(sys.argv[i+1])
+        else:
+            limits = async_tools.parse_limits(sys.argv[i+1])
+        sys.argv = sys.argv[:i] + sys.argv[i+2:]
+
+# --- Read command line arguments
+if len(sys.argv)==2:
+    noisemodel = sys.argv[1]
+    stations = []
+elif len(sys.argv)==3:
+    noisemodel = sys.argv[1]
+    stations = [sys.argv[2]]
+else:
+    print('Correct usage: analyse_and_plot.py {fGGM|GGM|MT|PL|FN|RW|WN|AR1|VA}+ [station_name] [--resume]')
+    print('                   [--jobs N] [--limits estimatetrend=4,gnuplot=8,...] [--store]')
+    print('                   [--queue [--lease seconds] [--new-batch]]')
+    print('Example: analyse_and_plot.py PLWN')
+    sys.exit()
+    
+# --- Check noise model combination before starting
+try:
+    analyse_timeseries.parse_noisemodels(noisemodel)
+except ValueError as e:
+    print(e)
+    sys.exit(1)
+
+# --- SQLite locking cannot be trusted on a network file system
+if use_queue == True and use_store == True:
+    print('--queue cannot be combined with --store')
+    sys.exit(1)
+
+# --- Read station names and metadata from the container of ./obs_files
+containers = None
+if use_store == True:
+    if not os.path.isfile('./obs_files.db'):
+        print('Could not find ./obs_files.db')
+        sys.exit()
+    containers = {}
+    for dirname in STAGES:
+        containers[dirname] = station_store.StationStore(
+                                        station_store.store_name(dirname),
+                                        readonly=(dirname == 'obs_files'))
+    catalog = containers['obs_files'].catalog()
+    if len(stations)==0:
+        stations = [name[:-len('.mom')] for name in sorted(catalog.keys())]
+
+# --- Read station names in directory ./obs_files
+elif len(stations)==0:
+    fnames = compressed_io.glob_files("./obs_files/*.mom")
+    
+    # --- Did we find files?
+    if len(fnames)==0:
+        print('Could not find any mom-file in ./obs_files')
+        sys.exit()
+
+    # --- Extract station names
+    for fname in sorted(fnames):
+        m = re.search('/(\w+)\.mom',fname)
+        if m:
+            station = m.group(1)
+            stations.append(station)
+        else:
+            print('Could not parse station name from: {0:s}'.format(fname))
+            sys.exit()
+
+    # --- Sampling period and span of all files, only new or changed
+    #    files are read
+    catalog = station_catalog.update_catalog('./obs_files')
+else:
+    catalog = station_catalog.load_catalog('./obs_files')
+
+
+# --- Several nodes keep each other's completion markers: a new batch is
+#    started by the first node with --new-batch
+if new_batch == True and (use_queue == False or resume == True):
+    print('--new-batch needs --queue and cannot be combined with --resume')
+    sys.exit(1)
+queue = node = None
+if use_queue == True:
+    queue = job_queue.JobQueue('./queue/analyse_and_plot_{0:s}'.\
+                                                    format(noisemodel), lease)
+    node = queue.node
+    if new_batch == True:
+        queue.clear()
+        for fname in job_queue.node_files('hector_estimatetrend.jsonl') + \
+                    job_queue.node_files('hector_removeoutliers.jsonl'):
+            os.remove(fname)
+
+# --- Completion markers of each station
+checkpoint_dir = './checkpoints/analyse_and_plot_{0:s}'.format(noisemodel)
+checkpoint.open_checkpoint(checkpoint_dir,
+                resume == True or (use_queue == True and new_batch == False),
+                node)
+
+# --- Start new stores for the JSON results of each station, unless we
+#    continue a previous run. With --queue every node has its own stores.
+store_est = 'hector_estimatetrend.jsonl'
+store_rem = 'hector_removeoutliers.jsonl'
+if use_queue == True:
+    store_est = job_queue.node_file(store_est, node)
+    store_rem = job_queue.node_file(store_rem, node)
+elif resume == False:
+    for fname in [store_est, store_rem]:
+        if os.path.isfile(fname):
+            os.remove(fname)
+
+# --- Do the output directories exist?
+for dirname in ['./pre_files', './mom_files', './data_figures', './psd_figures']:
+    if not os.path.exists(dirname):
+        os.makedirs(dirname)
+
+# --- Analyse the stations that are not done yet, those that are expected
+#    to take longest first (see cost_model.py)
+jobs = {}
+noisemodels = analyse_timeseries.parse_noisemodels(noisemodel)
+for station in stations:
+    if checkpoint.is_done(checkpoint_dir, station):
+        print('#### {0:s} already done'.format(station))
+    else:
+        entry = catalog.get(station + '.mom', {})
+        jobs[station] = cost_model.job_features(entry, 1, noisemodels)
+if use_queue == True:
+    history = job_queue.node_file(cost_model.HISTORY, node)
+    done_elsewhere = lambda station: checkpoint.is_done(checkpoint_dir, station)
+else:
+    history = cost_model.HISTORY
+    done_elsewhere = None
+model = cost_model.CostModel('analyse_' + noisemodel, history)
+schedule = cost_model.Schedule(model, jobs, n_jobs, done_elsewhere)
+todo = schedule.order()
+asyncio.run(analyse_all(todo, catalog, noisemodel, n_jobs, limits,
+        checkpoint_dir, store_est, store_rem, containers, queue, schedule))
+if containers is not None:
+    for dirname in STAGES:
+        containers[dirname].close()
+
+# --- Produce the combined JSON files, of all nodes with --queue
+if use_queue == True:
+    results_store.compact(job_queue.node_files('hector_estimatetrend.jsonl'),
+                                                'hector_estimatetrend.json')
+    results_store.compact(job_queue.node_files('hector_removeoutliers.jsonl'),
+                                                'hector_removeoutliers.json')
+else:
+    results_store.compact(store_est, 'hector_estimatetrend.json')
+    results_store.compact(store_rem, 'hector_removeoutliers.json')
+
+# --- Index the results when HECTOR_RESULTS_DB is set (see results_db.py)
+results_db.import_run('analyse_and_plot ' + noisemodel,
+            'hector_estimatetrend.json', 'hector_removeoutliers.json',
+            noisemodel=noisemodel, batch=checkpoint.batch_id(checkpoint_dir))
+
+# --- Show stations that need to be redone
+checkpoint.report_failures(checkpoint_dir)
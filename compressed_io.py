@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+#
+# Read and write data files that may be compressed with gzip, xz or bzip2.
+#
+# Every file is referred to by its plain name, e.g. ./raw_files/ABCD_0.mom.
+# When only ABCD_0.mom.gz (or .xz, .bz2) exists, the readers of this module
+# decompress it while reading. Writers produce a compressed file when the
+# environment variable HECTOR_COMPRESS is set to gz, xz or bz2. The Hector
+# programs themselves can only read plain files; scratch_input() gives them
+# a decompressed copy in the working directory, but only when needed.
+#
+#  This script is part of Hector 1.9
+# ===============================================================================
+
+import os
+import bz2
+import glob
+import gzip
+import lzma
+import shutil
+
+# ===============================================================================
+# Global constants
+# ===============================================================================
+
+COMPRESSORS = {'.gz': gzip, '.xz': lzma, '.bz2': bz2}
+
+# ===============================================================================
+# Subroutines
+# ===============================================================================
+
+
+# ----------------------
+def logical_name(fname):
+    """
+    :param fname: name of a file, possibly with .gz, .xz or .bz2 at the end
+    :return: the name without the compression extension
+    """
+
+    for extension in COMPRESSORS.keys():
+        if fname.endswith(extension):
+            return fname[:-len(extension)]
+    return fname
+
+
+# -------------------
+def find_file(fname):
+    """
+    :param fname: plain name of a file
+    :return: name of the plain or compressed file that exists, or None
+    """
+
+    if os.path.isfile(fname):
+        return fname
+    for extension in COMPRESSORS.keys():
+        if os.path.isfile(fname + extension):
+            return fname + extension
+    return None
+
+
+# ----------------------
+def glob_files(pattern):
+    """
+    Like glob.glob but also finds the compressed versions of the files. If
+    a file exists both plain and compressed, only the plain one is given.
+    :param pattern: glob pattern, e.g. ./raw_files/*.mom
+    :return: sorted list of names of existing files
+    """
+
+    found = {}
+    for extension in [''] + list(COMPRESSORS.keys()):
+        for fname in glob.glob(pattern + extension):
+            name = logical_name(fname)
+            if name not in found:
+                found[name] = fname
+
+    return [found[name] for name in sorted(found.keys())]
+
+
+# -----------------------------
+def open_file(fname, mode='r'):
+    """
+    Open a plain or compressed file for reading.
+    :param fname: plain name of a file (or the name of the compressed one)
+    :param mode: 'r' for text or 'rb' for bytes
+    :return: file object
+    """
+
+    path = find_file(fname)
+    if path is None:
+        raise IOError('Cannot find {0:s}'.format(fname))
+    extension = os.path.splitext(path)[1]
+    if extension in COMPRESSORS:
+        if mode == 'r':
+            mode = 'rt'
+        return COMPRESSORS[extension].open(path, mode)
+
+    return open(path, mode)
+
+
+# ---------------------
+def output_extension():
+    """
+    :return: compression extension set by HECTOR_COMPRESS, or ''
+    """
+
+    value = os.environ.get('HECTOR_COMPRESS', '').strip().lstrip('.')
+    if len(value) == 0 or value == 'no':
+        return ''
+    if '.' + value not in COMPRESSORS:
+        raise ValueError('HECTOR_COMPRESS must be gz, xz or bz2')
+    return '.' + value
+
+
+# -----------------------------------------------
+def open_output(fname, mode='w', extension=None):
+    """
+    Open a file for writing, compressed if HECTOR_COMPRESS is set. Other
+    versions of the same file (plain or compressed) are removed so that
+    readers never see an old copy.
+    :param fname: plain name of the file
+    :param mode: 'w' for text or 'wb' for bytes
+    :param extension: compression extension, default from HECTOR_COMPRESS
+    :return: file object
+    """
+
+    if extension is None:
+        extension = output_extension()
+    for other in [''] + list(COMPRESSORS.keys()):
+        if other != extension and os.path.isfile(fname + other):
+            os.remove(fname + other)
+
+    if extension == '':
+        return open(fname, mode)
+    if mode == 'w':
+        mode = 'wt'
+
+    return COMPRESSORS[extension].open(fname + extension, mode)
+
+
+# --------------------------
+def decompress_to(src, dst):
+    """
+    Write the (decompressed) contents of a file to a plain file.
+    :param src: plain name of a file, or the name of the compressed one
+    :param dst: name of the plain output file
+    """
+
+    path = find_file(src)
+    if path is None:
+        raise IOError('Cannot find {0:s}'.format(src))
+    if logical_name(path) == path:
+        shutil.copyfile(path, dst)
+        return
+    with open_file(path, 'rb') as fp_in, open(dst, 'wb') as fp_out:
+        shutil.copyfileobj(fp_in, fp_out)
+
+
+# ------------------------------------
+def copy_to_directory(src, directory):
+    """
+    Copy a file, compressed or not, into a directory and remove other
+    versions of the same file there.
+    :param src: plain name of a file, or the name of the compressed one
+    :param directory: destination directory
+    """
+
+    path = find_file(src)
+    if path is None:
+        raise IOError('Cannot find {0:s}'.format(src))
+    dst = os.path.join(directory, os.path.basename(path))
+    plain = logical_name(dst)
+    for other in [''] + list(COMPRESSORS.keys()):
+        if plain + other != dst and os.path.isfile(plain + other):
+            os.remove(plain + other)
+    shutil.copyfile(path, dst)
+
+
+# ------------------------------------------
+def scratch_input(workdir, directory, name):
+    """
+    Directory to put in a ctl file so that a Hector program, running in
+    workdir, can read a file. A compressed file is first decompressed into
+    workdir/scratch.
+    :param workdir: directory in which the program runs
+    :param directory: data directory relative to workdir, e.g. ./obs_files
+    :param name: plain file name, e.g. ABCD_0.mom
+    :return: directory relative to workdir
+    """
+
+    fname = os.path.join(workdir, directory, name)
+    path = find_file(fname)
+    if path is None:
+        raise IOError('Cannot find {0:s}'.format(fname))
+    if path == fname:
+        return directory
+
+    scratch = os.path.join(workdir, 'scratch')
+    if not os.path.exists(scratch):
+        os.makedirs(scratch)
+    decompress_to(path, os.path.join(scratch, name))
+
+    return './scratch'
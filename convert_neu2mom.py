@@ -21,11 +21,13 @@
 # ===============================================================================
 
 import sys
-import glob
 import os
 import re
 import math
 
+import compressed_io
+import profiling
+
 # ===============================================================================
 # Subroutines
 # ===============================================================================
@@ -58,8 +60,11 @@ def get_MJD (yearfraction):
 # Main program
 # ===============================================================================
 
+# --- Optional profiling with --profile or HECTOR_PROFILE (see profiling.py)
+profiling.setup('convert_neu2mom')
+
 # Read all filenames in ./ori_files
-fnames = glob.glob("./ori_files/*.neu")
+fnames = compressed_io.glob_files("./ori_files/*.neu")
 fnames.sort()
 
 # Did we find some neu-files?
@@ -88,13 +93,13 @@ for fname in fnames:
     # Open the three files for output writing (E,N and Up)
     for i in range(0,3):
         # Open output file
-        fp_out[i] = open("./raw_files/{0:s}_{1:d}.mom".format(station,i),"w")
+        fp_out[i] = compressed_io.open_output("./raw_files/{0:s}_{1:d}.mom".format(station,i))
 
         # Write header
         fp_out[i].write("# sampling period 1.0\n")
 
     first_value = True
-    with open('./ori_files/{0:s}.neu'.format(station)) as fp_in:
+    with compressed_io.open_file('./ori_files/{0:s}.neu'.format(station)) as fp_in:
         for line in fp_in:
             if not line.startswith('#'):
                 cols = line.split();
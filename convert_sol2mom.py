@@ -30,11 +30,13 @@
 #===============================================================================
 
 import sys
-import glob 
 import os
 import re
 import math
 
+import compressed_io
+import profiling
+
 #===============================================================================
 # Subroutines
 #===============================================================================
@@ -107,11 +109,14 @@ def cartesian_to_geodetic(x,y,z):
 # Main program
 #===============================================================================
 
+#--- Optional profiling with --profile or HECTOR_PROFILE (see profiling.py)
+profiling.setup('convert_sol2mom')
+
 #--- Constant
 deg = 45.0/math.atan(1.0)
 
 #--- Read all filenames in ./ori_files
-fnames = glob.glob("./ori_files/*.sol")
+fnames = compressed_io.glob_files("./ori_files/*.sol")
 fnames.sort()
 
 #--- Did we find some sol-files?
@@ -141,13 +146,13 @@ for fname in fnames:
 
     for i in range(0,3):
         #--- Open output file
-        fp_out[i] = open("./raw_files/{0:s}_{1:d}.mom".format(station,i),"w")
+        fp_out[i] = compressed_io.open_output("./raw_files/{0:s}_{1:d}.mom".format(station,i))
 
         #--- Write header
         fp_out[i].write("# sampling period 1.0\n")
 
     first_value = True
-    with open('./ori_files/{0:s}.sol'.format(station)) as fp_in:
+    with compressed_io.open_file('./ori_files/{0:s}.sol'.format(station)) as fp_in:
         for line in fp_in:
             cols = line.split();
             yearfraction = float(cols[1])
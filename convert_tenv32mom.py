@@ -17,15 +17,20 @@
 
 import sys
 import os
-import glob
 import re
 
+import compressed_io
+import profiling
+
 # ===============================================================================
 # Main program
 # ===============================================================================
 
+# --- Optional profiling with --profile or HECTOR_PROFILE (see profiling.py)
+profiling.setup('convert_tenv32mom')
+
 # --- Read all filenames in ./ori_files
-fnames = glob.glob("./ori_files/*.tenv3")
+fnames = compressed_io.glob_files("./ori_files/*.tenv3")
 # print(fnames)
 fnames.sort()
 
@@ -59,14 +64,14 @@ for fname in fnames:
     # --- Open a mom file for each component
     for comp in range(0, 3):
         # fp_out[comp] = open('./raw_files/{0:s}_{1:d}.mom'.format(station, comp), 'w')
-        comp = open('./raw_files/{0:s}_{1:d}.mom'.format(station, comp), 'w')
+        comp = compressed_io.open_output('./raw_files/{0:s}_{1:d}.mom'.format(station, comp))
         fp_out.append(comp)
     for item in fp_out:
         item.write('# sampling period 1.0\n')
 
     # --- Parse file
     first_value = True
-    with open(fname, 'r') as fp_in:
+    with compressed_io.open_file(fname, 'r') as fp_in:
         for line in fp_in:
             if not line.startswith('site'):
                 cols = line.split()
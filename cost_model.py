@@ -0,0 +1,428 @@
+#!/usr/bin/env python3
+#
+# Run times of the stations of batch runs and a model that predicts them.
+#
+# How long a station takes depends mostly on the number of observations,
+# the percentage of gaps, the number of components (3D or not), the noise
+# models and, for find_offset.py, the number of iterations. The batch
+# drivers append the run time of every station together with these
+# features to run_times.jsonl (see results_store.py). From this history a
+# linear model of log(run time) is fitted by least squares; a station that
+# was run before also gets its own correction, which covers for instance
+# the number of offsets that find_offset.py finds. The drivers start the
+# stations that are expected to take longest first, so that a slow station
+# is not left running alone at the end, and show the expected end time.
+#
+# Usage:
+#   cost_model.py fit  [task]
+#   cost_model.py show task station
+#
+#  This script is part of Hector 1.9
+# ===============================================================================
+
+import os
+import sys
+import glob
+import math
+import time
+
+import results_store
+
+# ===============================================================================
+# Global constants
+# ===============================================================================
+
+HISTORY = 'run_times.jsonl'
+RIDGE = 1.0e-3
+
+# ===============================================================================
+# Subroutines
+# ===============================================================================
+
+
+# ---------------------------------------------------------------------
+def job_features(entry, components=1, noisemodels=None, trivial=False):
+    """
+    :param entry: catalog entry of the mom-file (see station_catalog.py)
+    :param components: 3 for find_offset.py in 3D mode, otherwise 1
+    :param noisemodels: list of noise model abbreviations, e.g. ['PL','WN']
+    :param trivial: True if the job is only a copy (e.g. too many gaps)
+    :return: dictionary with the features of the job
+    """
+
+    gap = entry.get('gap_percentage')
+    features = {'count': entry.get('count') or 0,
+                'gap': 0.0 if gap is None else max(0.0, gap) / 100.0,
+                'components': components,
+                'offsets': len(entry.get('offsets', [])),
+                'noisemodels': [] if noisemodels is None else noisemodels,
+                'trivial': trivial}
+
+    return features
+
+
+# --------------------------------
+def design_row(features, columns):
+    """
+    :param features: dictionary made by job_features
+    :param columns: names of the columns of the linear model
+    :return: list with the value of each column
+    """
+
+    row = []
+    for column in columns:
+        if column == 'const':
+            row.append(1.0)
+        elif column == 'log_count':
+            row.append(math.log(max(1, features['count'])))
+        elif column == 'gap':
+            row.append(features['gap'])
+        elif column == 'log_components':
+            row.append(math.log(features['components']))
+        elif column == 'offsets':
+            row.append(float(features['offsets']))
+        elif column.startswith('noise_'):
+            model = column[len('noise_'):]
+            row.append(1.0 if model in features['noisemodels'] else 0.0)
+        else:
+            raise ValueError('unknown column {0:s}'.format(column))
+
+    return row
+
+
+# ---------------------
+def solve(matrix, rhs):
+    """
+    Solve a small linear system by Gaussian elimination with pivoting.
+    :param matrix: list of rows (modified)
+    :param rhs: right hand side (modified)
+    :return: solution
+    """
+
+    n = len(rhs)
+    for k in range(0, n):
+        p = max(range(k, n), key=lambda i: abs(matrix[i][k]))
+        if abs(matrix[p][k]) < 1.0e-12:
+            raise ValueError('singular system')
+        matrix[k], matrix[p] = matrix[p], matrix[k]
+        rhs[k], rhs[p] = rhs[p], rhs[k]
+        for i in range(k+1, n):
+            factor = matrix[i][k] / matrix[k][k]
+            for j in range(k, n):
+                matrix[i][j] -= factor * matrix[k][j]
+            rhs[i] -= factor * rhs[k]
+
+    x = [0.0] * n
+    for k in range(n-1, -1, -1):
+        s = rhs[k] - sum([matrix[k][j]*x[j] for j in range(k+1, n)])
+        x[k] = s / matrix[k][k]
+
+    return x
+
+
+# ---------------------------
+def format_duration(seconds):
+    """
+    :param seconds: duration
+    :return: text like 2h05m, 7m12s, 45s or 2.5s
+    """
+
+    if seconds < 10:
+        return '{0:.1f}s'.format(seconds)
+    seconds = int(round(seconds))
+    if seconds >= 3600:
+        return '{0:d}h{1:02d}m'.format(seconds // 3600, (seconds % 3600) // 60)
+    if seconds >= 60:
+        return '{0:d}m{1:02d}s'.format(seconds // 60, seconds % 60)
+    return '{0:d}s'.format(seconds)
+
+
+# ------------------------------------------
+def makespan(durations, running, n_workers):
+    """
+    Time until n_workers have finished all jobs when the longest jobs are
+    started first.
+    :param durations: expected durations of the jobs not started yet
+    :param running: expected remaining durations of the running jobs
+    :param n_workers: number of jobs processed at the same time
+    :return: seconds
+    """
+
+    workers = sorted(running)[-n_workers:] if len(running) > 0 else []
+    workers = workers + [0.0] * (n_workers - len(workers))
+    for duration in sorted(durations, reverse=True):
+        i = workers.index(min(workers))
+        workers[i] += duration
+
+    return max(workers)
+
+
+# ===============================================================================
+# Classes
+# ===============================================================================
+
+
+class CostModel:
+    """ Predicts the run time of a station for one task, e.g. find_offset.
+    """
+
+    # --------------------------------------
+    def __init__(self, task, fname=HISTORY):
+        """
+        Read the history of the task. The history files of all nodes of a
+        --queue run (run_times.<node>.jsonl) are read as well.
+        :param task: name of the task, e.g. find_offset or analyse_PLWN
+        :param fname: file to which this process appends its run times
+        """
+
+        self.task = task
+        self.fname = fname
+        self.records = []
+        [base, extension] = os.path.splitext(HISTORY)
+        fnames = glob.glob(base + '*' + extension)
+        if fname not in fnames and os.path.isfile(fname):
+            fnames.append(fname)
+        for name in sorted(fnames):
+            for station, result in results_store.iter_records(name):
+                if result.get('task') == task and \
+                                    not result['features'].get('trivial'):
+                    self.records.append([station, result])
+        self.fit()
+
+    # ------------
+    def fit(self):
+        """
+        Fit log(run time) to the features of the history. With too little
+        history, the number of observations times the number of components
+        is used as a relative cost.
+        """
+
+        self.coefficients = None
+        self.columns = ['const', 'log_count', 'gap', 'log_components',
+                                                                    'offsets']
+        models = set()
+        for station, result in self.records:
+            models.update(result['features']['noisemodels'])
+        self.columns += ['noise_' + model for model in sorted(models)]
+
+        m = len(self.columns)
+        if len(self.records) < m + 2:
+            self.corrections = {}
+            return
+
+        # --- Normal equations with a little ridge for unused columns
+        ata = [[0.0] * m for i in range(0, m)]
+        aty = [0.0] * m
+        rows = []
+        for station, result in self.records:
+            row = design_row(result['features'], self.columns)
+            y = math.log(max(1.0e-3, result['seconds']))
+            rows.append([station, row, y])
+            for i in range(0, m):
+                aty[i] += row[i] * y
+                for j in range(0, m):
+                    ata[i][j] += row[i] * row[j]
+        for i in range(1, m):
+            ata[i][i] += RIDGE * len(rows)
+        try:
+            self.coefficients = solve(ata, aty)
+        except ValueError:
+            self.coefficients = None
+            self.corrections = {}
+            return
+
+        # --- Mean residual of each station, shrunk towards zero
+        sums = {}
+        for station, row, y in rows:
+            r = y - sum([c*x for c, x in zip(self.coefficients, row)])
+            [s, n] = sums.get(station, [0.0, 0])
+            sums[station] = [s + r, n + 1]
+        self.corrections = dict([(station, s / (n + 1.0)) for station,
+                                                    [s, n] in sums.items()])
+
+    # -----------------------------------
+    def predict(self, station, features):
+        """
+        :param station: station name
+        :param features: dictionary made by job_features
+        :return: expected run time in seconds (relative cost if there is not
+                 enough history yet)
+        """
+
+        if features.get('trivial') == True:
+            return 0.0
+        if self.coefficients is None:
+            return 1.0e-3 * max(1, features['count']) * features['components']
+        row = design_row(features, self.columns)
+        log_t = sum([c*x for c, x in zip(self.coefficients, row)])
+        log_t += self.corrections.get(station, 0.0)
+
+        return math.exp(min(log_t, 20.0))
+
+    # -------------------------------------------------------
+    def record(self, station, features, seconds, extra=None):
+        """
+        Append the run time of a station to the history.
+        :param station: station name
+        :param features: dictionary made by job_features
+        :param seconds: run time
+        :param extra: optional dictionary with more information
+        """
+
+        result = {'task': self.task, 'features': features,
+                  'seconds': seconds, 'time': time.time()}
+        if extra is not None:
+            result.update(extra)
+        results_store.append_record(self.fname, station, result)
+        if features.get('trivial') != True:
+            self.records.append([station, result])
+
+
+class Schedule:
+    """ Orders the jobs of a batch run and keeps track of the expected end.
+    """
+
+    # -------------------------------------------------------
+    def __init__(self, model, jobs, n_workers, is_done=None):
+        """
+        :param model: CostModel of the task
+        :param jobs: dictionary station -> features
+        :param n_workers: number of jobs processed at the same time
+        :param is_done: function that tells whether another node finished
+                        a station (see job_queue.py), or None
+        """
+
+        self.model = model
+        self.jobs = jobs
+        self.n_workers = n_workers
+        self.is_done = is_done
+        self.expected = dict([(station, model.predict(station, features))
+                                        for station, features in jobs.items()])
+        self.started = {}
+        self.finished = []
+        self.t0 = time.time()
+
+    # --------------
+    def order(self):
+        """
+        :return: station names, longest expected run time first
+        """
+
+        return sorted(self.jobs.keys(), key=lambda station:
+                                        (-self.expected[station], station))
+
+    # --------------
+    def scale(self):
+        """
+        :return: ratio of the measured and expected run times of this run,
+                 which corrects a model with little or old history
+        """
+
+        if len(self.finished) == 0:
+            return 1.0 if self.model.coefficients is not None else None
+        actual = sum([seconds for station, seconds in self.finished])
+        expected = sum([self.expected[station] for station, seconds in \
+                                                                self.finished])
+        return actual / max(expected, 1.0e-9)
+
+    # -----------------------
+    def start(self, station):
+        self.started[station] = time.time()
+
+    # --------------------------------------------------
+    def finish(self, station, success=True, extra=None):
+        """
+        Record the run time of a station and show the progress.
+        :param station: station name
+        :param success: False if the station failed (time not recorded)
+        :param extra: optional dictionary stored with the run time
+        """
+
+        seconds = time.time() - self.started.pop(station)
+        if success == True:
+            self.model.record(station, self.jobs[station], seconds, extra)
+            self.finished.append([station, seconds])
+        eta = self.eta()
+        text = '[{0:d}/{1:d}] {2:s} took {3:s}'.format(len(self.finished),
+                        len(self.jobs), station, format_duration(seconds))
+        if eta is not None:
+            text += ', ETA {0:s} ({1:s})'.format(format_duration(eta),
+                            time.strftime('%H:%M', time.localtime(time.time()
+                                                                    + eta)))
+        print(text)
+
+    # ------------
+    def eta(self):
+        """
+        :return: expected number of seconds until all jobs are finished, or
+                 None if nothing is known about the run times yet
+        """
+
+        scale = self.scale()
+        if scale is None:
+            return None
+        now = time.time()
+        done = set([station for station, seconds in self.finished])
+        running = [max(0.0, scale*self.expected[station] - (now - t)) for \
+                                        station, t in self.started.items()]
+        todo = [scale*self.expected[station] for station in self.jobs if \
+                        station not in done and station not in self.started]
+        if self.is_done is not None:
+            todo = [scale*self.expected[station] for station in self.jobs if \
+                        station not in done and station not in self.started \
+                        and not self.is_done(station)]
+
+        return makespan(todo, running, self.n_workers)
+
+
+# ===============================================================================
+# Main program
+# ===============================================================================
+
+if __name__ == '__main__':
+
+    # --- Read command line arguments
+    if len(sys.argv) < 2 or sys.argv[1] not in ['fit', 'show'] or \
+                            (sys.argv[1] == 'show' and len(sys.argv) != 4):
+        print('Correct usage: cost_model.py fit [task]')
+        print('               cost_model.py show task station')
+        sys.exit()
+
+    tasks = set()
+    [base, extension] = os.path.splitext(HISTORY)
+    for fname in glob.glob(base + '*' + extension):
+        for station, result in results_store.iter_records(fname):
+            tasks.add(result.get('task'))
+    if len(sys.argv) > 2:
+        tasks = [sys.argv[2]]
+
+    if sys.argv[1] == 'fit':
+        for task in sorted(tasks):
+            model = CostModel(task)
+            print('{0:s}: {1:d} run times'.format(task, len(model.records)))
+            if model.coefficients is None:
+                print('  not enough history for a fit')
+                continue
+            for column, c in zip(model.columns, model.coefficients):
+                print('  {0:16s} {1:10.4f}'.format(column, c))
+            errors = [math.log(result['seconds'] / model.predict(station,
+                                result['features'])) for station, result in \
+                                model.records if result['seconds'] > 0]
+            if len(errors) > 0:
+                rms = math.sqrt(sum([e*e for e in errors]) / len(errors))
+                print('  rms error        {0:10.1f}%'.format(
+                                                    100*(math.exp(rms)-1)))
+    else:
+        model = CostModel(sys.argv[2])
+        history = [result for station, result in model.records \
+                                                    if station == sys.argv[3]]
+        if len(history) == 0:
+            print('No run times of {0:s} for {1:s}'.format(sys.argv[3],
+                                                                sys.argv[2]))
+            sys.exit(1)
+        for result in history:
+            print('{0:s}  {1:>8s}'.format(time.strftime('%Y-%m-%d %H:%M',
+                        time.localtime(result['time'])),
+                        format_duration(result['seconds'])))
+        print('expected: {0:s}'.format(format_duration(model.predict(
+                                        sys.argv[3], history[-1]['features']))))
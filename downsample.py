@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+#
+# Shape-preserving downsampling of time series for the quick-look plots.
+#
+# A figure is only a few thousand pixels wide, so plotting every epoch of
+# a long or sub-daily series makes the rendering slow and the figure files
+# huge without showing more. Before plotting, the series is reduced to a
+# budget of points with
+#
+#   lttb   : largest-triangle-three-buckets, keeps the points that shape
+#            the curve (used for the observations)
+#   minmax : the lowest and highest point of each bucket, so that no
+#            spike or offset disappears (used for lines)
+#
+# The budget is HECTOR_PLOT_POINTS (default 5000, 0 keeps all points).
+# The offsets in the header of the mom-file are returned too, so that
+# they can be shown as markers. analyse_and_plot.py uses this module for
+# its data and residual plots, time_series.sh calls it as a filter.
+#
+# Usage: downsample.py file.mom [--points N] [--method lttb|minmax]
+#                               [--column 2] [--offsets]
+#
+#  This script is part of Hector 1.9
+# ===============================================================================
+
+import os
+import re
+import sys
+import argparse
+
+import compressed_io
+
+# ===============================================================================
+# Global constants
+# ===============================================================================
+
+POINTS = 5000
+METHODS = ['lttb', 'minmax']
+
+# --- Header line of an offset
+OFFSET = re.compile(r'#\s*offset\s+(\d+\.?\d*)')
+
+# ===============================================================================
+# Subroutines
+# ===============================================================================
+
+
+# -----------------
+def point_budget():
+    """
+    :return: number of points of a plotted series, HECTOR_PLOT_POINTS or
+             POINTS, 0 means all points
+    """
+
+    value = os.environ.get('HECTOR_PLOT_POINTS', '').strip()
+    if len(value) == 0:
+        return POINTS
+    return max(0, int(value))
+
+
+# ---------------------
+def read_series(fname):
+    """
+    :param fname: name of a (possibly compressed) mom-file
+    :return: [offsets, mjd, columns] with the MJD of the offsets in the
+             header, the epochs and the list of the other columns
+    """
+
+    offsets = []
+    mjd = []
+    columns = []
+    with compressed_io.open_file(fname, 'r') as fp:
+        for line in fp:
+            if line.startswith('#'):
+                m = OFFSET.match(line)
+                if m:
+                    offsets.append(float(m.group(1)))
+                continue
+            cols = line.split()
+            if len(cols) < 2:
+                continue
+            mjd.append(float(cols[0]))
+            while len(columns) < len(cols) - 1:
+                columns.append([])
+            for i in range(1, len(cols)):
+                columns[i-1].append(float(cols[i]))
+
+    return [offsets, mjd, columns]
+
+
+# ---------------------
+def lttb(x, y, budget):
+    """
+    Largest-triangle-three-buckets: the first and last point are kept and
+    from each of budget-2 buckets the point that makes the largest
+    triangle with the point kept before it and the mean of the next
+    bucket.
+    :param x: epochs (increasing)
+    :param y: values
+    :param budget: number of points kept
+    :return: indices of the points kept
+    """
+
+    n = len(x)
+    if budget <= 0 or n <= budget or budget < 3:
+        return list(range(0, n))
+
+    width = (n - 2) / (budget - 2)
+    kept = [0]
+    a = 0
+    for i in range(0, budget - 2):
+        start = int(i * width) + 1
+        end = int((i + 1) * width) + 1
+
+        # --- Mean of the next bucket (the last point for the last bucket)
+        next_start = end
+        next_end = min(int((i + 2) * width) + 1, n - 1)
+        if next_end <= next_start:
+            next_end = next_start + 1
+        x_mean = sum(x[next_start:next_end]) / (next_end - next_start)
+        y_mean = sum(y[next_start:next_end]) / (next_end - next_start)
+
+        # --- Point of this bucket with the largest triangle
+        best = start
+        area_max = -1.0
+        for j in range(start, end):
+            area = abs((x[a] - x_mean) * (y[j] - y[a]) - \
+                                            (x[a] - x[j]) * (y_mean - y[a]))
+            if area > area_max:
+                area_max = area
+                best = j
+        kept.append(best)
+        a = best
+    kept.append(n - 1)
+
+    return kept
+
+
+# -----------------------
+def minmax(x, y, budget):
+    """
+    The lowest and highest point of each of budget/2 buckets, in the
+    order of the epochs.
+    :param x: epochs (increasing)
+    :param y: values
+    :param budget: number of points kept (at most)
+    :return: indices of the points kept
+    """
+
+    n = len(x)
+    if budget <= 0 or n <= budget or budget < 2:
+        return list(range(0, n))
+
+    n_buckets = budget // 2
+    kept = []
+    for i in range(0, n_buckets):
+        start = i * n // n_buckets
+        end = (i + 1) * n // n_buckets
+        if end <= start:
+            continue
+        j_min = min(range(start, end), key=y.__getitem__)
+        j_max = max(range(start, end), key=y.__getitem__)
+        kept.extend(sorted(set([j_min, j_max])))
+
+    return kept
+
+
+# -----------------------------------------------
+def downsample(x, y, budget=None, method='lttb'):
+    """
+    :param x: epochs (increasing)
+    :param y: values
+    :param budget: number of points kept, default point_budget()
+    :param method: 'lttb' or 'minmax'
+    :return: indices of the points kept
+    """
+
+    if budget is None:
+        budget = point_budget()
+    if method == 'lttb':
+        return lttb(x, y, budget)
+    elif method == 'minmax':
+        return minmax(x, y, budget)
+    raise ValueError('unknown method {0:s}'.format(method))
+
+
+# ----------------------------------------------------------
+def write_plot_files(fname, directory, prefix, budget=None):
+    """
+    Write the downsampled observations (lttb), model and residuals
+    (minmax) of a mom-file with the fitted model, for gnuplot.
+    :param fname: mom-file with observations and model
+    :param directory: directory of the output files
+    :param prefix: start of the names of the output files
+    :param budget: number of points of each series, default point_budget()
+    :return: [list of the 3 file names, offsets (MJD)]
+    """
+
+    [offsets, mjd, columns] = read_series(fname)
+    if len(columns) < 2:
+        raise ValueError('{0:s} has no fitted model'.format(fname))
+    obs = columns[0]
+    mod = columns[1]
+    res = [obs[i] - mod[i] for i in range(0, len(mjd))]
+
+    fnames = []
+    for [name, y, method] in [['data', obs, 'lttb'], ['model', mod, 'minmax'],
+                              ['res', res, 'minmax']]:
+        fnames.append(os.path.join(directory, '{0:s}_{1:s}.dat'.format(prefix,
+                                                                        name)))
+        with open(fnames[-1], 'w') as fp:
+            for i in downsample(mjd, y, budget, method):
+                fp.write('{0:11.4f} {1:9.4f}\n'.format(mjd[i], y[i]))
+
+    return [fnames, offsets]
+
+
+# ===============================================================================
+# Main program
+# ===============================================================================
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Downsampled epochs and '
+                                     'values of a mom-file, e.g. for gmt plot')
+    parser.add_argument('fname', help='mom-file')
+    parser.add_argument('--points', type=int, default=point_budget(),
+                        help='number of points (0: all)')
+    parser.add_argument('--method', default='lttb', choices=METHODS)
+    parser.add_argument('--column', type=int, default=2,
+                        help='column with the values (2: observations)')
+    parser.add_argument('--offsets', action='store_true',
+                        help='print the epochs of the offsets instead')
+    args = parser.parse_args()
+
+    try:
+        [offsets, mjd, columns] = read_series(args.fname)
+    except (IOError, ValueError) as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
+
+    if args.offsets == True:
+        for t in offsets:
+            print('{0:11.4f}'.format(t))
+        sys.exit()
+
+    if args.column < 2 or args.column - 2 >= len(columns):
+        print('{0:s} has no column {1:d}'.format(args.fname, args.column),
+                                                            file=sys.stderr)
+        sys.exit(1)
+    y = columns[args.column - 2]
+    for i in downsample(mjd, y, args.points, args.method):
+        print('{0:11.4f} {1:9.4f}'.format(mjd[i], y[i]))
@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+#
+# Catalog of candidate offset epochs per station, e.g. antenna and receiver
+# changes from the equipment logs or the dates of nearby earthquakes.
+#
+# The catalog is a text file with one event per line:
+#
+#   ABCD  2009-10-08            antenna change
+#   ABCD  55211.5               receiver change
+#   EFGH  2011-03-11T05:46      earthquake
+#
+# The epoch is an MJD or a date (YYYY-MM-DD, optionally with a time). The
+# rest of the line is a free description. Lines starting with # are
+# comments. find_offset.py and find_all_offsets.py accept the catalog with
+# --events: the next offset is then first looked for within --tolerance days
+# of an event of the station. Only when none of the events lowers BIC_c is
+# the epoch with the lowest BIC_c of the full scan used, and only if it
+# lowers BIC_c by more than --margin. With --exclusive the full scan is
+# never used. Stations without events in the catalog are searched as
+# before.
+#
+# Usage: event_catalog.py catalog_file [station ...]
+#
+#  This script is part of Hector 1.9
+# ===============================================================================
+
+import re
+import sys
+import bisect
+import datetime
+
+# ===============================================================================
+# Global constants
+# ===============================================================================
+
+DEFAULT_TOLERANCE = 3.0
+DEFAULT_MARGIN = 6.0
+MODES = ['first', 'exclusive']
+
+MJD0 = datetime.datetime(1858, 11, 17)
+
+# ===============================================================================
+# Subroutines
+# ===============================================================================
+
+
+# --------------------
+def parse_epoch(text):
+    """
+    :param text: MJD or date as YYYY-MM-DD, YYYY-MM-DDTHH:MM[:SS]
+    :return: MJD, ValueError if the text is neither
+    """
+
+    m = re.match(r'^(\d{4})-(\d{2})-(\d{2})(?:[T ](\d{2}):(\d{2})(?::(\d{2}))?)?$',
+                                                                        text)
+    if m:
+        values = [int(value) if value is not None else 0 for value in \
+                                                                m.groups()]
+        epoch = datetime.datetime(*values)
+        return (epoch - MJD0).total_seconds() / 86400.0
+
+    return float(text)
+
+
+# ----------------------
+def read_catalog(fname):
+    """
+    :param fname: name of the catalog file
+    :return: dictionary station -> sorted list of [mjd, description]
+    """
+
+    catalog = {}
+    with open(fname, 'r') as fp:
+        for i, line in enumerate(fp):
+            cols = line.split(None, 2)
+            if len(cols) == 0 or cols[0].startswith('#'):
+                continue
+            if len(cols) < 2:
+                raise ValueError('{0:s}:{1:d}: expected station and epoch'. \
+                                                            format(fname, i+1))
+            try:
+                mjd = parse_epoch(cols[1])
+            except ValueError:
+                raise ValueError('{0:s}:{1:d}: cannot read epoch {2:s}'. \
+                                                   format(fname, i+1, cols[1]))
+            description = cols[2].strip() if len(cols) > 2 else ''
+            catalog.setdefault(cols[0], []).append([mjd, description])
+
+    for station in catalog:
+        catalog[station].sort()
+
+    return catalog
+
+
+# -----------------------------------
+def station_events(catalog, station):
+    """
+    :param catalog: dictionary station -> list of [mjd, description]
+    :param station: station name, a component (ABCD_0) also finds ABCD
+    :return: sorted list of the MJD of the events (empty if none)
+    """
+
+    events = catalog.get(station)
+    if events is None:
+        m = re.match(r'^(\w+)_\d$', station)
+        if m:
+            events = catalog.get(m.group(1))
+    if events is None:
+        return []
+
+    return [mjd for [mjd, description] in events]
+
+
+# -------------------------------------
+def near_event(mjd, events, tolerance):
+    """
+    :param mjd: epoch (MJD)
+    :param events: sorted list of event epochs (MJD)
+    :param tolerance: maximum distance to an event [days]
+    :return: True if mjd is within tolerance of one of the events
+    """
+
+    j = bisect.bisect_left(events, mjd - tolerance)
+
+    return j < len(events) and events[j] <= mjd + tolerance
+
+
+# ----------------------------------------------------------------
+def search_settings(catalog, station, tolerance=DEFAULT_TOLERANCE,
+                                        mode='first', margin=DEFAULT_MARGIN):
+    """
+    Settings of the offset search of one station (see find_offset.py).
+    :param catalog: dictionary station -> list of [mjd, description]
+    :param station: station name
+    :param tolerance: maximum distance to an event [days]
+    :param mode: 'first' (fall back to the full scan) or 'exclusive'
+    :param margin: decrease of BIC_c the full scan must at least give
+    :return: dictionary or None if the station has no events
+    """
+
+    if catalog is None:
+        return None
+    events = station_events(catalog, station)
+    if len(events) == 0:
+        return None
+
+    return {'events': events, 'tolerance': tolerance, 'mode': mode,
+            'margin': margin}
+
+
+# ===============================================================================
+# Main program
+# ===============================================================================
+
+if __name__ == '__main__':
+
+    # --- Read command line arguments
+    if len(sys.argv) < 2:
+        print('Correct usage: event_catalog.py catalog_file [station ...]')
+        sys.exit()
+
+    try:
+        catalog = read_catalog(sys.argv[1])
+    except (IOError, ValueError) as e:
+        print(e)
+        sys.exit(1)
+
+    stations = sys.argv[2:] if len(sys.argv) > 2 else sorted(catalog.keys())
+    for station in stations:
+        if station not in catalog:
+            print('{0:s}: no events'.format(station))
+            continue
+        for [mjd, description] in catalog[station]:
+            print('{0:12s} {1:10.2f}  {2:s}'.format(station, mjd, description))
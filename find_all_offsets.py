@@ -10,40 +10,289 @@
 import sys
 import os
 import re
-import glob
+
+import asyncio
+import threading
+
+import async_tools
+import checkpoint
+import compressed_io
+import cost_model
+import event_catalog
+import find_offset
+import job_queue
+import profiling
+import progress_metrics
+import results_db
+import station_catalog
+import station_store
+import workspace
+
+# ===============================================================================
+# Subroutines
+# ===============================================================================
+
+
+# -----------------------------------------------------------------------
+async def find_offsets_station(name, entry, options, pool, workdir='.'):
+    """
+    Find the offsets of one station (see find_offset.py, called in a thread
+    of the pool), or simply copy the files to ./obs_files if there are too
+    many gaps.
+    :param name: station name
+    :param entry: catalog entry of the mom-file used for the gaps
+    :param options: dictionary with use_3D, extra_penalty, resume, capture,
+                    the containers raw_store and obs_store (or None), the
+                    events of the stations with their settings (see
+                    event_catalog.py) and the length of the shortlist of
+                    the prescan (see offset_prescan.py) or None
+    :param pool: async_tools.ToolPool that runs find_offset.find_offsets
+    :param workdir: directory with links to the data directories in which
+                    the offsets are searched (see workspace.py)
+    :return: [lines of offsets_BIC_c.dat, number of iterations of
+             find_offset (0 if the offsets were not searched)]
+    """
+
+    # --- Percentage missing data (None for less than two epochs)
+    percentage = entry['gap_percentage']
+    if entry['sampling_period'] is None:
+        print('assuming daily observations')
+
+    # --- With containers (see station_store.py), the working directory has
+    #    private raw_files and obs_files directories
+    if options['use_3D'] == True:
+        comps = ['{0:s}_{1:d}.mom'.format(name, comp) for comp in range(0, 3)]
+    else:
+        comps = ['{0:s}.mom'.format(name)]
+    if options['raw_store'] is not None:
+        for fname in comps:
+            options['raw_store'].export_file(fname,
+                                            os.path.join(workdir, 'raw_files'))
+
+    # --- Only for time series with n>0
+    bic_c_lines = []
+    iterations = 0
+    if percentage is not None:
+        print('{0:s} :  {1:6.2f}%'.format(name, percentage))
+
+        # --- If there are too many gaps, simply copy files to ./obs_files
+        if percentage > 40.0:
+            for comp in range(0, 3):
+                compressed_io.copy_to_directory(os.path.join(workdir,
+                        'raw_files/{0:s}_{1:d}.mom'.format(name,comp)),
+                        os.path.join(workdir, 'obs_files'))
+
+        # --- Else, search the offsets
+        else:
+            if options['capture'] == True:
+                fp_log = open(os.path.join(workdir, 'find_offset.out'), 'w')
+                log = lambda text: fp_log.write(text + '\n')
+            else:
+                fp_log = None
+                log = print
+            search = event_catalog.search_settings(options['events'], name,
+                                options['tolerance'], options['mode'],
+                                options['margin'])
+            # --- When the job is cancelled (lost lease), the thread is told
+            #    to stop through the event
+            try:
+                result = await pool.call('find_offset', profiling.call,
+                                'find_offset', name,
+                                find_offset.find_offsets, name, 'PLWN',
+                                options['use_3D'], options['extra_penalty'],
+                                options['resume'], workdir, log, search,
+                                options['prescan'], cancel=threading.Event())
+            finally:
+                if fp_log is not None:
+                    fp_log.close()
+            bic_c_lines = ['{0:10.1f} {1:11.3f}'.format(mjd, bic_c) \
+                                        for [mjd, bic_c] in result['offsets']]
+            iterations = result['iterations']
+
+    # --- Move the results into the container of ./obs_files
+    if options['obs_store'] is not None:
+        for fname in comps:
+            path = compressed_io.find_file(os.path.join(workdir, 'obs_files',
+                                                                      fname))
+            if path is not None:
+                options['obs_store'].import_file(path)
+                os.remove(path)
+            os.remove(os.path.join(workdir, 'raw_files', fname))
+
+    return [bic_c_lines, iterations]
+
+
+# ------------------------------------------------------
+def combine_offsets(directory, stations, output_fname):
+    """
+    Write offsets_BIC_c.dat from the lines stored in the completion markers
+    of the stations, by all nodes. A station that is processed again after
+    a crash therefore never has its lines twice. Stations finished by an
+    older version, without lines in the marker, keep the lines of the
+    existing offsets_BIC_c.dat (or offsets_BIC_c.<node>.dat) files.
+    :param directory: checkpoint directory
+    :param stations: names of all stations
+    :param output_fname: name of the combined file
+    """
+
+    # --- Lines of the existing files, the last file of a station wins
+    old_lines = {}
+    for fname in [output_fname] + job_queue.node_files(output_fname):
+        if not os.path.isfile(fname):
+            continue
+        found = {}
+        with open(fname, 'r') as fp:
+            for line in fp:
+                cols = line.split()
+                if len(cols) > 0:
+                    found.setdefault(cols[0], []).append(line)
+        old_lines.update(found)
+
+    text = ''
+    for name in sorted(stations):
+        info = checkpoint.done_info(directory, name)
+        if info is None:
+            continue
+        elif 'offsets' in info:
+            text += ''.join(['{0:12s}  {1:s}\n'.format(name, line) for \
+                                                    line in info['offsets']])
+        else:
+            text += ''.join(old_lines.get(name, []))
+    checkpoint.write_atomic(output_fname, text)
+
 
 # ===============================================================================
 # Main program
 # ===============================================================================
 
+# --- Optional profiling with --profile or HECTOR_PROFILE (see profiling.py)
+profiling.setup('find_all_offsets')
+
+# --- Optional flag to skip stations finished in a previous run
+resume = '--resume' in sys.argv
+argv = [arg for arg in sys.argv if arg != '--resume']
+
+# --- Optional flag to read ./raw_files.db and write ./obs_files.db instead
+#    of the directories (see station_store.py)
+use_store = '--store' in argv
+argv = [arg for arg in argv if arg != '--store']
+
+# --- Optional flag to share the stations with other nodes that run the
+#    same command (see job_queue.py)
+use_queue = '--queue' in argv
+argv = [arg for arg in argv if arg != '--queue']
+
+# --- Optional flag for the first node of a new --queue batch: the markers
+#    and locks of the previous batch are removed
+new_batch = '--new-batch' in argv
+argv = [arg for arg in argv if arg != '--new-batch']
+
+# --- Optional flag to never fall back to the full scan when an event
+#    catalog is given (see event_catalog.py)
+exclusive = '--exclusive' in argv
+argv = [arg for arg in argv if arg != '--exclusive']
+
+# --- Optional number of stations processed at the same time, lease of
+#    the stations claimed in the queue and event catalog
+n_jobs = 1
+lease = job_queue.DEFAULT_LEASE
+events = None
+tolerance = event_catalog.DEFAULT_TOLERANCE
+margin = event_catalog.DEFAULT_MARGIN
+prescan = None
+for option in ['--jobs', '--lease', '--events', '--tolerance', '--margin',
+                                                                '--prescan']:
+    if option in argv:
+        i = argv.index(option)
+        if i+1 >= len(argv):
+            print('{0:s} needs a value'.format(option))
+            sys.exit(1)
+        if option == '--jobs':
+            n_jobs = max(1, int(argv[i+1]))
+        elif option == '--lease':
+            lease = float(argv[i+1])
+        elif option == '--events':
+            events = argv[i+1]
+        elif option == '--tolerance':
+            tolerance = float(argv[i+1])
+        elif option == '--prescan':
+            prescan = max(1, int(argv[i+1]))
+        else:
+            margin = float(argv[i+1])
+        argv = argv[:i] + argv[i+2:]
+
 # --- Read command line arguments
-if len(sys.argv) < 1 or len(sys.argv) > 3 or (len(sys.argv) == 3 and sys.argv[2] != '3D'):
-    print('Correct usage: find_all_offsets.py [penalty] [3D]')
+if len(argv) < 1 or len(argv) > 3 or (len(argv) == 3 and argv[2] != '3D'):
+    print('Correct usage: find_all_offsets.py [penalty] [3D] [--resume] [--jobs N] [--store]')
+    print('                   [--queue [--lease seconds] [--new-batch]]')
+    print('                   [--events catalog [--tolerance days] [--margin BIC_c] [--exclusive]]')
+    print('                   [--prescan candidates]')
     sys.exit()
 else:
-    if len(sys.argv) == 1:
+    if len(argv) == 1:
         use_3D = False
         extra_penalty = 8.0
-    elif len(sys.argv) == 2:
-        if sys.argv[2] != '3D':
+    elif len(argv) == 2:
+        if argv[1] != '3D':
             use_3D = False
-            extra_penalty = float(sys.argv[1])
+            extra_penalty = float(argv[1])
         else:
             use_3D = True
             extra_penalty = 8.0
     else:
         use_3D = True
-        extra_penalty = float(sys.argv[1])
+        extra_penalty = float(argv[1])
+
+# --- Candidate offset epochs of the stations
+events_by_station = None
+if events is not None:
+    try:
+        events_by_station = event_catalog.read_catalog(events)
+    except (IOError, ValueError) as e:
+        print(e)
+        sys.exit(1)
 
+# --- SQLite locking cannot be trusted on a network file system
+if use_queue == True and use_store == True:
+    print('--queue cannot be combined with --store')
+    sys.exit(1)
+
+# --- Several nodes keep each other's completion markers: a new batch is
+#    started by the first node with --new-batch
+if new_batch == True and (use_queue == False or resume == True):
+    print('--new-batch needs --queue and cannot be combined with --resume')
+    sys.exit(1)
+if use_queue == True:
+    queue = job_queue.JobQueue('./queue/find_all_offsets', lease)
+    node = queue.node
+    if new_batch == True:
+        queue.clear()
+        for fname in job_queue.node_files("offsets_BIC_c.dat"):
+            os.remove(fname)
+else:
+    queue = node = None
 
-# --- Open files to store estimated offset times
-fp_bic_c = open("offsets_BIC_c.dat", "w")
+# --- Completion markers of each station
+checkpoint_dir = './checkpoints/find_all_offsets'
+checkpoint.open_checkpoint(checkpoint_dir,
+                resume == True or (use_queue == True and new_batch == False),
+                node)
 
 # --- Retrieve all station names that need to be processed
 if use_3D == True:
-    fnames = glob.glob("./raw_files/*_0.mom")
+    pattern = "*_0.mom"
 else:
-    fnames = glob.glob("./raw_files/*.mom")
+    pattern = "*.mom"
+if use_store == True:
+    if not os.path.isfile('./raw_files.db'):
+        print("Did not find ./raw_files.db")
+        sys.exit()
+    raw_store = station_store.StationStore('./raw_files.db', readonly=True)
+    obs_store = station_store.StationStore('./obs_files.db')
+    fnames = ['./raw_files/' + name for name in raw_store.names(pattern)]
+else:
+    raw_store = obs_store = None
+    fnames = compressed_io.glob_files("./raw_files/" + pattern)
 
 # --- Sanity check
 if len(fnames) == 0:
@@ -54,7 +303,15 @@ if len(fnames) == 0:
 if not os.path.exists('./obs_files'):
     os.mkdir('./obs_files')
 
-# --- Process each file
+# --- Sampling period, span and gaps of each file (see station_catalog.py)
+if use_store == True:
+    catalog = raw_store.catalog()
+else:
+    catalog = station_catalog.update_catalog('./raw_files')
+
+# --- Collect the stations that still need to be processed
+stations = []
+todo = []
 for fname in sorted(fnames):
     if use_3D == True:
         m = re.search("/(\w+)_\d+.mom",fname)
@@ -71,45 +328,110 @@ for fname in sorted(fnames):
             print('Could not find station name in {0:s}'.format(fname))
             sys.exit()
 
-    # --- Check percentage missing data
-    fp = open(fname,'r')
-    lines = fp.readlines()
-    fp.close()
-    m = re.search('# sampling period (\d+\.d*)',lines[0])
-    if m:
-        dt = float(m.group(1))
+    # --- Already done in a previous run?
+    stations.append(name)
+    if checkpoint.is_done(checkpoint_dir, name):
+        print('{0:s} :  already done'.format(name))
     else:
-        print('assuming daily observations')
-        dt = 1.0
-    i0 = 0
-    while lines[i0].startswith('#'):
-        i0 += 1
-    i1 = len(lines)-1
-    cols = lines[i0].split()
-    t0 = float(cols[0])
-    cols = lines[i1].split()
-    t1 = float(cols[0])
-    n = int((t1-t0)/dt+1.0e-6)
+        todo.append([name, catalog[compressed_io.logical_name(os.path.basename(fname))]])
 
-    # --- Only for time series with n>0
-    if n > 0:
-        percentage = 100 - (i1-i0)/n * 100
-    
-        print('{0:s} :  {1:6.2f}%'.format(name, percentage))
+# --- Start the stations that are expected to take longest first (see
+#    cost_model.py)
+if use_queue == True:
+    history = job_queue.node_file(cost_model.HISTORY, node)
+    done_elsewhere = lambda name: checkpoint.is_done(checkpoint_dir, name)
+else:
+    history = cost_model.HISTORY
+    done_elsewhere = None
+jobs = {}
+for [name, entry] in todo:
+    trivial = entry['gap_percentage'] is None or entry['gap_percentage'] > 40.0
+    jobs[name] = cost_model.job_features(entry, 3 if use_3D else 1,
+                                                        ['PL', 'WN'], trivial)
+model = cost_model.CostModel('find_offset', history)
+schedule = cost_model.Schedule(model, jobs, n_jobs, done_elsewhere)
+entries = dict(todo)
+todo = [[name, entries[name]] for name in schedule.order()]
 
-        # --- If there are too many gaps, simply copy files to ./obs_files
-        if percentage > 40.0:
-            for comp in range(0, 3):
-                os.system('cp -f ./raw_files/{0:s}_{1:d}.mom ./obs_files/'.format(name,comp))
+# --- With more than one job, the progress of each station is stored in
+#    ./work/<station>/find_offset.out instead of shown.
+options = {'use_3D': use_3D, 'extra_penalty': extra_penalty,
+           'resume': resume, 'capture': n_jobs > 1,
+           'raw_store': raw_store, 'obs_store': obs_store,
+           'events': events_by_station, 'tolerance': tolerance,
+           'mode': 'exclusive' if exclusive else 'first', 'margin': margin,
+           'prescan': prescan}
 
-        # --- Else, run find_offset.py
+
+# ------------------------------------------------------
+async def process_station(name, entry, pool, slots, metrics):
+    async with slots:
+        if use_store == True:
+            workdir = workspace.make_workdir(name,
+                                        local=['raw_files', 'obs_files'])
+        elif n_jobs == 1 and use_queue == False:
+            workdir = '.'
         else:
-            if use_3D:
-                status = os.system("find_offset.py {0:s} PLWN 3D {1:f}".format(name,extra_penalty))
-            else:
-                status = os.system("find_offset.py {0:s} PLWN {1:f}".format(name,extra_penalty))
-            with open("findoffset_BIC_c.dat", 'r') as fp_in:
-                for line in fp_in:
-                    fp_bic_c.write("{0:12s}  {1:s}\n".format(name,line.rstrip()))
+            workdir = workspace.make_workdir(name)
+        schedule.start(name)
+        metrics.start(name)
+        try:
+            [bic_c_lines, iterations] = await find_offsets_station(name,
+                                                entry, options, pool, workdir)
+        except (IOError, IndexError, KeyError, ValueError, RuntimeError) as e:
+            print('{0:s} failed: {1:s}'.format(name, str(e)))
+            checkpoint.record_failure(checkpoint_dir, name, str(e), node)
+            schedule.finish(name, False)
+            metrics.finish(name, False)
+            return
+        except asyncio.CancelledError:
+            schedule.finish(name, False)
+            metrics.finish(name, False)
+            raise
+
+        schedule.finish(name, True, {'iterations': iterations})
+        metrics.finish(name)
+
+        # --- The offsets are stored with the marker, in one atomic step
+        checkpoint.mark_done(checkpoint_dir, name, {'offsets': bic_c_lines})
+
+
+# ---------------------
+async def process_all():
+    pool = async_tools.ToolPool({'find_offset': n_jobs})
+    slots = asyncio.Semaphore(n_jobs)
+    metrics = progress_metrics.Metrics('find_all_offsets',
+                [name for [name, entry] in todo], n_jobs, pool, node,
+                schedule.eta, done_elsewhere)
+    writer = asyncio.ensure_future(metrics.run())
+    if use_queue == True:
+
+        async def process(name):
+            await process_station(name, entries[name], pool, slots, metrics)
+
+        await job_queue.process_queue(queue, [name for [name, entry] in todo],
+                process, lambda name: checkpoint.is_done(checkpoint_dir, name),
+                n_jobs)
+    else:
+        await asyncio.gather(*[process_station(name, entry, pool, slots,
+                                        metrics) for [name, entry] in todo])
+    writer.cancel()
+    metrics.write()
+
+
+# --- Process each station
+asyncio.run(process_all())
+
+if use_store == True:
+    raw_store.close()
+    obs_store.close()
+
+# --- Combine the offsets of all stations, found by all nodes
+combine_offsets(checkpoint_dir, stations, "offsets_BIC_c.dat")
+
+# --- Index the offsets when HECTOR_RESULTS_DB is set (see results_db.py)
+results_db.import_run('find_all_offsets', offsets='offsets_BIC_c.dat',
+                                    batch=checkpoint.batch_id(checkpoint_dir))
 
-fp_bic_c.close()
+# --- Show stations that need to be redone
+checkpoint.report_failures(checkpoint_dir)
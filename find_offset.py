@@ -8,40 +8,65 @@
 import math
 import os
 import re
+import json
 import sys
 import time
+import shutil
 
+import checkpoint
+import compressed_io
+import event_catalog
+import offset_prescan
+import profiling
+from tool_exec import run_tool, move_file, remove_files
+
+
+# ===============================================================================
+# Global constants
+# ===============================================================================
+
+# --- Progress of the current station, saved after each iteration
+STATE_FILE = 'find_offset.state'
+
+# --- Maximum number of offsets and the reserved header lines for them
+MAX_ITERATIONS = 8
+N_SLOTS = MAX_ITERATIONS
+SLOT_WIDTH = 32
+
+# --- Noise models of the ctl files
+NOISE_MODELS = {'PLWN': 'GGM White', 'FNWN': 'FlickerGGM White',
+                'RWFNWN': 'RandomWalkGGM FlickerGGM White', 'WN': 'White'}
 
 # ===============================================================================
 # Subroutines
 # ===============================================================================
 
 
-# ---------------------
-def extract_results():
+# ---------------------------
+def extract_results(output):
     """
-    Extract estimated noise parameters from findoffset.txt.
+    Extract estimated noise parameters from the output of findoffset.
+    :param output: text written by findoffset to stdout
     :return: return list of estimated parameters
     """
 
     # --- Define variables we need to send back
     trend = trend_error = mjd = bic_c = None
 
-    # --- Read each line from file and see if it contains a label we need
-    with open("findoffset.txt", 'r') as fp:
-        for line in fp:
-            # --- This is the first BIC_c mentioned in the output and
-            #    corresponds to the situation before adding a new offset
-            m = re.match(r"^BIC_c\s+=\s*(-?\d+\.?\d*)", line)
-            if m:
-                bic_c = float(m.group(1))
-            m = re.match(r"^FindOffset MJD\s+=\s*(\d+\.?\d*)", line)
-            if m:
-                mjd = float(m.group(1))
-            m = re.match(r"^trend:\s+(-?\d+\.?\d*) \+\/\- (\d+\.?\d*)", line)
-            if m:
-                trend = float(m.group(1))
-                trend_error = float(m.group(2))
+    # --- Look at each line of the output and see if it contains a label we need
+    for line in output.splitlines():
+        # --- This is the first BIC_c mentioned in the output and
+        #    corresponds to the situation before adding a new offset
+        m = re.match(r"^BIC_c\s+=\s*(-?\d+\.?\d*)", line)
+        if m:
+            bic_c = float(m.group(1))
+        m = re.match(r"^FindOffset MJD\s+=\s*(\d+\.?\d*)", line)
+        if m:
+            mjd = float(m.group(1))
+        m = re.match(r"^trend:\s+(-?\d+\.?\d*) \+\/\- (\d+\.?\d*)", line)
+        if m:
+            trend = float(m.group(1))
+            trend_error = float(m.group(2))
 
     # --- Construct output
     output = [trend, trend_error, mjd, bic_c]
@@ -49,16 +74,17 @@ def extract_results():
     return output
 
 
-# ----------------------------------------
-def create_removeoutliers_ctl_file(comp):
+# ------------------------------------------------------
+def create_removeoutliers_ctl_file(comp, directory='.'):
     """
     Create ctl file for removeoutlier.
     :param comp:
         comp (integer): 0=East, 1=North and 2=Up
+    :param directory: directory in which removeoutliers will be run
     """
 
     # --- Create control.txt file for removeoutliers
-    fp = open("removeoutliers.ctl", "w")
+    fp = open(os.path.join(directory, "removeoutliers.ctl"), "w")
     fp.write("DataFile            dummy_raw.mom\n")
     fp.write("DataDirectory       ./\n")
     fp.write("interpolate         no\n")
@@ -73,36 +99,30 @@ def create_removeoutliers_ctl_file(comp):
 
 
 # -----------------------------------------------------------------------
-def create_findoffset_ctl_file(comp, i, noisemodel, extra_penalty, use_3D):
+def create_findoffset_ctl_file(comp, noisemodel, extra_penalty, use_3D,
+                                                                directory='.'):
     """
     Create ctl file for findoffset.
     :param comp: comp (integer): 0=East, 1=North and 2=Up
-    :param i: (integer): number of iteration
     :param noisemodel: noisemodel (string): PLWN, FNWN, RWFNWN or WN
     :param extra_penalty: 
     :param use_3D: 
+    :param directory: directory in which findoffset will be run
     :return: 
     """
 
     # --- Create control.txt file for EstimateTrend
-    fp = open("findoffset.ctl", "w")
-    fp.write("DataFile            dummy{0:d}_{1:d}.mom\n".format(comp, i))
+    fp = open(os.path.join(directory, "findoffset.ctl"), "w")
+    fp.write("DataFile            dummy{0:d}.mom\n".format(comp))
     fp.write("OutputFile          output.mom\n")
     fp.write("DataDirectory       ./\n")
     fp.write("interpolate         no\n")
     fp.write("PhysicalUnit        mm\n")
     fp.write("ScaleFactor         1.0\n")
-    if noisemodel == 'FNWN':
-        fp.write("NoiseModels         FlickerGGM White\n")
-    elif noisemodel == 'PLWN':
-        fp.write("NoiseModels         GGM White\n")
-    elif noisemodel == 'RWFNWN':
-        fp.write("NoiseModels         RandomWalkGGM FlickerGGM White\n")
-    elif noisemodel == 'WN':
-        fp.write("NoiseModels         White\n")
-    else:
-        print("Unknown noise model: {0:s}".format(noisemodel))
-        sys.exit()
+    if noisemodel not in NOISE_MODELS:
+        fp.close()
+        raise ValueError("Unknown noise model: {0:s}".format(noisemodel))
+    fp.write("NoiseModels         {0:s}\n".format(NOISE_MODELS[noisemodel]))
     fp.write("seasonalsignal      yes\n")
     fp.write("halfseasonalsignal  yes\n")
     fp.write("estimateoffsets     yes\n")
@@ -123,43 +143,145 @@ def create_findoffset_ctl_file(comp, i, noisemodel, extra_penalty, use_3D):
     fp.close()
 
 
-# -----------------------------------------
-def add_offsets_to_header(comp, i, offsets):
+# -----------------------------------------------------------------
+def create_estimatetrend_ctl_file(comp, noisemodel, directory='.'):
     """
-    Add newly found offsets to header.
+    Create ctl file for estimatetrend, used to compute the exact BIC_c of
+    the offsets in the header of dummy{comp}.mom (see run_prescan).
     :param comp: comp (integer): 0=East, 1=North and 2=Up
-    :param i: i (integer): number of iteration
-    :param offsets: 
-    :return: 
+    :param noisemodel: noisemodel (string): PLWN, FNWN, RWFNWN or WN
+    :param directory: directory in which estimatetrend will be run
+    """
+
+    if noisemodel not in NOISE_MODELS:
+        raise ValueError("Unknown noise model: {0:s}".format(noisemodel))
+    fp = open(os.path.join(directory, "estimatetrend.ctl"), "w")
+    fp.write("DataFile            dummy{0:d}.mom\n".format(comp))
+    fp.write("OutputFile          output.mom\n")
+    fp.write("DataDirectory       ./\n")
+    fp.write("interpolate         no\n")
+    fp.write("PhysicalUnit        mm\n")
+    fp.write("ScaleFactor         1.0\n")
+    fp.write("NoiseModels         {0:s}\n".format(NOISE_MODELS[noisemodel]))
+    fp.write("seasonalsignal      yes\n")
+    fp.write("halfseasonalsignal  yes\n")
+    fp.write("estimateoffsets     yes\n")
+    fp.write("JSON                yes\n")
+    fp.write("GGM_1mphi           6.9e-06\n")
+    fp.close()
+
+
+# ------------------------------------
+def make_overlay(comp, directory='.'):
+    """
+    Copy dummy{comp}_0.mom once into dummy{comp}.mom with, after the
+    header, N_SLOTS empty lines of SLOT_WIDTH characters. These slots are
+    later overwritten in place with the offsets of each iteration.
+    :param comp: comp (integer): 0=East, 1=North and 2=Up
+    :param directory: directory with the dummy files
+    :return: position (bytes) of the first slot in dummy{comp}.mom
     """
 
-    fp_out = open("dummy{0:d}_{1:d}.mom".format(comp, i), "w")
-    header = 1
-    with open("dummy{0:d}_0.mom".format(comp), 'r') as fp_in:
+    pos = None
+    fname_in = os.path.join(directory, "dummy{0:d}_0.mom".format(comp))
+    fname_out = os.path.join(directory, "dummy{0:d}.mom".format(comp))
+    with open(fname_in, 'rb') as fp_in, open(fname_out, 'wb') as fp_out:
         for line in fp_in:
-            if header == 1 and line.startswith('#') == False:
-                for mjd in offsets:
-                    if mjd > 1.0:
-                        fp_out.write("# offset {0:f}\n".format(mjd))
-                header = 0
+            if pos is None and line.startswith(b'#') == False:
+                pos = fp_out.tell()
+                fp_out.write(format_slots([]))
             fp_out.write(line)
+        if pos is None:
+            pos = fp_out.tell()
+            fp_out.write(format_slots([]))
+
+    os.remove(fname_in)
+
+    return pos
+
+
+# -------------------------
+def format_slots(offsets):
+    """
+    :param offsets: list of offsets (MJD), values <= 1 are skipped
+    :return: N_SLOTS header lines of SLOT_WIDTH bytes
+    """
+
+    lines = []
+    for mjd in offsets:
+        if mjd > 1.0:
+            lines.append("# offset {0:f}".format(mjd).ljust(SLOT_WIDTH-1))
+    if len(lines) > N_SLOTS:
+        raise RuntimeError("Too many offsets for the reserved header lines")
+    while len(lines) < N_SLOTS:
+        lines.append("#".ljust(SLOT_WIDTH-1))
+
+    return ''.join([line + '\n' for line in lines]).encode()
+
+
+# -----------------------------------------------------------
+def add_offsets_to_header(comp, pos, offsets, directory='.'):
+    """
+    Write the offsets into the reserved header lines of dummy{comp}.mom.
+    Only these lines are rewritten, not the observations.
+    :param comp: comp (integer): 0=East, 1=North and 2=Up
+    :param pos: position of the first slot (see make_overlay)
+    :param offsets: list of offsets (MJD), values <= 1 are skipped
+    :param directory: directory with the dummy files
+    """
 
-    fp_out.close()
+    with open(os.path.join(directory, "dummy{0:d}.mom".format(comp)),
+                                                                "r+b") as fp:
+        fp.seek(pos)
+        fp.write(format_slots(offsets))
 
 
-# ------------------------
-def find_minimum(n_comp):
+# --------------------------------------------------------------
+def save_with_offsets(comp, pos, offsets, fname, directory='.'):
+    """
+    Write dummy{comp}.mom with the given offsets in the header, without the
+    unused slots, to fname (compressed if HECTOR_COMPRESS is set).
+    :param comp: comp (integer): 0=East, 1=North and 2=Up
+    :param pos: position of the first slot (see make_overlay)
+    :param offsets: list of offsets (MJD), values <= 1 are skipped
+    :param fname: name of the output file
+    :param directory: directory with the dummy files
+    """
+
+    with open(os.path.join(directory, "dummy{0:d}.mom".format(comp)),
+                                                            "rb") as fp_in, \
+         compressed_io.open_output(fname, "wb") as fp_out:
+        fp_out.write(fp_in.read(pos))
+        for mjd in offsets:
+            if mjd > 1.0:
+                fp_out.write("# offset {0:f}\n".format(mjd).encode())
+        fp_in.seek(pos + N_SLOTS*SLOT_WIDTH)
+        shutil.copyfileobj(fp_in, fp_out)
+
+
+# -------------------------------------------------
+def find_minimum(n_comp, directory='.', log=print, search=None,
+                                                bic_c_now=None, offsets=None):
     """
      Sum BICc for three components and pick epoch (MJD) with minimum.
+     With an event catalog (see event_catalog.py) the minimum near the
+     events is taken if it lowers BIC_c. Otherwise the minimum of the full
+     scan is used, if it lowers BIC_c by more than the margin.
     :param n_comp: n_comp - 1 or 3 components
-    :return: list with [mjd,value] at minimum
+    :param directory: directory with the findoffset_?.out files
+    :param log: function that shows a line of progress
+    :param search: None or dictionary with events, tolerance, mode, margin
+    :param bic_c_now: BIC_c with the offsets found so far
+    :param offsets: offsets found so far, not tried again near an event
+    :return: MJD at minimum, None if no epoch may be used
     """
 
     mjds = []
     values = []
     for i in range(0, n_comp):
         j = 0
-        with open('findoffset_{0:1d}.out'.format(i), 'r') as fp:
+        with open(os.path.join(directory, 'findoffset_{0:1d}.out'.format(i)),
+                                                                    'r') as fp:
             for line in fp:
                 cols = line.split()
                 mjd = float(cols[0])
@@ -169,22 +291,51 @@ def find_minimum(n_comp):
                     values.append(value)
                 else:
                     if math.fabs(mjd - mjds[j]) > 1.0e-6:
-                        print('Huh? MJDs are not equal {0:f} - {1:f}'. \
+                        log('Huh? MJDs are not equal {0:f} - {1:f}'. \
                               format(mjd, mjds[j]))
                     else:
                         values[j] = values[j] + value
                         j = j + 1
 
+    if search is None:
+        j_min = values.index(min(values))
+        log('--> mjd={0:f},  value={1:f}'.format(mjds[j_min], values[j_min]))
+        return mjds[j_min]
+
+    # --- Epochs near an event of the station
+    if offsets is None:
+        offsets = []
+    near = [j for j in range(0, len(mjds)) if event_catalog.near_event(
+                        mjds[j], search['events'], search['tolerance']) and \
+                        min([math.fabs(mjds[j] - mjd) for mjd in offsets] + \
+                                                                [1.0]) >= 0.5]
+    if len(near) > 0:
+        j_min = min(near, key=lambda j: values[j])
+        if search['mode'] == 'exclusive' or values[j_min] < bic_c_now:
+            log('--> mjd={0:f},  value={1:f}  (event)'.format(mjds[j_min],
+                                                            values[j_min]))
+            return mjds[j_min]
+    if search['mode'] == 'exclusive':
+        log('--> no epoch near an event left')
+        return None
+
+    # --- Full scan, only if BIC_c still improves meaningfully
     j_min = values.index(min(values))
-    print('--> mjd={0:f},  value={1:f}'.format(mjds[j_min], values[j_min]))
+    if values[j_min] < bic_c_now - search['margin']:
+        log('--> mjd={0:f},  value={1:f}  (full scan)'.format(mjds[j_min],
+                                                            values[j_min]))
+        return mjds[j_min]
+    log('--> no event lowers BIC_c and the full scan not by {0:.1f}'. \
+                                                    format(search['margin']))
 
-    return mjds[j_min]
+    return None
 
 
-# -----------------------
-def make_equal_length():
+# -----------------------------------
+def make_equal_length(directory='.'):
     """
     Read the three dummy0/1/2_0.mom files and make them equal length.
+    :param directory: directory with the dummy files
     :return: 
     """
 
@@ -202,7 +353,7 @@ def make_equal_length():
         obs[i] = []
         header[i] = []
 
-        fp[i] = open("dummy{0:1d}_0.mom".format(i), "r")
+        fp[i] = open(os.path.join(directory, "dummy{0:1d}_0.mom".format(i)), "r")
         lines = fp[i].readlines()
         fp[i].close()
         for line in lines:
@@ -216,7 +367,7 @@ def make_equal_length():
     # --- length of each time series, open output file and write header
     for i in range(0, 3):
         n[i] = len(MJD[i])
-        fp[i] = open("dummy{0:1d}_0.mom".format(i), "w")
+        fp[i] = open(os.path.join(directory, "dummy{0:1d}_0.mom".format(i)), "w")
         for line in header[i]:
             fp[i].write(line)
 
@@ -233,168 +384,515 @@ def make_equal_length():
         elif MJD[2][index[2]] < MJD[0][index[0]] or MJD[2][index[2]] < MJD[0][index[0]]:
             index[2] = index[2] + 1
         else:
-            print("This should not happen...")
-            sys.exit()
+            for i in range(0, 3):
+                fp[i].close()
+            raise RuntimeError("This should not happen...")
 
     # --- Close the new files     
     for i in range(0, 3):
         fp[i].close()
 
 
-# ===============================================================================
-# Main program
-# ===============================================================================
+# ---------------------------------------------------------------
+def load_resume_state(station, noisemodel, n_comp, extra_penalty,
+                                directory='.', search=None, prescan=None):
+    """
+    Read the state of an interrupted run of the same station and settings.
+    :param station: station name
+    :param noisemodel: noisemodel (string): PLWN, FNWN, RWFNWN or WN
+    :param n_comp: 1 or 3 components
+    :param extra_penalty: BIC_c extra penalty
+    :param directory: directory of the interrupted run
+    :param search: settings of the event catalog or None
+    :param prescan: number of candidates of the prescan or None
+    :return: state dictionary or None if we have to start from scratch
+    """
 
-# --- Read command line arguments
-if len(sys.argv) < 3 or len(sys.argv) > 5:
-    print('Correct usage: find_offset.py station_name PLWN|FNWN|RWFNWN|WN [3D] [penalty]')
-    sys.exit()
-else:
-    station = sys.argv[1]
-    noisemodel = sys.argv[2]
-    if len(sys.argv) == 4:
-        if sys.argv[3] == '3D':
-            use_3D = True
-            n_comp = 3
-            extra_penalty = 8.0
-        else:
-            use_3D = False
-            n_comp = 1
-            extra_penalty = float(sys.argv[3])
-    elif len(sys.argv) == 5:
-        if sys.argv[3] == '3D':
-            use_3D = True
-            n_comp = 3
+    state = checkpoint.load_state(os.path.join(directory, STATE_FILE))
+    if state is None:
+        return None
+    if state['station'] != station or state['noisemodel'] != noisemodel or \
+       state['n_comp'] != n_comp or state['extra_penalty'] != extra_penalty:
+        return None
+    if state.get('search') != search or state.get('prescan') != prescan:
+        return None
+
+    # --- The dummy files of the outlier-free time series must still exist
+    if 'slots' not in state:
+        return None
+    for comp in range(0, n_comp):
+        if not os.path.isfile(os.path.join(directory,
+                                            "dummy{0:d}.mom".format(comp))):
+            return None
+
+    return state
+
+
+# -------------------------------------------------------------
+def prepare_station(station, n_comp, directory='.', log=print):
+    """
+    Remove the outliers of the 1 or 3 components and reserve the header
+    lines for the offsets.
+    :param station: station name
+    :param n_comp: 1 or 3 components
+    :param directory: directory with a raw_files directory in which the
+                      Hector programs are run
+    :param log: function that shows a line of progress
+    :return: list with the position of the slots in each dummy file
+    """
+
+    # --- Check if file for the 1 or 3 components exist and remove outliers
+    for comp in range(0, n_comp):
+
+        # --- Construct filename
+        if n_comp == 1:
+            name = station
         else:
-            print('Only accept 3D as 4th argument if 5th one is given as well')
-            sys.exit()
-        extra_penalty = float(sys.argv[4])
-    else:
-        use_3D = False
-        n_comp = 1
-        extra_penalty = 8.0
+            name = '{0:s}_{1:d}'.format(station, comp)
+
+        # --- check file existence
+        fname = os.path.join(directory, "raw_files/{0:s}.mom".format(name))
+        if compressed_io.find_file(fname) is None:
+            raise IOError("Cannot find {0:s}.mom file in raw_files directory". \
+                                                                format(name))
+
+        # --- Copy file to dummy_raw.mom and run removeoutliers over it
+        compressed_io.decompress_to(fname, os.path.join(directory,
+                                                            "dummy_raw.mom"))
+        create_removeoutliers_ctl_file(comp, directory)
+        output = run_tool(["removeoutliers"], cwd=directory)
+        if len(output) > 0:
+            log(output.rstrip())
+
+    # --- Make equal lengths if 3 components are used at the same time
+    if n_comp == 3:
+        make_equal_length(directory)
+
+    # --- Reserve header lines for the offsets so that each iteration only
+    #    needs to rewrite those lines
+    slots = []
+    for comp in range(0, n_comp):
+        slots.append(make_overlay(comp, directory))
 
-# --- Just for fun, also note down how long everything takes
-start = time.time()
+    return slots
 
-# --- Create empty arrays
-bic_c = []
-offsets = []
-misfit = []
 
-# --- Check if file for the 1 or 3 components exist and remove outliers
-for comp in range(0, n_comp):
+# --------------------------------------------------------------------------
+def run_findoffset(n_comp, noisemodel, extra_penalty, use_3D, directory='.',
+                                                                    log=print):
+    """
+    Run findoffset for each component with the offsets that are currently
+    in the header of the dummy files.
+    :param n_comp: 1 or 3 components
+    :param noisemodel: noisemodel (string): PLWN, FNWN, RWFNWN or WN
+    :param extra_penalty: BIC_c extra penalty
+    :param use_3D: True if the offsets are the same in all components
+    :param directory: directory with the dummy files
+    :param log: function that shows a line of progress
+    :return: sum of BIC_c of the components (before the new offset)
+    """
 
-    # --- Construct filename
-    if n_comp == 1:
-        name = station
-    else:
-        name = '{0:s}_{1:d}'.format(station, comp)
-
-    # --- check file existence
-    if not os.path.isfile("./raw_files/{0:s}.mom".format(name)):
-        print("Cannot find {0:s}.mom file in raw_files directory".format(name))
-        sys.exit()
-
-    # --- Copy file to dummy_raw.mom and run removeoutliers over it
-    os.system("cp -f ./raw_files/{0:s}.mom dummy_raw.mom".format(name))
-    create_removeoutliers_ctl_file(comp)
-    status = os.system("removeoutliers")
-
-# --- Make equal lengths if 3 components are used at the same time
-if n_comp == 3:
-    make_equal_length()
-
-# --- First test with no offset
-offsets.append(0.0)
-bic_c_0 = 0.0
-for comp in range(0, n_comp):
-    create_findoffset_ctl_file(comp, 0, noisemodel, extra_penalty, use_3D)
-    os.system("findoffset > findoffset.txt")
-    output = extract_results()
-    print("MJD={0:f}, trend={1:f}, BIC_c={2:f}".format(output[2], output[0], output[3]))
-    # --- Add BIC_c value (associated before new jump is found) to total
-    bic_c_0 = bic_c_0 + output[3]
-
-    # --- Save results
-    os.system('mv findoffset.out findoffset_{0:1d}.out'.format(comp))
-
-# --- For the case there are no offsets, use listed BIC_c
-print("For first round (no new offsets added) BIC_c: {0:f}".format(bic_c_0))
-bic_c.append(bic_c_0)
-
-# --- Next offset location
-mjd_min = find_minimum(n_comp)
-offsets.append(mjd_min)
-
-i = 0
-bic_c_old = bic_c[0]
-# --- Now test for 1 to 8 breaks 
-while i < 8:
-
-    # --- Add offsets to header
-    i = i + 1
-    misfit_row = []
     bic_c_0 = 0.0
     for comp in range(0, n_comp):
-        add_offsets_to_header(comp, i, offsets)
-
-        # --- Look at the effect of new offset
-        create_findoffset_ctl_file(comp, i, noisemodel, extra_penalty, use_3D)
-        os.system("findoffset > findoffset.txt")
-        output = extract_results()
-        print("MJD={0:f}, trend={1:f}, BIC_c={2:f}".format(output[2], output[0], output[3]))
+        create_findoffset_ctl_file(comp, noisemodel, extra_penalty, use_3D,
+                                                                    directory)
+        output = extract_results(run_tool(["findoffset"], cwd=directory))
+        log("MJD={0:f}, trend={1:f}, BIC_c={2:f}".format(output[2], output[0], output[3]))
         # --- Add BIC_c value (associated before new jump is found) to total
         bic_c_0 = bic_c_0 + output[3]
 
         # --- Save results
-        os.system('mv findoffset.out findoffset_{0:1d}.out'.format(comp))
+        move_file(os.path.join(directory, 'findoffset.out'),
+                  os.path.join(directory, 'findoffset_{0:1d}.out'.format(comp)))
 
-    # --- Save misfits for offset i
-    print("For offsets {0:1d} BIC_c: {1:f}".format(i, bic_c_0))
-    bic_c.append(bic_c_0)
+    return bic_c_0
 
-    # --- Prepare next offset location and already save it, together with BIC_c
-    mjd_min = find_minimum(n_comp)
-    offsets.append(mjd_min)
 
-    # --- Should we stop
-    if bic_c[i] >= bic_c_old:
-        break
+# ----------------------------------------------------------------------
+def run_estimatetrend(n_comp, noisemodel, extra_penalty, slots, offsets,
+                                                                directory='.'):
+    """
+    Exact BIC_c of the time series with the given offsets: estimatetrend
+    is run for each component with these offsets in the header.
+    :param n_comp: 1 or 3 components
+    :param noisemodel: noisemodel (string): PLWN, FNWN, RWFNWN or WN
+    :param extra_penalty: BIC_c extra penalty of each offset
+    :param slots: position of the slots in each dummy file
+    :param offsets: list of offsets (MJD), values <= 1 are skipped
+    :param directory: directory with the dummy files
+    :return: sum of BIC_c of the components, including the extra penalty
+    """
 
-    # --- Else prepare next round
-    bic_c_old = bic_c[i]
+    bic_c = 0.0
+    for comp in range(0, n_comp):
+        add_offsets_to_header(comp, slots[comp], offsets, directory)
+        create_estimatetrend_ctl_file(comp, noisemodel, directory)
+        run_tool(["estimatetrend"], cwd=directory)
+        with open(os.path.join(directory, 'estimatetrend.json'), 'r') as fp:
+            bic_c = bic_c + json.load(fp)['BIC_c']
+
+    n_offsets = len([mjd for mjd in offsets if mjd > 1.0])
+
+    return bic_c + n_comp * n_offsets * extra_penalty
+
+
+# ------------------------------------------------------------------------------
+def run_prescan(n_comp, noisemodel, extra_penalty, slots, offsets, n_candidates,
+                            cache, directory='.', log=print, search=None):
+    """
+    Next offset from a shortlist of the approximate scan of all epochs (see
+    offset_prescan.py): only the candidates are fitted exactly with
+    estimatetrend. The candidates are chosen with the rules of find_minimum.
+    :param n_comp: 1 or 3 components
+    :param noisemodel: noisemodel (string): PLWN, FNWN, RWFNWN or WN
+    :param extra_penalty: BIC_c extra penalty of each offset
+    :param slots: position of the slots in each dummy file
+    :param offsets: offsets found so far
+    :param n_candidates: length of the shortlist of the full scan
+    :param cache: dictionary tuple of offsets -> BIC_c, so that the BIC_c
+                  of the chosen candidate is not computed again
+    :param directory: directory with the dummy files
+    :param log: function that shows a line of progress
+    :param search: None or dictionary with events, tolerance, mode, margin
+    :return: [BIC_c with the offsets found so far, MJD of the next offset
+              or None if no epoch may be used]
+    """
+
+    # --- Exact BIC_c of a list of offsets, computed only once
+    def exact(mjds):
+        key = tuple(mjds)
+        if key not in cache:
+            cache[key] = run_estimatetrend(n_comp, noisemodel, extra_penalty,
+                                                slots, mjds, directory)
+        return cache[key]
+
+    bic_c_0 = exact(offsets)
+
+    # --- A candidate needs a free header line
+    if len([mjd for mjd in offsets if mjd > 1.0]) >= N_SLOTS:
+        log('--> no header line left for another offset')
+        return [bic_c_0, None]
+
+    fnames = [os.path.join(directory, "dummy{0:d}.mom".format(comp)) \
+                                                for comp in range(0, n_comp)]
+    if search is None:
+        [candidates, event_candidates, ds] = offset_prescan.prescan(fnames,
+                                                        offsets, n_candidates)
+    else:
+        if search['mode'] == 'exclusive':
+            n_candidates = 0
+        [candidates, event_candidates, ds] = offset_prescan.prescan(fnames,
+                                offsets, n_candidates, events=search['events'],
+                                tolerance=search['tolerance'])
+    log('prescan: d={0:s}, {1:d} candidates, {2:d} near events'.format(
+                    ','.join(['{0:.2f}'.format(d) for d in ds]),
+                    len(candidates), len(event_candidates)))
+
+    # --- Exact BIC_c of the candidates, lowest first
+    def confirm(shortlist, label):
+        values = []
+        for [mjd, approximate] in shortlist:
+            values.append([exact(offsets + [mjd]), mjd])
+            log('    mjd={0:f}, approximate={1:f}, BIC_c={2:f}{3:s}'.format(
+                                        mjd, approximate, values[-1][0], label))
+        return sorted(values)
+
+    if search is None:
+        values = confirm(candidates, '')
+        if len(values) == 0:
+            log('--> no candidate left')
+            return [bic_c_0, None]
+        log('--> mjd={0:f},  value={1:f}'.format(values[0][1], values[0][0]))
+        return [bic_c_0, values[0][1]]
+
+    # --- Epochs near an event of the station
+    values = confirm(event_candidates, '  (event)')
+    if len(values) > 0:
+        if search['mode'] == 'exclusive' or values[0][0] < bic_c_0:
+            log('--> mjd={0:f},  value={1:f}  (event)'.format(values[0][1],
+                                                                values[0][0]))
+            return [bic_c_0, values[0][1]]
+    if search['mode'] == 'exclusive':
+        log('--> no epoch near an event left')
+        return [bic_c_0, None]
+
+    # --- Shortlist of the full scan, only if BIC_c still improves meaningfully
+    values = confirm(candidates, '')
+    if len(values) > 0 and values[0][0] < bic_c_0 - search['margin']:
+        log('--> mjd={0:f},  value={1:f}  (full scan)'.format(values[0][1],
+                                                                values[0][0]))
+        return [bic_c_0, values[0][1]]
+    log('--> no event lowers BIC_c and the full scan not by {0:.1f}'. \
+                                                    format(search['margin']))
+
+    return [bic_c_0, None]
+
+
+# --------------------------------
+def check_cancel(cancel, station):
+    """
+    :param cancel: threading.Event or None
+    :param station: station name
+    """
+
+    if cancel is not None and cancel.is_set():
+        raise RuntimeError('{0:s} was cancelled'.format(station))
+
+
+# ---------------------------------------------------------------------------
+def find_offsets(station, noisemodel='PLWN', use_3D=False, extra_penalty=8.0,
+                        resume=False, directory='.', log=print, search=None,
+                                                    prescan=None, cancel=None):
+    """
+    Find the offsets of a station: add offsets one by one at the epoch
+    with the lowest BIC_c until BIC_c no longer decreases. The time series
+    with the offsets of the best iteration in the header are written to
+    obs_files, the offsets and BIC_c values to findoffset_BIC_c.dat. The
+    function only uses files below directory, so several stations can be
+    processed at the same time in different directories.
+    :param station: station name
+    :param noisemodel: noisemodel (string): PLWN, FNWN, RWFNWN or WN
+    :param use_3D: use the 3 components STATION_0/1/2 at the same time
+    :param extra_penalty: BIC_c extra penalty
+    :param resume: continue after the last completed iteration
+    :param directory: directory with raw_files and obs_files in which the
+                      Hector programs are run
+    :param log: function that shows a line of progress, default print
+    :param search: None (full scan) or the settings of the event catalog,
+                   see event_catalog.search_settings
+    :param prescan: None (findoffset scans all epochs) or the number of
+                    candidates of the approximate scan (see run_prescan)
+    :param cancel: optional threading.Event; once it is set, e.g. because
+                   another node took over the station (see job_queue.py),
+                   RuntimeError is raised before the next iteration and
+                   before anything is written to obs_files
+    :return: dictionary with offsets (list of [mjd, BIC_c] up to the best
+             iteration, the first line has no offset), iterations and
+             seconds
+    """
+
+    n_comp = 3 if use_3D == True else 1
+    state_file = os.path.join(directory, STATE_FILE)
+
+    # --- Just for fun, also note down how long everything takes
+    start = time.time()
+
+    # --- Continue an interrupted run of this station?
+    state = None
+    if resume == True:
+        state = load_resume_state(station, noisemodel, n_comp, extra_penalty,
+                                                directory, search, prescan)
+
+    if state is None:
+        slots = prepare_station(station, n_comp, directory, log)
+
+        # --- No iteration has been completed yet
+        state = {'station': station, 'noisemodel': noisemodel,
+                 'n_comp': n_comp, 'extra_penalty': extra_penalty, 'i': -1,
+                 'offsets': [], 'bic_c': [], 'finished': False, 'slots': slots,
+                 'search': search, 'prescan': prescan}
+        checkpoint.save_state(state_file, state)
 
-# --- Remember number of offsets estimated
-n = i
-
-# --- Show results
-for i in range(0, n + 1):
-    print("{0:1d} MJD={1:10.1f} BIC_c={2:10.2f}". \
-          format(i, offsets[i], bic_c[i]))
-
-# --- Save found breaks to file
-fp = open("findoffset_BIC_c.dat", "w")
-for i in range(0, bic_c.index(min(bic_c)) + 1):
-    fp.write("{0:10.1f} {1:11.3f}\n".format(offsets[i], bic_c[i]))
-fp.close()
-
-# --- Does the obs_files directory exists?
-if not os.path.exists('./obs_files'):
-    os.mkdir('./obs_files')
-
-# --- Save time series with offsets in header
-k = bic_c.index(min(bic_c))
-for comp in range(0, n_comp):
-    if n_comp == 1:
-        os.system("cp -f dummy{0:1d}_{1:1d}.mom obs_files/{2:s}.mom".format(comp, k, name))
     else:
-        os.system("cp -f dummy{0:1d}_{1:1d}.mom obs_files/{2:s}".format(comp, k, station) + "_{0:1d}.mom".format(comp))
+        log("Resuming {0:s} after iteration {1:d}".format(station, state['i']))
+
+    # --- Offsets and BIC_c values found so far
+    offsets = state['offsets']
+    bic_c = state['bic_c']
+    slots = state['slots']
+    i = state['i']
+
+    # --- Exact BIC_c of the offsets tried by the prescan
+    cache = {}
+
+    # --- First test with no offset
+    check_cancel(cancel, station)
+    if i < 0:
+        offsets.append(0.0)
+        if prescan is None:
+            bic_c_0 = run_findoffset(n_comp, noisemodel, extra_penalty,
+                                                    use_3D, directory, log)
+
+            # --- Next offset location
+            mjd_min = find_minimum(n_comp, directory, log, search, bic_c_0,
+                                                                    offsets)
+        else:
+            [bic_c_0, mjd_min] = run_prescan(n_comp, noisemodel,
+                                        extra_penalty, slots, offsets, prescan,
+                                        cache, directory, log, search)
+
+        # --- For the case there are no offsets, use listed BIC_c
+        log("For first round (no new offsets added) BIC_c: {0:f}".format(bic_c_0))
+        bic_c.append(bic_c_0)
+        if mjd_min is None:
+            state['finished'] = True
+        else:
+            offsets.append(mjd_min)
+
+        i = 0
+        state['i'] = i
+        checkpoint.save_state(state_file, state)
+
+    bic_c_old = bic_c[i]
+    # --- Now test for 1 to 8 breaks 
+    while i < MAX_ITERATIONS and state['finished'] == False:
+        check_cancel(cancel, station)
+
+        # --- Add offsets to header and look at the effect of new offset
+        i = i + 1
+        if prescan is None:
+            for comp in range(0, n_comp):
+                add_offsets_to_header(comp, slots[comp], offsets, directory)
+            bic_c_0 = run_findoffset(n_comp, noisemodel, extra_penalty,
+                                                    use_3D, directory, log)
+
+            # --- Prepare next offset location
+            mjd_min = find_minimum(n_comp, directory, log, search, bic_c_0,
+                                                                    offsets)
+        else:
+            [bic_c_0, mjd_min] = run_prescan(n_comp, noisemodel,
+                                        extra_penalty, slots, offsets, prescan,
+                                        cache, directory, log, search)
+
+        # --- Save misfits for offset i and the next offset location
+        log("For offsets {0:1d} BIC_c: {1:f}".format(i, bic_c_0))
+        bic_c.append(bic_c_0)
+        if mjd_min is None:
+            state['finished'] = True
+        else:
+            offsets.append(mjd_min)
+
+        # --- Should we stop
+        if bic_c[i] >= bic_c_old:
+            state['finished'] = True
+
+        # --- Else prepare next round
+        else:
+            bic_c_old = bic_c[i]
+
+        # --- Remember that this iteration has been completed
+        state['i'] = i
+        checkpoint.save_state(state_file, state)
+
+    # --- Remember number of offsets estimated
+    n = i
+
+    # --- Show results
+    for i in range(0, n + 1):
+        log("{0:1d} MJD={1:10.1f} BIC_c={2:10.2f}". \
+              format(i, offsets[i], bic_c[i]))
+
+    # --- Save found breaks to file
+    check_cancel(cancel, station)
+    k = bic_c.index(min(bic_c))
+    fp = open(os.path.join(directory, "findoffset_BIC_c.dat"), "w")
+    for i in range(0, k + 1):
+        fp.write("{0:10.1f} {1:11.3f}\n".format(offsets[i], bic_c[i]))
+    fp.close()
+
+    # --- Does the obs_files directory exists?
+    if not os.path.exists(os.path.join(directory, 'obs_files')):
+        os.mkdir(os.path.join(directory, 'obs_files'))
+
+    # --- Save time series with the offsets of the best iteration in header
+    for comp in range(0, n_comp):
+        if n_comp == 1:
+            fname = "obs_files/{0:s}.mom".format(station)
+        else:
+            fname = "obs_files/{0:s}_{1:1d}.mom".format(station, comp)
+        save_with_offsets(comp, slots[comp], offsets[:k+1],
+                                    os.path.join(directory, fname), directory)
+
+    # --- Finally, show computation time
+    finish = time.time()
+    dif = finish - start
+    log("Computation time in seconds: {0:f}".format(dif))
+
+    # --- Clean up dummy files and the progress of this station
+    remove_files(os.path.join(directory, 'dummy*.mom'))
+    if prescan is not None:
+        remove_files(os.path.join(directory, 'estimatetrend.json'))
+    os.remove(state_file)
 
-# --- Finally, show computation time
-finish = time.time()
-dif = finish - start
-print("Computation time in seconds: {0:f}".format(dif))
+    return {'offsets': [[offsets[i], bic_c[i]] for i in range(0, k + 1)],
+            'iterations': n, 'seconds': dif}
+
+
+# ===============================================================================
+# Main program
+# ===============================================================================
 
-# --- Clean up dummy files
-os.system('rm -f dummy*.mom')
+if __name__ == '__main__':
+
+    # --- Optional profiling with --profile or HECTOR_PROFILE (see profiling.py)
+    profiling.setup('find_offset')
+
+    # --- Optional flag to continue after the last completed iteration
+    resume = '--resume' in sys.argv
+    sys.argv = [arg for arg in sys.argv if arg != '--resume']
+
+    # --- Optional catalog of candidate offset epochs (see event_catalog.py)
+    exclusive = '--exclusive' in sys.argv
+    sys.argv = [arg for arg in sys.argv if arg != '--exclusive']
+    events = None
+    tolerance = event_catalog.DEFAULT_TOLERANCE
+    margin = event_catalog.DEFAULT_MARGIN
+
+    # --- Optional length of the shortlist of the approximate scan (see
+    #    offset_prescan.py)
+    prescan = None
+    for option in ['--events', '--tolerance', '--margin', '--prescan']:
+        if option in sys.argv:
+            i = sys.argv.index(option)
+            if i+1 >= len(sys.argv):
+                print('{0:s} needs a value'.format(option))
+                sys.exit(1)
+            if option == '--events':
+                events = sys.argv[i+1]
+            elif option == '--tolerance':
+                tolerance = float(sys.argv[i+1])
+            elif option == '--prescan':
+                prescan = max(1, int(sys.argv[i+1]))
+            else:
+                margin = float(sys.argv[i+1])
+            sys.argv = sys.argv[:i] + sys.argv[i+2:]
+
+    # --- Read command line arguments
+    if len(sys.argv) < 3 or len(sys.argv) > 5:
+        print('Correct usage: find_offset.py station_name PLWN|FNWN|RWFNWN|WN [3D] [penalty] [--resume]')
+        print('                   [--events catalog [--tolerance days] [--margin BIC_c] [--exclusive]]')
+        print('                   [--prescan candidates]')
+        sys.exit(1)
+    else:
+        station = sys.argv[1]
+        noisemodel = sys.argv[2]
+        if len(sys.argv) == 4:
+            if sys.argv[3] == '3D':
+                use_3D = True
+                extra_penalty = 8.0
+            else:
+                use_3D = False
+                extra_penalty = float(sys.argv[3])
+        elif len(sys.argv) == 5:
+            if sys.argv[3] == '3D':
+                use_3D = True
+            else:
+                print('Only accept 3D as 4th argument if 5th one is given as well')
+                sys.exit(1)
+            extra_penalty = float(sys.argv[4])
+        else:
+            use_3D = False
+            extra_penalty = 8.0
+    profiling.set_label(station)
+
+    try:
+        search = None
+        if events is not None:
+            catalog = event_catalog.read_catalog(events)
+            search = event_catalog.search_settings(catalog, station,
+                    tolerance, 'exclusive' if exclusive else 'first', margin)
+        find_offsets(station, noisemodel, use_3D, extra_penalty, resume,
+                                            search=search, prescan=prescan)
+    except (IOError, ValueError, RuntimeError) as e:
+        print(e)
+        sys.exit(1)
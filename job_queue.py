@@ -0,0 +1,386 @@
+#!/usr/bin/env python3
+#
+# Share the stations of a batch run between several nodes through a queue
+# directory on a shared file system.
+#
+# Every node runs the same command, e.g. "analyse_and_plot.py PLWN --queue".
+# Before a node processes a station it creates the lock file
+# <queue>/<station>.lock with O_CREAT|O_EXCL, which succeeds for only one
+# node. While the station is processed the node touches the lock file every
+# lease/3 seconds. A lock file that has not been touched for longer than the
+# lease belongs to a node that crashed; it is renamed away (an atomic
+# operation that only one node can win) and the station is claimed again.
+# If the renamed file turns out to be a fresh lock of another node, it is
+# put back. A node that finds its lock gone or replaced cancels the job.
+# Finished stations are recorded by the completion markers of checkpoint.py.
+# A new batch is started by giving the first node --new-batch, which clears
+# the locks and the markers of the previous batch.
+# The ages of the lock files are measured with the clock of the file server,
+# so the clocks of the nodes do not need to agree.
+#
+# Usage:
+#   job_queue.py status queue_directory [lease]
+#   job_queue.py clear  queue_directory
+#
+#  This script is part of Hector 1.9
+# ===============================================================================
+
+import os
+import sys
+import glob
+import json
+import time
+import socket
+import asyncio
+
+# ===============================================================================
+# Global constants
+# ===============================================================================
+
+DEFAULT_LEASE = 600.0
+
+# ===============================================================================
+# Subroutines
+# ===============================================================================
+
+
+# --------------
+def node_name():
+    """
+    :return: name of this node and process, e.g. node12.4711
+    """
+
+    return '{0:s}.{1:d}'.format(socket.gethostname().split('.')[0],
+                                                                  os.getpid())
+
+
+# -------------------------
+def node_file(fname, node):
+    """
+    Every node writes its results to its own file since appending to one
+    file from several machines is not safe on a network file system.
+    :param fname: name of the combined file, e.g. offsets_BIC_c.dat
+    :param node: name of the node
+    :return: name of the file of this node, e.g. offsets_BIC_c.node12.4711.dat
+    """
+
+    [base, extension] = os.path.splitext(fname)
+    return '{0:s}.{1:s}{2:s}'.format(base, node, extension)
+
+
+# --------------------
+def node_files(fname):
+    """
+    :param fname: name of the combined file, e.g. offsets_BIC_c.dat
+    :return: names of the files of all nodes, oldest first
+    """
+
+    [base, extension] = os.path.splitext(fname)
+    fnames = glob.glob('{0:s}.*{1:s}'.format(base, extension))
+    fnames = [name for name in fnames if name != fname]
+
+    return sorted(fnames, key=os.path.getmtime)
+
+
+# ---------------------------------------------------------------------------
+async def process_queue(queue, keys, process, is_done, n_workers, poll=None):
+    """
+    Process the jobs that this node manages to claim with n_workers at the
+    same time. Jobs locked by other nodes are tried again every poll seconds
+    until they are done or their lease has expired, so the jobs of a crashed
+    node are taken over.
+    :param queue: JobQueue
+    :param keys: list of all jobs (the same on every node)
+    :param process: coroutine function that processes one job, cancelled
+                    when the lease of the job is lost (see JobQueue.renew)
+    :param is_done: function that tells whether a job is finished
+    :param n_workers: number of jobs processed at the same time
+    :param poll: seconds between tries of jobs of other nodes
+    """
+
+    if poll is None:
+        poll = min(60.0, queue.lease / 10.0)
+    pending = list(keys)
+    waiting = []
+
+    async def worker():
+        while len(pending) > 0 or len(waiting) > 0:
+            if len(pending) == 0:
+                await asyncio.sleep(poll)
+                pending.extend(waiting)
+                del waiting[:]
+                continue
+            key = pending.pop(0)
+            if is_done(key):
+                continue
+            if queue.claim(key) == False:
+                waiting.append(key)
+                continue
+            try:
+                # --- Finished by another node after we listed it?
+                if is_done(key) == False:
+                    queue.tasks[key] = asyncio.ensure_future(process(key))
+                    await queue.tasks[key]
+            except asyncio.CancelledError:
+                if key not in queue.lost:
+                    raise
+                print('{0:s}: cancelled {1:s}'.format(queue.node, key))
+            finally:
+                queue.tasks.pop(key, None)
+                queue.release(key)
+
+    beat = asyncio.ensure_future(queue.heartbeat())
+    try:
+        await asyncio.gather(*[worker() for i in range(0, n_workers)])
+    finally:
+        beat.cancel()
+
+
+# ===============================================================================
+# Classes
+# ===============================================================================
+
+
+class JobQueue:
+    """ Claims stations in a queue directory that is shared by all nodes.
+    """
+
+    # ------------------------------------------------------------
+    def __init__(self, directory, lease=DEFAULT_LEASE, node=None):
+        """
+        :param directory: queue directory on the shared file system
+        :param lease: seconds after which the lock of a silent node is stale
+        :param node: name of this node, default host name + process id
+        """
+
+        if not os.path.exists(directory):
+            os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.lease = lease
+        self.node = node_name() if node is None else node
+        self.held = {}
+        self.lost = set()
+        self.tasks = {}
+
+    # -----------------------
+    def lock_name(self, key):
+        return os.path.join(self.directory, key + '.lock')
+
+    # --------------------
+    def server_time(self):
+        """
+        :return: current time according to the file server
+        """
+
+        fname = os.path.join(self.directory, '.clock.' + self.node)
+        with open(fname, 'w'):
+            pass
+        now = os.stat(fname).st_mtime
+        os.remove(fname)
+
+        return now
+
+    # -------------------------
+    def read_lock(self, fname):
+        """
+        :param fname: name of a lock file
+        :return: [contents, seconds since it was touched], None if it does
+                 not exist
+        """
+
+        try:
+            with open(fname, 'rb') as fp:
+                contents = fp.read()
+                mtime = os.fstat(fp.fileno()).st_mtime
+        except OSError:
+            return None
+
+        return [contents, self.server_time() - mtime]
+
+    # ----------------------
+    def lock_age(self, key):
+        """
+        :param key: name of the job, normally the station name
+        :return: seconds since the lock was touched, None if not locked
+        """
+
+        try:
+            mtime = os.stat(self.lock_name(key)).st_mtime
+        except OSError:
+            return None
+
+        return self.server_time() - mtime
+
+    # -------------------
+    def claim(self, key):
+        """
+        Try to become the owner of a job. A stale lock is broken first.
+        :param key: name of the job, normally the station name
+        :return: True if this node now owns the job
+        """
+
+        for attempt in range(0, 2):
+            try:
+                fd = os.open(self.lock_name(key),
+                             os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+            except FileExistsError:
+                lock = self.read_lock(self.lock_name(key))
+                if lock is not None and lock[1] > self.lease and \
+                                    self.break_lock(key, lock[0]) == True:
+                    continue
+                return False
+            info = {'node': self.node, 'time': time.time()}
+            contents = (json.dumps(info) + '\n').encode()
+            os.write(fd, contents)
+            os.fsync(fd)
+            os.close(fd)
+            self.held[key] = contents
+            return True
+
+        return False
+
+    # ----------------------------------
+    def break_lock(self, key, contents):
+        """
+        Remove the lock of a crashed node. The lock is renamed so that only
+        one of the nodes that noticed it is stale removes it. Another node
+        may have broken it and made a fresh lock in the meantime, which we
+        then renamed instead: that lock is put back with os.link, which
+        does not replace a lock made since.
+        :param key: name of the job
+        :param contents: contents of the lock that was found stale
+        :return: True if the stale lock was removed
+        """
+
+        fname = self.lock_name(key)
+        stale = '{0:s}.stale.{1:s}'.format(fname, self.node)
+        try:
+            os.rename(fname, stale)
+        except OSError:
+            return False
+        lock = self.read_lock(stale)
+        if lock is None or lock[0] != contents or lock[1] <= self.lease:
+            try:
+                os.link(stale, fname)
+            except OSError:
+                pass
+            os.remove(stale)
+            return False
+        print('{0:s}: broke stale lease of {1:s}'.format(self.node, key))
+        os.remove(stale)
+
+        return True
+
+    # -------------------
+    def renew(self, key):
+        """
+        Touch the lock of a job that this node owns. If the lock is gone or
+        belongs to another node, the job is cancelled.
+        :param key: name of the job
+        """
+
+        if key in self.lost:
+            return
+        fname = self.lock_name(key)
+        lock = self.read_lock(fname)
+        if lock is not None and lock[0] == self.held[key]:
+            try:
+                os.utime(fname)
+                return
+            except OSError:
+                pass
+        print('{0:s}: lost the lease of {1:s}'.format(self.node, key))
+        self.lost.add(key)
+        if key in self.tasks:
+            self.tasks[key].cancel()
+
+    # ---------------------
+    def release(self, key):
+        """
+        Give up the ownership of a job (finished or failed).
+        :param key: name of the job
+        """
+
+        if key in self.held:
+            del self.held[key]
+            if key not in self.lost:
+                try:
+                    os.remove(self.lock_name(key))
+                except OSError:
+                    pass
+        self.lost.discard(key)
+
+    # ------------------------
+    async def heartbeat(self):
+        """
+        Renew the leases of all jobs of this node until cancelled.
+        """
+
+        while True:
+            await asyncio.sleep(self.lease / 3.0)
+            for key in list(self.held):
+                self.renew(key)
+
+    # --------------
+    def locks(self):
+        """
+        :return: list of [key, node, age] of all locks in the queue
+        """
+
+        now = self.server_time()
+        result = []
+        for fname in sorted(os.listdir(self.directory)):
+            if not fname.endswith('.lock'):
+                continue
+            path = os.path.join(self.directory, fname)
+            try:
+                age = now - os.stat(path).st_mtime
+                with open(path, 'r') as fp:
+                    node = json.load(fp)['node']
+            except (OSError, ValueError, KeyError):
+                continue
+            result.append([fname[:-len('.lock')], node, age])
+
+        return result
+
+    # --------------
+    def clear(self):
+        """
+        Remove all locks, to start a new batch. No node may be running.
+        """
+
+        for fname in os.listdir(self.directory):
+            if fname.endswith('.lock'):
+                try:
+                    os.remove(os.path.join(self.directory, fname))
+                except OSError:
+                    pass
+
+
+# ===============================================================================
+# Main program
+# ===============================================================================
+
+if __name__ == '__main__':
+
+    # --- Read command line arguments
+    if len(sys.argv) < 3 or sys.argv[1] not in ['status', 'clear']:
+        print('Correct usage: job_queue.py status|clear queue_directory [lease]')
+        sys.exit()
+
+    directory = sys.argv[2]
+    if not os.path.isdir(directory):
+        print('Cannot find directory {0:s}'.format(directory))
+        sys.exit(1)
+    lease = DEFAULT_LEASE
+    if len(sys.argv) > 3:
+        lease = float(sys.argv[3])
+    queue = JobQueue(directory, lease)
+
+    if sys.argv[1] == 'clear':
+        queue.clear()
+    else:
+        for key, node, age in queue.locks():
+            state = 'stale' if age > lease else 'running'
+            print('{0:20s} {1:24s} {2:8.0f}s  {3:s}'.format(key, node, age,
+                                                                        state))
@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+#
+# Wiener filter of the varying seasonal signal of a whole network in one
+# pass (apply_WF.py does one station per run).
+#
+# The noise parameters and seasonal amplitudes of each station are taken
+# from an earlier PLWN analysis, the hector_estimatetrend.json file (or
+# the hector_estimatetrend.jsonl store) of "analyse_and_plot.py PLWN",
+# and the residuals from ./mom_files. The stations are grouped by the
+# length and sampling period of their gap-filled series. The series of a
+# group are stacked and filtered with one FFT along the time axis, with
+# the gain of every station evaluated in one broadcast operation (see
+# apply_WF.wienerfilter). The design matrix of the constant seasonal
+# signal is computed once for all stations with the same epochs. As with
+# apply_WF.py, the results are written to ./fil_files, ./sea_files and
+# ./mom_files/<station>_WF.mom.
+#
+# Example: network_WF.py 0.5 0.3 0.999 --results hector_estimatetrend.json
+#
+#  This script is part of Hector 1.9
+# ===============================================================================
+
+import os
+import sys
+import time
+import argparse
+
+import apply_WF
+import profiling
+import results_store
+
+# ===============================================================================
+# Global constants
+# ===============================================================================
+
+RESULTS = 'hector_estimatetrend.json'
+BATCH = 256
+
+# ===============================================================================
+# Subroutines
+# ===============================================================================
+
+
+# -----------------------------------------------
+def load_station(station, result, directory='.'):
+    """
+    Read the residuals of a station and its noise parameters.
+    :param station: station name (including _0, _1 or _2)
+    :param result: JSON output of the PLWN analysis of the station
+    :param directory: directory with mom_files
+    :return: dictionary with the series and the parameters of the filter
+    """
+    import numpy as np
+
+    [sigma_pl, sigma_w, d, theta] = apply_WF.noise_parameters(result)
+    [header, DeltaT, t, x, x_hat, flag] = apply_WF.read_residuals(
+            os.path.join(directory, 'mom_files/{0:s}.mom'.format(station)))
+    if DeltaT == None:
+        DeltaT = 1.0
+    if len(t) == 0:
+        raise ValueError('{0:s} has no observations'.format(station))
+
+    # --- Convert sigma_pl to the unit without (Delta T)^(-kappa/4)
+    kappa = -2.0 * float(d)
+    return {'header': header, 'DeltaT': DeltaT,
+            't': np.asarray(t), 'x': np.asarray(x),
+            'x_hat': np.asarray(x_hat), 'flag': np.asarray(flag),
+            'kappa': kappa, 'theta': theta,
+            'sigma_pl': sigma_pl * pow(DeltaT / 365.25, -kappa / 4.0),
+            'sigma_w': sigma_w,
+            'info': {'sigma_pl': sigma_pl, 'sigma_w': sigma_w, 'd': d}}
+
+
+# -----------------------------------------------------------------------
+def filter_group(series, sigma_a, sigma_sa, phi, extension, batch=BATCH):
+    """
+    Filter the series of stations with the same length and sampling period
+    together, batch stations per FFT so that the stacked spectra stay
+    small.
+    :param series: list of dictionaries of load_station
+    :param sigma_a: standard deviation of white noise that drives annual AR(1)
+    :param sigma_sa: same for the semi-annual AR(1)
+    :param phi: coefficient of the AR(1) processes
+    :param extension: 'taper', 'mirror', 'zero' or 'none'
+    :param batch: maximum number of stations per FFT
+    :return: list of vectors with the varying seasonal signal (s_r)
+    """
+    import numpy as np
+
+    n = len(series[0]['t'])
+    DeltaT = series[0]['DeltaT']
+    s_r = []
+    for i in range(0, len(series), batch):
+        part = series[i:i+batch]
+        r = np.array([item['x'] - item['x_hat'] for item in part])
+        column = lambda key: np.array([[item[key]] for item in part])
+        s_r.extend(apply_WF.wienerfilter(n, r, column('kappa'),
+                    column('sigma_pl'), column('sigma_w'), sigma_a, sigma_sa,
+                    phi, DeltaT, extension))
+
+    return s_r
+
+
+# --------------------------------------------------------------------
+def filter_network(results, sigma_a, sigma_sa, phi, extension='taper',
+                    stations=None, directory='.', log=print, batch=BATCH):
+    """
+    Estimate the varying seasonal signal of all stations.
+    :param results: dictionary station -> JSON output of the PLWN analysis
+    :param sigma_a: standard deviation of white noise that drives annual AR(1)
+    :param sigma_sa: same for the semi-annual AR(1)
+    :param phi: coefficient of the AR(1) processes
+    :param extension: 'taper', 'mirror', 'zero' or 'none'
+    :param stations: stations to filter (None: all in results)
+    :param directory: directory with mom_files
+    :param log: function that shows a line of progress
+    :param batch: maximum number of stations per FFT
+    :return: [dictionary station -> info as returned by
+              apply_WF.filter_station, dictionary station -> error]
+    """
+    import numpy as np
+
+    if stations is None:
+        stations = sorted(results.keys())
+
+    # --- Read all series and group them by length and sampling period
+    t0 = time.time()
+    groups = {}
+    failed = {}
+    for station in stations:
+        try:
+            if station not in results:
+                raise ValueError('no analysis of {0:s} in the results'.\
+                                                            format(station))
+            item = load_station(station, results[station], directory)
+        except (IOError, ValueError, KeyError) as e:
+            failed[station] = str(e)
+            log('{0:s} skipped: {1:s}'.format(station, str(e)))
+            continue
+        item['station'] = station
+        key = (len(item['t']), item['DeltaT'])
+        groups.setdefault(key, []).append(item)
+    log('read {0:d} stations in {1:.1f}s'.format(sum([len(group) for group \
+                                    in groups.values()]), time.time() - t0))
+
+    done = {}
+    for key in sorted(groups.keys()):
+        series = groups.pop(key)
+        t0 = time.time()
+        s_r = filter_group(series, sigma_a, sigma_sa, phi, extension, batch)
+        log('{0:d} stations of {1:d} epochs (sampling period {2:g}): '
+            'filtered in {3:.2f}s'.format(len(series), key[0], key[1],
+                                                        time.time() - t0))
+
+        # --- Design matrices of the constant seasonal signal, per epoch grid
+        designs = {}
+        for item, s_r_station in zip(series, s_r):
+            grid = (item['t'][0], key[0], key[1])
+            if grid not in designs:
+                designs[grid] = apply_WF.seasonal_design(item['t'])
+            s_c = designs[grid].dot(np.asarray(item['theta']))
+
+            info = item['info']
+            info['files'] = apply_WF.output_files(item['station'], directory)
+            apply_WF.write_results(info['files'], item['header'],
+                    zip(zip(item['t'].tolist(), item['x'].tolist(),
+                            item['x_hat'].tolist(), item['flag'].tolist()),
+                        s_c.tolist(), s_r_station.tolist()))
+            done[item['station']] = info
+
+    return [done, failed]
+
+
+# ===============================================================================
+# Main program
+# ===============================================================================
+
+if __name__ == '__main__':
+
+    # --- Optional profiling with --profile or HECTOR_PROFILE (see profiling.py)
+    profiling.setup('network_WF')
+
+    parser = argparse.ArgumentParser(description='Wiener filter of the '
+                        'varying seasonal signal of all stations in one pass')
+    parser.add_argument('sigma_a', type=float, help='std of random variation '
+                                                    'of annual amplitude')
+    parser.add_argument('sigma_sa', type=float, help='std of random '
+                                        'variation of semi-annual amplitude')
+    parser.add_argument('phi', type=float, help='coefficient AR(1) process')
+    parser.add_argument('stations', nargs='*', help='stations to filter '
+                        '(default: all stations in the results)')
+    parser.add_argument('--results', default=RESULTS, help='JSON file or '
+                        '.jsonl store of the PLWN analysis of the stations')
+    parser.add_argument('--pad', default='taper', choices=apply_WF.EXTENSIONS,
+                        help='extension of the series before the FFT')
+    parser.add_argument('--batch', type=int, default=BATCH,
+                        help='maximum number of stations per FFT')
+    args = parser.parse_args()
+
+    try:
+        results = results_store.load_results(args.results)
+    except (IOError, ValueError) as e:
+        print(e)
+        sys.exit(1)
+
+    stations = args.stations if len(args.stations) > 0 else None
+    [done, failed] = filter_network(results, args.sigma_a, args.sigma_sa,
+                    args.phi, args.pad, stations, batch=max(1, args.batch))
+    print('{0:d} stations filtered, {1:d} failed'.format(len(done),
+                                                                len(failed)))
+    if len(failed) > 0:
+        sys.exit(1)
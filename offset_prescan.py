@@ -0,0 +1,408 @@
+#!/usr/bin/env python3
+#
+# Fast approximate scan for the next offset of a time series.
+#
+# findoffset evaluates BIC_c with the full noise model at every epoch,
+# which is the largest cost of find_offset.py. This scan computes an
+# approximate BIC curve over all epochs at once. The residuals, the step
+# and the design of the trend, the seasonal signal and the offsets found
+# so far are whitened with the fractional difference filter (1-B)^d of a
+# power-law noise, with d estimated from the low frequencies of the
+# periodogram once the most likely new step has been removed. The
+# decrease of the sum of squares for a step at each epoch, after removing
+# the part of the whitened step in the whitened design, then follows from
+# cross-correlations (computed with an FFT) and a cumulative sum. The
+# curves of the components are added. The lowest epochs, at least SPACING
+# samples apart and away from the offsets already found, form the
+# shortlist of which find_offset.py --prescan computes the exact BIC_c
+# with estimatetrend. --check compares the scan with an exact
+# least-squares scan of simulated series.
+#
+# Usage: offset_prescan.py file.mom [file.mom ...] [--candidates N]
+#        offset_prescan.py --check
+#
+#  This script is part of Hector 1.9
+# ===============================================================================
+
+import re
+import sys
+import math
+import argparse
+
+import compressed_io
+
+# ===============================================================================
+# Global constants
+# ===============================================================================
+
+N_CANDIDATES = 5
+SPACING = 10
+
+# --- Header line of an offset
+OFFSET = re.compile(r'#\s*offset\s+(\d+\.?\d*)')
+
+# ===============================================================================
+# Subroutines
+# ===============================================================================
+
+
+# ---------------------
+def read_series(fname):
+    """
+    :param fname: name of a (possibly compressed) mom-file
+    :return: [t, x, offsets] with the epochs and observations (numpy
+             arrays) and the offsets in the header (MJD)
+    """
+    import numpy as np
+
+    t = []
+    x = []
+    offsets = []
+    with compressed_io.open_file(fname, 'r') as fp:
+        for line in fp:
+            if line.startswith('#'):
+                m = OFFSET.match(line)
+                if m:
+                    offsets.append(float(m.group(1)))
+                continue
+            cols = line.split()
+            if len(cols) >= 2:
+                t.append(float(cols[0]))
+                x.append(float(cols[1]))
+
+    return [np.array(t), np.array(x), offsets]
+
+
+# -------------------------------
+def design_matrix(t, offsets):
+    """
+    :param t: epochs (MJD)
+    :param offsets: epochs of the offsets (MJD), values <= 1 are skipped
+    :return: columns of a constant, trend, annual and semi-annual signal
+             and a step at each offset
+    """
+    import numpy as np
+
+    phase = 2 * math.pi * (t - 51544.0) / 365.25
+    columns = [np.ones(len(t)), (t - t[0]) / 365.25, np.cos(phase),
+               np.sin(phase), np.cos(2 * phase), np.sin(2 * phase)]
+    for mjd in offsets:
+        if mjd > 1.0:
+            columns.append((t >= mjd).astype(float))
+
+    return np.column_stack(columns)
+
+
+# ---------------------------
+def residuals(t, x, offsets):
+    """
+    :param t: epochs (MJD)
+    :param x: observations
+    :param offsets: epochs of the offsets (MJD), values <= 1 are skipped
+    :return: observations minus the least-squares fit of a trend, annual
+             and semi-annual signal and the offsets
+    """
+    import numpy as np
+
+    H = design_matrix(t, offsets)
+    theta = np.linalg.lstsq(H, x, rcond=None)[0]
+
+    return x - H.dot(theta)
+
+
+# ----------------
+def estimate_d(r):
+    """
+    Fractional difference parameter d of the power-law noise from the
+    slope of the periodogram at the lowest frequencies (log-periodogram
+    regression).
+    :param r: residuals
+    :return: d between 0 (white noise) and 0.99
+    """
+    import numpy as np
+
+    n = len(r)
+    m = max(4, int(math.sqrt(n)))
+    if n < 16:
+        return 0.0
+    I = np.square(np.abs(np.fft.rfft(r)))[1:m+1]
+    omega = 2 * math.pi * np.arange(1, m+1) / n
+    u = np.log(np.square(2.0 * np.sin(0.5 * omega)))
+    u -= u.mean()
+    y = np.log(np.maximum(I, 1.0e-30))
+    d = -np.dot(u, y - y.mean()) / np.dot(u, u)
+
+    return min(max(d, 0.0), 0.99)
+
+
+# --------------------------
+def difference_filter(d, n):
+    """
+    :param d: fractional difference parameter
+    :param n: number of coefficients
+    :return: coefficients of (1-B)^d
+    """
+    import numpy as np
+
+    pi_ = np.ones(n)
+    for j in range(1, n):
+        pi_[j] = pi_[j-1] * (j - 1 - d) / j
+
+    return pi_
+
+
+# -------------------
+def step_bic(H, x, d):
+    """
+    BIC for a step at each epoch, with generalised least squares for the
+    power-law noise (1-B)^-d and the columns of H.
+    :param H: design matrix (see design_matrix)
+    :param x: observations
+    :param d: fractional difference parameter
+    :return: bic[k] for a step at epoch k (bic[0] is for no new step)
+    """
+    import numpy as np
+
+    n = len(x)
+    theta = np.linalg.lstsq(H, x, rcond=None)[0]
+    r = x - H.dot(theta)
+
+    # --- Whitened residuals w, design WH and step c (step at epoch 0)
+    pi_ = difference_filter(d, n)
+    L = 1
+    while L < 2 * n:
+        L *= 2
+    F = np.fft.rfft(pi_, L)
+    w = np.fft.irfft(np.fft.rfft(r, L) * F, L)[:n]
+    WH = np.fft.irfft(np.fft.rfft(H, L, axis=0) * F[:, None], L, axis=0)[:n]
+    c = np.cumsum(pi_)
+
+    # --- Orthonormal basis Q of the whitened design. The residuals and the
+    #    steps are compared after removing their part in it, else the scan
+    #    favours the end of the series
+    [U, sv] = np.linalg.svd(WH, full_matrices=False)[0:2]
+    Q = U[:, sv > 1.0e-10 * sv[0]]
+    w = w - Q.dot(Q.T.dot(w))
+
+    # --- For a step at k the whitened regressor is c shifted by k:
+    #    numerator sum_t w[t] c[t-k], denominator sum_j<n-k c[j]^2 minus
+    #    the squared projections sum_t Q[t] c[t-k] on the design
+    C = np.conj(np.fft.rfft(c, L))
+    numerator = np.fft.irfft(np.fft.rfft(w, L) * C, L)[:n]
+    projections = np.fft.irfft(np.fft.rfft(Q, L, axis=0) * C[:, None], L,
+                                                                axis=0)[:n]
+    energy = np.cumsum(np.square(c))[::-1]
+    denominator = energy - np.sum(np.square(projections), axis=1)
+    rss_0 = np.dot(w, w)
+    rss = np.full(n, rss_0)
+    valid = denominator > 1.0e-9 * energy
+    rss[valid] = rss_0 - np.square(numerator[valid]) / denominator[valid]
+    rss[0] = rss_0
+    rss = np.maximum(rss, 1.0e-12 * rss_0)
+
+    return n * np.log(rss / n)
+
+
+# ---------------------------------
+def approximate_bic(t, x, offsets):
+    """
+    Approximate BIC for an offset at each epoch of the series.
+    :param t: epochs (MJD)
+    :param x: observations
+    :param offsets: offsets found so far (MJD)
+    :return: [bic, d] with bic[k] for a step at t[k] (bic[0] is for no
+             new offset) and the estimated d
+    """
+    import numpy as np
+
+    n = len(t)
+    H = design_matrix(t, offsets)
+
+    # --- A step left in the residuals looks like power-law noise with d
+    #    near 1, so d is estimated after removing the best step of a scan
+    #    that assumes white noise
+    k = int(np.argmin(step_bic(H, x, 0.0)[1:])) + 1
+    H_k = np.column_stack([H, (np.arange(n) >= k).astype(float)])
+    d = estimate_d(x - H_k.dot(np.linalg.lstsq(H_k, x, rcond=None)[0]))
+
+    return [step_bic(H, x, d), d]
+
+
+# ------------------------------------------------------------------------
+def shortlist(t, bic, offsets, n_candidates=N_CANDIDATES, spacing=SPACING,
+                                                                allowed=None):
+    """
+    :param t: epochs (MJD)
+    :param bic: approximate BIC of an offset at each epoch
+    :param offsets: offsets found so far (MJD), not proposed again
+    :param n_candidates: length of the shortlist
+    :param spacing: minimum distance between candidates [samples]
+    :param allowed: optional boolean array of epochs that may be proposed
+    :return: list of [mjd, approximate BIC], lowest first
+    """
+    import numpy as np
+
+    taken = np.zeros(len(t), dtype=bool)
+    taken[0] = True
+    if allowed is not None:
+        taken |= ~allowed
+    for mjd in offsets:
+        if mjd > 1.0:
+            k = int(np.searchsorted(t, mjd))
+            taken[max(0, k-spacing):k+spacing+1] = True
+
+    candidates = []
+    for k in np.argsort(bic, kind='stable'):
+        if len(candidates) >= n_candidates:
+            break
+        if taken[k] == True:
+            continue
+        candidates.append([float(t[k]), float(bic[k])])
+        taken[max(0, k-spacing):k+spacing+1] = True
+
+    return candidates
+
+
+# ----------------------------------------------------------------------
+def prescan(fnames, offsets, n_candidates=N_CANDIDATES, spacing=SPACING,
+                                                events=None, tolerance=3.0):
+    """
+    Shortlist of the epochs of the next offset of 1 or 3 components.
+    :param fnames: mom-files of the components (same epochs)
+    :param offsets: offsets found so far (MJD)
+    :param n_candidates: length of the shortlist
+    :param spacing: minimum distance between candidates [samples]
+    :param events: optional sorted list of event epochs (see
+                   event_catalog.py); the best epoch within tolerance of
+                   each event is added to the shortlist
+    :param tolerance: maximum distance to an event [days]
+    :return: [candidates, event candidates, d of each component], the
+             candidates as lists of [mjd, approximate BIC]
+    """
+    import numpy as np
+
+    t = None
+    total = None
+    ds = []
+    for fname in fnames:
+        [t_comp, x] = read_series(fname)[0:2]
+        if t is not None and (len(t_comp) != len(t) or \
+                                np.max(np.abs(t_comp - t)) > 1.0e-6):
+            raise ValueError('{0:s} does not have the epochs of {1:s}'.\
+                                                    format(fname, fnames[0]))
+        t = t_comp
+        if len(t) < 2 * spacing + 2:
+            raise ValueError('{0:s} is too short to scan'.format(fname))
+        [bic, d] = approximate_bic(t, x, offsets)
+        total = bic if total is None else total + bic
+        ds.append(d)
+
+    candidates = shortlist(t, total, offsets, n_candidates, spacing)
+
+    event_candidates = []
+    if events is not None:
+        for mjd in events:
+            near = np.abs(t - mjd) <= tolerance
+            event_candidates.extend(shortlist(t, total, offsets, 1, spacing,
+                                                                        near))
+
+    return [candidates, event_candidates, ds]
+
+
+# ---------------------------
+def exact_bic(t, x, offsets):
+    """
+    BIC of a step at each epoch from a separate least-squares fit per
+    epoch, assuming white noise. Slow, only used by check.
+    :param t: epochs (MJD)
+    :param x: observations
+    :param offsets: offsets found so far (MJD)
+    :return: bic[k] for a step at t[k] (bic[0] is for no new offset)
+    """
+    import numpy as np
+
+    n = len(t)
+    H = design_matrix(t, offsets)
+    rss = np.zeros(n)
+    for k in range(0, n):
+        H_k = H if k == 0 else np.column_stack([H, (t >= t[k]).astype(float)])
+        r = x - H_k.dot(np.linalg.lstsq(H_k, x, rcond=None)[0])
+        rss[k] = np.dot(r, r)
+
+    return n * np.log(rss / n)
+
+
+# -------------------------------------------------------
+def check(seeds=(1, 2), n=4000, mjd=51234.0, size=3.0):
+    """
+    Regression check of the scan: daily white noise with a step. With d
+    fixed to 0 the curve must equal the exact least-squares scan, and the
+    shortlist must contain the epoch of the step found by the exact scan.
+    :param seeds: seeds of the random series
+    :param n: number of daily observations, starting at MJD 50000
+    :param mjd: epoch of the step
+    :param size: size of the step in units of the noise
+    :return: list of the failures, empty if all is well
+    """
+    import numpy as np
+
+    t = 50000.0 + np.arange(n)
+    failures = []
+    for seed in seeds:
+        x = np.random.default_rng(seed).standard_normal(n) + \
+                                                    size * (t >= mjd)
+        exact = exact_bic(t, x, [])
+        mjd_exact = t[np.argmin(exact[1:]) + 1]
+        error = np.max(np.abs(step_bic(design_matrix(t, []), x, 0.0) - exact))
+        if error > 1.0e-6 * n:
+            failures.append('seed {0:d}: BIC differs by {1:g} from the '
+                            'exact scan'.format(seed, error))
+        [bic, d] = approximate_bic(t, x, [])
+        candidates = [c[0] for c in shortlist(t, bic, [])]
+        if min([abs(c - mjd_exact) for c in candidates]) > 4.0:
+            failures.append('seed {0:d}: step at {1:.1f} (exact scan) not '
+                            'in shortlist {2:s} (d={3:.3f})'.format(seed,
+                            mjd_exact, str(candidates), d))
+
+    return failures
+
+
+# ===============================================================================
+# Main program
+# ===============================================================================
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Approximate scan for the '
+                                     'next offset of 1 or 3 components')
+    parser.add_argument('fnames', nargs='*', help='mom-files (same epochs)')
+    parser.add_argument('--candidates', type=int, default=N_CANDIDATES,
+                        help='length of the shortlist')
+    parser.add_argument('--spacing', type=int, default=SPACING,
+                        help='minimum distance between candidates [samples]')
+    parser.add_argument('--check', action='store_true',
+                        help='compare the scan with an exact least-squares '
+                             'scan of simulated series')
+    args = parser.parse_args()
+
+    # --- Regression check of the scan itself
+    if args.check == True:
+        failures = check()
+        for failure in failures:
+            print(failure)
+        print('check {0:s}'.format('failed' if failures else 'passed'))
+        sys.exit(1 if failures else 0)
+    if len(args.fnames) == 0:
+        parser.error('no mom-files given')
+
+    try:
+        offsets = read_series(args.fnames[0])[2]
+        [candidates, event_candidates, ds] = prescan(args.fnames, offsets,
+                                            args.candidates, args.spacing)
+    except (IOError, ValueError) as e:
+        print(e)
+        sys.exit(1)
+
+    print('# d = {0:s}'.format(' '.join(['{0:.3f}'.format(d) for d in ds])))
+    for [mjd, bic] in candidates:
+        print('{0:10.1f} {1:12.3f}'.format(mjd, bic))
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+#
+# Merge the profiles written with --profile (see profiling.py) over all
+# stations and show where the time and the memory go.
+#
+# The cProfile statistics of the selected runs are added together and the
+# functions with the largest (cumulative or own) time are shown. For the
+# memory, the peak of each run is listed together with the allocation
+# sites that were largest, summed over the runs.
+#
+# Example: profile_report.py --script find_offset --sort tottime
+#
+#  This script is part of Hector 1.9
+# ===============================================================================
+
+import os
+import sys
+import glob
+import json
+import pstats
+import argparse
+
+import profiling
+
+# ===============================================================================
+# Subroutines
+# ===============================================================================
+
+
+# -----------------------------------------------------
+def find_profiles(directory, extension, script, label):
+    """
+    :param directory: profiles directory
+    :param extension: .prof or .mem.json
+    :param script: only runs of this script (None: all)
+    :param label: only runs with this label, e.g. station (None: all)
+    :return: sorted list of file names
+    """
+
+    fnames = []
+    for fname in sorted(glob.glob(os.path.join(directory, '*' + extension))):
+        parts = os.path.basename(fname)[:-len(extension)].split('.')
+        if len(parts) < 3:
+            continue
+        if script is not None and parts[0] != script:
+            continue
+        if label is not None and '.'.join(parts[1:-1]) != label:
+            continue
+        fnames.append(fname)
+
+    return fnames
+
+
+# -----------------------------------------------
+def cpu_report(fnames, sort, n_top, output=None):
+    """
+    Add the cProfile statistics together and print the top functions.
+    :param fnames: .prof files
+    :param sort: pstats sort key, e.g. cumulative or tottime
+    :param n_top: number of functions shown
+    :param output: optional file for the merged statistics
+    """
+
+    stats = pstats.Stats(fnames[0])
+    for fname in fnames[1:]:
+        stats.add(fname)
+    print('#### CPU: {0:d} runs'.format(len(fnames)))
+    stats.strip_dirs().sort_stats(sort).print_stats(n_top)
+    if output is not None:
+        stats.dump_stats(output)
+        print('merged statistics written to {0:s}'.format(output))
+
+
+# -------------------------------
+def memory_report(fnames, n_top):
+    """
+    Print the peak memory of each run and the largest allocation sites.
+    :param fnames: .mem.json files
+    :param n_top: number of runs and allocation sites shown
+    """
+
+    runs = []
+    sites = {}
+    for fname in fnames:
+        with open(fname, 'r') as fp:
+            info = json.load(fp)
+        runs.append(info)
+        for item in info['top']:
+            key = '{0:s}:{1:d}'.format(os.path.basename(item['file']),
+                                                                item['line'])
+            [size, count, peak] = sites.get(key, [0, 0, 0])
+            sites[key] = [size + item['size'], count + 1,
+                                                    max(peak, item['size'])]
+
+    print('#### Memory: {0:d} runs'.format(len(runs)))
+    print('{0:>10s} {1:>9s}  script     label'.format('peak (MB)', 'wall (s)'))
+    runs.sort(key=lambda info: -info['peak_bytes'])
+    for info in runs[:n_top]:
+        print('{0:10.1f} {1:9.2f}  {2:10s} {3:s}'.format(
+                    info['peak_bytes']/1.0e6, info['wall_seconds'],
+                    info['script'], info['label']))
+
+    print('\n{0:>10s} {1:>10s} {2:>5s}  allocation site'.format('sum (MB)',
+                                                        'max (MB)', 'runs'))
+    keys = sorted(sites.keys(), key=lambda key: -sites[key][0])
+    for key in keys[:n_top]:
+        [size, count, peak] = sites[key]
+        print('{0:10.1f} {1:10.1f} {2:5d}  {3:s}'.format(size/1.0e6,
+                                                    peak/1.0e6, count, key))
+
+
+# ===============================================================================
+# Main program
+# ===============================================================================
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Merge the profiles of '
+                                     'many runs (see profiling.py)')
+    parser.add_argument('directory', nargs='?', default=os.environ.get(
+                'HECTOR_PROFILE_DIR', profiling.PROFILE_DIR))
+    parser.add_argument('--script', help='only this script, e.g. find_offset')
+    parser.add_argument('--label', help='only this label, e.g. a station')
+    parser.add_argument('--sort', default='cumulative',
+                choices=['cumulative', 'tottime', 'calls'],
+                help='order of the functions')
+    parser.add_argument('--top', type=int, default=25,
+                help='number of functions, runs and allocation sites shown')
+    parser.add_argument('--output', help='write the merged cProfile '
+                'statistics to this file (for snakeviz, gprof2dot, ...)')
+    args = parser.parse_args()
+
+    prof_files = find_profiles(args.directory, '.prof', args.script,
+                                                                args.label)
+    mem_files = find_profiles(args.directory, '.mem.json', args.script,
+                                                                args.label)
+    if len(prof_files) == 0 and len(mem_files) == 0:
+        print('No profiles found in {0:s}'.format(args.directory))
+        sys.exit(1)
+
+    if len(prof_files) > 0:
+        cpu_report(prof_files, args.sort, args.top, args.output)
+    if len(mem_files) > 0:
+        memory_report(mem_files, args.top)
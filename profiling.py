@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+#
+# Optional cProfile and tracemalloc profiling of the scripts.
+#
+# Every script that processes data calls setup() at the start of its main
+# program. With --profile on the command line, or with the environment
+# variable HECTOR_PROFILE set, the script is run under cProfile and
+# tracemalloc and at exit it writes to the profiles directory:
+#
+#   <script>.<label>.<pid>.prof      cProfile statistics (see pstats)
+#   <script>.<label>.<pid>.mem.json  peak memory and largest allocations
+#
+# The label is normally the station name (see set_label). --profile also
+# sets HECTOR_PROFILE, so the scripts started by a batch driver, e.g.
+# analyse_and_plot.py by run_pipeline.py, are profiled as well. Stages
+# that a driver runs in threads are profiled per station with call().
+# HECTOR_PROFILE=cpu or HECTOR_PROFILE=mem selects only one of the two,
+# since tracemalloc slows a script down considerably. The directory is
+# ./profiles, or HECTOR_PROFILE_DIR. The statistics of many stations are
+# merged with profile_report.py.
+#
+#  This script is part of Hector 1.9
+# ===============================================================================
+
+import os
+import sys
+import json
+import time
+import atexit
+import cProfile
+import tracemalloc
+
+# ===============================================================================
+# Global constants
+# ===============================================================================
+
+PROFILE_DIR = './profiles'
+MODES = ['cpu', 'mem', 'all']
+N_TOP = 25
+
+# --- Profile of this process, if any
+_session = None
+
+# ===============================================================================
+# Subroutines
+# ===============================================================================
+
+
+# ---------
+def mode():
+    """
+    :return: None (no profiling), 'cpu', 'mem' or 'all'
+    """
+
+    value = os.environ.get('HECTOR_PROFILE', '').strip().lower()
+    if value in ['', '0', 'no', 'off']:
+        return None
+    if value in MODES:
+        return value
+    return 'all'
+
+
+# ----------------
+def setup(script):
+    """
+    Start profiling the script if --profile is given (the option is removed
+    from sys.argv) or HECTOR_PROFILE is set. The results are written when
+    the script exits.
+    :param script: name of the script, e.g. find_offset
+    :return: Session or None
+    """
+
+    global _session
+
+    if '--profile' in sys.argv:
+        sys.argv[:] = [arg for arg in sys.argv if arg != '--profile']
+        if mode() is None:
+            os.environ['HECTOR_PROFILE'] = 'all'
+    if mode() is None:
+        return None
+
+    # --- Scripts started from another directory write to the same place
+    if 'HECTOR_PROFILE_DIR' not in os.environ:
+        os.environ['HECTOR_PROFILE_DIR'] = os.path.abspath(PROFILE_DIR)
+
+    # --- Already profiled, e.g. a job of station_server.py
+    if _session is not None:
+        return _session
+
+    _session = Session(script)
+    _session.start()
+    atexit.register(_session.stop)
+
+    return _session
+
+
+# -------------------
+def set_label(label):
+    """
+    :param label: name of the work of this run, normally the station name
+    """
+
+    if _session is not None:
+        _session.label = label
+
+
+# ------------------------------------------------
+def call(script, label, function, *args, **kwargs):
+    """
+    Call a function, e.g. a stage run in a thread by async_tools.ToolPool,
+    with its own cProfile session when profiling is on, so that it writes
+    the statistics <script>.<label>.<pid>.prof of that thread. Memory is
+    shared by the threads and is only measured for the whole script.
+    :param script: name of the stage, e.g. find_offset
+    :param label: name of the work, normally the station name
+    :param function: function to call
+    :return: what the function returns
+    """
+
+    if mode() not in ['cpu', 'all']:
+        return function(*args, **kwargs)
+
+    session = Session(script, label, 'cpu')
+    session.start()
+    try:
+        return function(*args, **kwargs)
+    finally:
+        session.stop()
+
+
+# ===============================================================================
+# Classes
+# ===============================================================================
+
+
+class Session:
+    """ cProfile and tracemalloc measurement of one run of a script.
+    """
+
+    # -------------------------------------------------
+    def __init__(self, script, label='all', what=None):
+        """
+        :param script: name of the script
+        :param label: name of the work of this run, normally the station
+        :param what: 'cpu', 'mem' or 'all', default mode()
+        """
+
+        self.script = script
+        self.label = label
+        self.mode = what or mode() or 'all'
+        self.directory = os.environ.get('HECTOR_PROFILE_DIR', PROFILE_DIR)
+        self.profiler = None
+        self.t0 = None
+
+    # --------------
+    def start(self):
+        self.t0 = time.time()
+        if self.mode in ['mem', 'all'] and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        if self.mode in ['cpu', 'all']:
+            self.profiler = cProfile.Profile()
+            try:
+                self.profiler.enable()
+            except ValueError:
+                # --- Since Python 3.12 only one cProfile can run, and the
+                #    one of the script then also sees the other threads
+                self.profiler = None
+
+    # -------------
+    def stop(self):
+        """
+        Stop profiling and write the results. Calling it again does nothing.
+        """
+
+        global _session
+
+        if self.t0 is None:
+            return
+        wall = time.time() - self.t0
+        self.t0 = None
+        if _session is self:
+            _session = None
+
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory, exist_ok=True)
+        label = ''.join([c if c.isalnum() or c in '-_' else '_' for c in \
+                                                                    self.label])
+        base = os.path.join(self.directory, '{0:s}.{1:s}.{2:d}'.format(
+                                            self.script, label, os.getpid()))
+
+        # --- The snapshot is taken before the statistics of cProfile are
+        #    written, so that these do not show up as allocations
+        if self.profiler is not None:
+            self.profiler.disable()
+        if self.mode in ['mem', 'all'] and tracemalloc.is_tracing():
+            snapshot = tracemalloc.take_snapshot()
+            [current, peak] = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            snapshot = snapshot.filter_traces([
+                        tracemalloc.Filter(False, tracemalloc.__file__),
+                        tracemalloc.Filter(False, cProfile.__file__)])
+            top = []
+            for stat in snapshot.statistics('lineno')[:N_TOP]:
+                frame = stat.traceback[0]
+                top.append({'file': frame.filename, 'line': frame.lineno,
+                            'size': stat.size, 'count': stat.count})
+            info = {'script': self.script, 'label': self.label,
+                    'pid': os.getpid(), 'wall_seconds': wall,
+                    'peak_bytes': peak, 'current_bytes': current,
+                    'top': top}
+            with open(base + '.mem.json', 'w') as fp:
+                json.dump(info, fp, indent=1)
+                fp.write('\n')
+
+        if self.profiler is not None:
+            self.profiler.dump_stats(base + '.prof')
+            self.profiler = None
+
+    # ------------------
+    def __enter__(self):
+        global _session
+        _session = self
+        self.start()
+        return self
+
+    # ----------------------------
+    def __exit__(self, *exc_info):
+        self.stop()
@@ -0,0 +1,317 @@
+#!/usr/bin/env python3
+#
+# Live progress and throughput metrics of the batch drivers.
+#
+# While find_all_offsets.py or analyse_and_plot.py runs, the number of
+# finished, failed and running stations, the stations not started yet, the
+# utilisation of the workers, the moving average of the seconds per station
+# and, per stage (external tool), the number of waiting, running and
+# finished runs are written every few seconds to ./metrics/<job>.prom in the
+# text format of Prometheus (for the textfile collector of node exporter)
+# and to ./metrics/<job>.json. The files are replaced atomically so a reader
+# never sees a half written file. The directory can be changed with the
+# environment variable HECTOR_METRICS_DIR. When the age of the oldest
+# running station keeps growing or the throughput drops, something is
+# stuck.
+#
+# Usage: progress_metrics.py [metrics_directory]
+#
+#  This script is part of Hector 1.9
+# ===============================================================================
+
+import os
+import sys
+import glob
+import json
+import time
+import asyncio
+
+from checkpoint import write_atomic
+
+# ===============================================================================
+# Global constants
+# ===============================================================================
+
+METRICS_DIR = './metrics'
+INTERVAL = 10.0
+WINDOW = 20
+
+# ===============================================================================
+# Subroutines
+# ===============================================================================
+
+
+# ----------------------
+def metrics_directory():
+    """
+    :return: directory of the metrics files, HECTOR_METRICS_DIR or ./metrics
+    """
+
+    return os.environ.get('HECTOR_METRICS_DIR', METRICS_DIR)
+
+
+# ------------------------
+def format_labels(labels):
+    """
+    :param labels: dictionary label -> value
+    :return: text like {job="find_all_offsets",stage="findoffset"}
+    """
+
+    items = ['{0:s}="{1:s}"'.format(key, str(labels[key]).replace('\\',
+                    '\\\\').replace('"', '\\"')) for key in sorted(labels)]
+
+    return '{' + ','.join(items) + '}'
+
+
+# ----------------------
+def format_value(value):
+    """
+    :param value: number
+    :return: text of the number with at most 6 decimals
+    """
+
+    if isinstance(value, int):
+        return str(value)
+    return repr(round(float(value), 6))
+
+
+# ===============================================================================
+# Classes
+# ===============================================================================
+
+
+class Metrics:
+    """ Progress of the stations of one batch run.
+    """
+
+    # ---------------------------------------------------------------------
+    def __init__(self, job, stations, n_workers, pool=None, node=None,
+                                                    eta=None, is_done=None):
+        """
+        :param job: name of the run, e.g. find_all_offsets
+        :param stations: names of the stations that need to be processed
+        :param n_workers: number of stations processed at the same time
+        :param pool: async_tools.ToolPool of the run, for the stages
+        :param node: name of the node in a --queue run (see job_queue.py)
+        :param eta: function that returns the expected seconds until the
+                    end of the run, or None (see cost_model.py)
+        :param is_done: function that tells whether a station was finished
+                        by any node, or None when this process does all
+        """
+
+        self.job = job
+        self.stations = stations
+        self.total = len(stations)
+        self.is_done = is_done
+        self.done = set()
+        self.n_workers = n_workers
+        self.pool = pool
+        self.node = node
+        self.eta = eta
+        self.t0 = time.time()
+        self.completed = 0
+        self.failed = 0
+        self.in_flight = {}
+        self.busy = 0.0
+        self.recent = []
+
+        directory = metrics_directory()
+        if not os.path.exists(directory):
+            os.makedirs(directory, exist_ok=True)
+        name = job if node is None else '{0:s}.{1:s}'.format(job, node)
+        self.fname = os.path.join(directory, name)
+
+    # -----------------------
+    def start(self, station):
+        self.in_flight[station] = time.time()
+
+    # --------------------------------------
+    def finish(self, station, success=True):
+        """
+        :param station: station name
+        :param success: False if the station failed
+        """
+
+        now = time.time()
+        seconds = now - self.in_flight.pop(station)
+        self.busy += seconds
+        if success == True:
+            self.completed += 1
+            self.done.add(station)
+            self.recent.append([now, seconds])
+            self.recent = self.recent[-WINDOW:]
+        else:
+            self.failed += 1
+        self.write()
+
+    # -----------------
+    def snapshot(self):
+        """
+        :return: dictionary with the current values of all metrics
+        """
+
+        now = time.time()
+        elapsed = max(now - self.t0, 1.0e-9)
+        running = [now - t for t in self.in_flight.values()]
+        busy = self.busy + sum(running)
+
+        # --- With --queue the other nodes take stations too. A station
+        #    stays done, so only the others are checked again
+        if self.is_done is None:
+            waiting = self.total - self.completed - self.failed - \
+                                                        len(self.in_flight)
+        else:
+            for station in self.stations:
+                if station not in self.done and self.is_done(station) == True:
+                    self.done.add(station)
+            waiting = len([station for station in self.stations if \
+                            station not in self.in_flight and \
+                            station not in self.done]) - self.failed
+        values = {'job': self.job,
+                  'node': self.node,
+                  'timestamp': now,
+                  'elapsed_seconds': elapsed,
+                  'stations_total': self.total,
+                  'stations_completed': self.completed,
+                  'stations_failed': self.failed,
+                  'stations_in_flight': len(self.in_flight),
+                  'queue_depth': max(0, waiting),
+                  'workers': self.n_workers,
+                  'worker_utilisation': busy / (self.n_workers * elapsed),
+                  'oldest_in_flight_seconds': max(running) if \
+                                                    len(running) > 0 else 0.0,
+                  'seconds_per_station': None,
+                  'stations_per_hour': None,
+                  'eta_seconds': None,
+                  'stages': {}}
+
+        # --- Moving average over the last WINDOW stations
+        if len(self.recent) > 0:
+            values['seconds_per_station'] = sum([s for t, s in \
+                                        self.recent]) / len(self.recent)
+            span = max(now - (self.recent[0][0] - self.recent[0][1]), 1.0)
+            values['stations_per_hour'] = 3600.0 * len(self.recent) / span
+        if self.eta is not None:
+            values['eta_seconds'] = self.eta()
+
+        # --- Stages
+        if self.pool is not None:
+            for tool in sorted(self.pool.finished.keys()):
+                [runs, seconds] = self.pool.finished[tool]
+                values['stages'][tool] = {'runs': runs,
+                        'seconds': seconds,
+                        'running': self.pool.running[tool],
+                        'waiting': self.pool.waiting[tool],
+                        'runs_per_minute': 60.0 * runs / elapsed}
+
+        return values
+
+    # --------------
+    def write(self):
+        """
+        Replace the Prometheus and JSON files with the current values.
+        """
+
+        values = self.snapshot()
+        labels = {'job': self.job}
+        if self.node is not None:
+            labels['node'] = self.node
+
+        lines = []
+        station_metrics = [
+            ['stations_total', 'gauge', 'stations of the run'],
+            ['stations_completed', 'counter', 'stations finished'],
+            ['stations_failed', 'counter', 'stations that failed'],
+            ['stations_in_flight', 'gauge', 'stations being processed'],
+            ['queue_depth', 'gauge', 'stations not started yet'],
+            ['workers', 'gauge', 'stations processed at the same time'],
+            ['worker_utilisation', 'gauge', 'fraction of time the workers '
+                                                                'were busy'],
+            ['oldest_in_flight_seconds', 'gauge', 'age of the oldest '
+                                                            'running station'],
+            ['seconds_per_station', 'gauge', 'moving average of the run '
+                                                        'time of a station'],
+            ['stations_per_hour', 'gauge', 'recent throughput'],
+            ['eta_seconds', 'gauge', 'expected seconds until the end'],
+            ['elapsed_seconds', 'gauge', 'seconds since the start'],
+            ['timestamp', 'gauge', 'time of this update (unix seconds)']]
+        for [key, kind, text] in station_metrics:
+            if values[key] is None:
+                continue
+            name = 'hector_batch_' + key
+            if key == 'stations_total':
+                name = 'hector_batch_stations'
+            elif kind == 'counter':
+                name += '_total'
+            lines.append('# HELP {0:s} {1:s}'.format(name, text))
+            lines.append('# TYPE {0:s} {1:s}'.format(name, kind))
+            lines.append('{0:s}{1:s} {2:s}'.format(name,
+                            format_labels(labels), format_value(values[key])))
+
+        stages = [['runs', 'counter', 'finished runs of each stage'],
+                  ['seconds', 'counter', 'total run time of each stage'],
+                  ['running', 'gauge', 'running instances of each stage'],
+                  ['waiting', 'gauge', 'runs waiting for their tool limit'],
+                  ['runs_per_minute', 'gauge', 'throughput of each stage']]
+        for [key, kind, text] in stages:
+            if len(values['stages']) == 0:
+                break
+            name = 'hector_batch_stage_' + key
+            if kind == 'counter':
+                name += '_total'
+            lines.append('# HELP {0:s} {1:s}'.format(name, text))
+            lines.append('# TYPE {0:s} {1:s}'.format(name, kind))
+            for tool in values['stages']:
+                stage_labels = dict(labels)
+                stage_labels['stage'] = tool
+                lines.append('{0:s}{1:s} {2:s}'.format(name,
+                    format_labels(stage_labels),
+                    format_value(values['stages'][tool][key])))
+
+        write_atomic(self.fname + '.prom', '\n'.join(lines) + '\n')
+        write_atomic(self.fname + '.json', json.dumps(values, indent=2) + '\n')
+
+    # -------------------------------------
+    async def run(self, interval=INTERVAL):
+        """
+        Write the metrics every interval seconds until cancelled, so that
+        the age of a stuck station keeps growing in the files.
+        :param interval: seconds between updates
+        """
+
+        while True:
+            self.write()
+            await asyncio.sleep(interval)
+
+
+# ===============================================================================
+# Main program
+# ===============================================================================
+
+if __name__ == '__main__':
+
+    # --- Read command line arguments
+    if len(sys.argv) > 2:
+        print('Correct usage: progress_metrics.py [metrics_directory]')
+        sys.exit()
+    directory = sys.argv[1] if len(sys.argv) == 2 else metrics_directory()
+
+    fnames = sorted(glob.glob(os.path.join(directory, '*.json')))
+    if len(fnames) == 0:
+        print('No metrics in {0:s}'.format(directory))
+        sys.exit()
+
+    # --- One line per run (and node)
+    for fname in fnames:
+        with open(fname, 'r') as fp:
+            values = json.load(fp)
+        age = time.time() - values['timestamp']
+        name = os.path.basename(fname)[:-len('.json')]
+        rate = values['stations_per_hour']
+        print('{0:s}: {1:d}/{2:d} done, {3:d} failed, {4:d} running, '
+              '{5:d} waiting, {6:.0f}% busy, {7:s}/h, updated {8:.0f}s ago'.\
+              format(name, values['stations_completed'],
+              values['stations_total'], values['stations_failed'],
+              values['stations_in_flight'], values['queue_depth'],
+              100*values['worker_utilisation'],
+              '-' if rate is None else '{0:.1f}'.format(rate), age))
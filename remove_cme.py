@@ -0,0 +1,352 @@
+#!/usr/bin/env python3
+#
+# Estimate the common mode error (CME) of a regional network and remove it
+# from the series before the velocities are estimated again.
+#
+# The residuals (observations minus the fitted model) of all stations in
+# ./mom_files, written by an earlier analysis (analyse_and_plot.py), are
+# placed on one epoch grid per component: a matrix of stations x epochs
+# with a mask of the epochs each station observed. The common mode is then
+# estimated from this matrix with
+#
+#   stack : the weighted mean over the stations at each epoch (weight
+#           1/sigma^2 of the residuals of the station)
+#   pca   : the first --components principal components of the residuals
+#           normalised by their standard deviation, computed with masked
+#           alternating least squares so that data gaps are not filled
+#
+# Epochs observed by fewer than --min-stations stations are not corrected.
+# The observations minus the common mode are written to ./cme_files with
+# the header of the station, so they can be analysed again after being
+# copied to obs_files. The common mode of each component is written to
+# ./cme_files/CME_<component>.txt.
+#
+# Example: remove_cme.py --method pca --components 2
+#
+#  This script is part of Hector 1.9
+# ===============================================================================
+
+import os
+import re
+import sys
+import time
+import argparse
+
+import compressed_io
+import profiling
+
+# ===============================================================================
+# Global constants
+# ===============================================================================
+
+OUTPUT_DIR = './cme_files'
+METHODS = ['stack', 'pca']
+MIN_STATIONS = 3
+MAX_ITERATIONS = 100
+TOLERANCE = 1.0e-6
+CHUNK = 256
+
+# ===============================================================================
+# Subroutines
+# ===============================================================================
+
+
+# ------------------
+def read_mom(fname):
+    """
+    Read a mom-file with observations and the fitted model.
+    :param fname: name of the mom-file
+    :return: [header, mjd, obs, mod, DeltaT] with numpy arrays, DeltaT is
+             None if the header does not contain the sampling period
+    """
+    import numpy as np
+
+    header = []
+    values = []
+    DeltaT = None
+    with compressed_io.open_file(fname, 'r') as fp:
+        for line in fp:
+            if line.startswith('#'):
+                header.append(line)
+                m = re.match(r'# sampling period (\d+\.?\d*)', line)
+                if m:
+                    DeltaT = float(m.group(1))
+            elif len(line.strip()) > 0:
+                cols = line.split()
+                if len(cols) < 3:
+                    raise ValueError('{0:s} has no fitted model'.format(fname))
+                values.append([float(cols[0]), float(cols[1]),
+                                                            float(cols[2])])
+
+    if len(values) == 0:
+        raise ValueError('{0:s} has no observations'.format(fname))
+    values = np.array(values)
+
+    return [header, values[:, 0], values[:, 1], values[:, 2], DeltaT]
+
+
+# -----------------------------
+def component_groups(stations):
+    """
+    :param stations: station names, e.g. ABCD_0, ABCD_1, EFGH_0
+    :return: dictionary component (0, 1, 2 or '' without one) -> stations
+    """
+
+    groups = {}
+    for station in stations:
+        m = re.match(r'^(.+)_(\d)$', station)
+        component = m.group(2) if m else ''
+        groups.setdefault(component, []).append(station)
+
+    return groups
+
+
+# ----------------------------------
+def residual_matrix(series, DeltaT):
+    """
+    Place the residuals of the stations on a common epoch grid.
+    :param series: list of [header, mjd, obs, mod, DeltaT] (see read_mom)
+    :param DeltaT: sampling period of the grid [days]
+    :return: [epochs, index, R, M] with the MJD of the grid, the column of
+             each observation per station, the residuals (stations x
+             epochs, zero where missing) and the mask (1 where observed)
+    """
+    import numpy as np
+
+    t0 = min([item[1][0] for item in series])
+    index = [np.rint((item[1] - t0) / DeltaT).astype(int) for item in series]
+    n_epochs = max([int(columns.max()) for columns in index]) + 1
+    epochs = t0 + DeltaT * np.arange(n_epochs)
+
+    R = np.zeros((len(series), n_epochs))
+    M = np.zeros((len(series), n_epochs))
+    for i, item in enumerate(series):
+        R[i, index[i]] = item[2] - item[3]
+        M[i, index[i]] = 1.0
+
+    return [epochs, index, R, M]
+
+
+# ----------------------
+def station_sigma(R, M):
+    """
+    :param R: residuals (stations x epochs, zero where missing)
+    :param M: mask (1 where observed)
+    :return: standard deviation of the residuals of each station
+    """
+    import numpy as np
+
+    n = np.maximum(M.sum(axis=1), 1.0)
+    mean = R.sum(axis=1) / n
+    var = (np.square(R).sum(axis=1) - n * np.square(mean)) / n
+
+    return np.sqrt(np.maximum(var, 1.0e-12))
+
+
+# ---------------------------------------
+def stack_cme(R, M, sigma, min_stations):
+    """
+    Weighted mean of the residuals at each epoch.
+    :param R: residuals (stations x epochs, zero where missing)
+    :param M: mask (1 where observed)
+    :param sigma: standard deviation of the residuals of each station
+    :param min_stations: minimum number of stations at an epoch
+    :return: [U, V] such that the common mode of station i is V[i].U[t]
+    """
+    import numpy as np
+
+    w = 1.0 / np.square(sigma)
+    weight = w.dot(M)
+    valid = M.sum(axis=0) >= min_stations
+    U = np.where(valid, w.dot(R) / np.maximum(weight, 1.0e-30), 0.0)
+
+    return [U.reshape(-1, 1), np.ones((R.shape[0], 1))]
+
+
+# -------------------------------------------------------------
+def pca_cme(R, M, sigma, n_components, min_stations, log=print,
+                        max_iterations=MAX_ITERATIONS, tolerance=TOLERANCE):
+    """
+    Principal components of the normalised residuals with missing data:
+    Z ~ V U' is fitted to the observed entries only, alternating between
+    the temporal components U (one small least-squares problem per epoch)
+    and the spatial responses V (one per station). All epochs, and all
+    stations, are solved at once with matrix products. To save memory R
+    is normalised in place.
+    :param R: residuals (stations x epochs, zero where missing)
+    :param M: mask (1 where observed)
+    :param sigma: standard deviation of the residuals of each station
+    :param n_components: number of principal components
+    :param min_stations: minimum number of stations at an epoch
+    :param log: function that shows a line of progress
+    :param max_iterations: maximum number of iterations
+    :param tolerance: relative change of the misfit at which to stop
+    :return: [U, V] such that the common mode of station i is V[i].U[t]
+    """
+    import numpy as np
+
+    k = n_components
+    Z = R
+    Z /= sigma.reshape(-1, 1)
+    valid = M.sum(axis=0) >= min_stations
+    ridge = 1.0e-9 * np.eye(k)
+
+    # --- Start with a uniform response for the first component
+    V = np.random.RandomState(0).normal(0.0, 0.1, (R.shape[0], k))
+    V[:, 0] = 1.0
+
+    total = np.square(Z).sum()
+    misfit_old = None
+    for iteration in range(0, max_iterations):
+
+        # --- Temporal components: sum over the stations observed at t
+        A = M.T.dot((V[:, :, None] * V[:, None, :]).reshape(-1, k*k))
+        b = Z.T.dot(V)
+        U = np.linalg.solve(A.reshape(-1, k, k) + ridge, b[:, :, None])[:, :, 0]
+        U[~valid] = 0.0
+
+        # --- Spatial responses: sum over the epochs observed by station i
+        A = M.dot((U[:, :, None] * U[:, None, :]).reshape(-1, k*k))
+        b = Z.dot(U)
+        V = np.linalg.solve(A.reshape(-1, k, k) + ridge, b[:, :, None])[:, :, 0]
+
+        # --- Misfit of the observed entries, CHUNK stations at a time
+        misfit = 0.0
+        for i in range(0, Z.shape[0], CHUNK):
+            misfit += np.square((Z[i:i+CHUNK] - V[i:i+CHUNK].dot(U.T)) * \
+                                                        M[i:i+CHUNK]).sum()
+        if misfit_old is not None and \
+                        abs(misfit_old - misfit) <= tolerance * misfit_old:
+            break
+        misfit_old = misfit
+
+    log('pca: {0:d} iterations, {1:.1f}% of the variance in the common mode'.\
+            format(iteration+1, 100.0 * (1.0 - misfit / max(total, 1.0e-30))))
+
+    return [U, V * sigma.reshape(-1, 1)]
+
+
+# ------------------------------------------------------
+def remove_cme(stations, method='stack', n_components=1,
+                min_stations=MIN_STATIONS, directory='.', output=OUTPUT_DIR,
+                log=print):
+    """
+    Estimate the common mode of the stations, per component, and write the
+    corrected series.
+    :param stations: station names (including _0, _1 or _2) in mom_files
+    :param method: 'stack' or 'pca'
+    :param n_components: number of principal components (pca)
+    :param min_stations: minimum number of stations at an epoch
+    :param directory: directory with mom_files
+    :param output: directory of the corrected series
+    :param log: function that shows a line of progress
+    :return: dictionary component -> number of stations corrected
+    """
+
+    if method not in METHODS:
+        raise ValueError('unknown method {0:s}'.format(method))
+    if not os.path.exists(output):
+        os.makedirs(output, exist_ok=True)
+
+    summary = {}
+    groups = component_groups(stations)
+    for component in sorted(groups.keys()):
+        t0 = time.time()
+
+        # --- Read the residuals; all stations need the same sampling
+        series = []
+        names = []
+        for station in groups[component]:
+            item = read_mom(os.path.join(directory,
+                                    'mom_files/{0:s}.mom'.format(station)))
+            if item[4] is None:
+                item[4] = 1.0
+            series.append(item)
+            names.append(station)
+        DeltaT = series[0][4]
+        for station, item in zip(names, series):
+            if abs(item[4] - DeltaT) > 1.0e-6:
+                raise ValueError('{0:s} has sampling period {1:g}, not {2:g}'.\
+                                            format(station, item[4], DeltaT))
+        if len(series) < min_stations:
+            log('component {0:s}: only {1:d} stations, nothing removed'.\
+                                            format(component, len(series)))
+            continue
+
+        [epochs, index, R, M] = residual_matrix(series, DeltaT)
+        sigma = station_sigma(R, M)
+        log('component {0:s}: {1:d} stations x {2:d} epochs'.format(
+                                        component, R.shape[0], R.shape[1]))
+        if method == 'stack':
+            [U, V] = stack_cme(R, M, sigma, min_stations)
+        else:
+            [U, V] = pca_cme(R, M, sigma, n_components, min_stations, log)
+        del R, M
+
+        # --- Common mode (temporal components)
+        name = 'CME_{0:s}.txt'.format(component if component != '' else 'all')
+        with open(os.path.join(output, name), 'w') as fp:
+            fp.write('# {0:s} of {1:d} stations\n'.format(method, len(names)))
+            for t in range(0, len(epochs)):
+                fp.write('{0:11.4f} {1:s}\n'.format(epochs[t], ' '.join(
+                            ['{0:9.5f}'.format(value) for value in U[t]])))
+
+        # --- Corrected observations
+        for i, station in enumerate(names):
+            [header, mjd, obs, mod, DeltaT_i] = series[i]
+            corrected = obs - U[index[i]].dot(V[i])
+            fp = compressed_io.open_output(os.path.join(output,
+                                                '{0:s}.mom'.format(station)))
+            fp.write(''.join(header))
+            for j in range(0, len(mjd)):
+                fp.write('{0:11.4f} {1:9.5f}\n'.format(mjd[j], corrected[j]))
+            fp.close()
+            series[i] = None
+
+        summary[component] = len(names)
+        log('component {0:s}: written in {1:.1f}s'.format(component,
+                                                        time.time() - t0))
+
+    return summary
+
+
+# ===============================================================================
+# Main program
+# ===============================================================================
+
+if __name__ == '__main__':
+
+    # --- Optional profiling with --profile or HECTOR_PROFILE (see profiling.py)
+    profiling.setup('remove_cme')
+
+    parser = argparse.ArgumentParser(description='Estimate and remove the '
+                        'common mode error of the stations in ./mom_files')
+    parser.add_argument('stations', nargs='*', help='stations of the network '
+                        '(default: all in ./mom_files)')
+    parser.add_argument('--method', default='stack', choices=METHODS,
+                        help='weighted stacking or principal components')
+    parser.add_argument('--components', type=int, default=1,
+                        help='number of principal components (pca)')
+    parser.add_argument('--min-stations', type=int, default=MIN_STATIONS,
+                        help='epochs with fewer stations are not corrected')
+    parser.add_argument('--output', default=OUTPUT_DIR,
+                        help='directory of the corrected series')
+    args = parser.parse_args()
+
+    stations = args.stations
+    if len(stations) == 0:
+        for fname in compressed_io.glob_files('./mom_files/*.mom'):
+            station = os.path.basename(compressed_io.logical_name(fname))[:-4]
+            if not station.endswith('_WF'):
+                stations.append(station)
+    if len(stations) == 0:
+        print('No mom-files in ./mom_files')
+        sys.exit(1)
+
+    try:
+        summary = remove_cme(stations, args.method, max(1, args.components),
+                             args.min_stations, output=args.output)
+    except (IOError, ValueError) as e:
+        print(e)
+        sys.exit(1)
+    print('{0:d} stations corrected'.format(sum(summary.values())))
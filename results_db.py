@@ -0,0 +1,562 @@
+#!/usr/bin/env python3
+#
+# Local SQLite index of the analysis results of all stations and runs.
+#
+# The combined hector_estimatetrend.json and hector_removeoutliers.json
+# files, and offsets_BIC_c.dat of find_all_offsets.py, must be read
+# completely to answer a simple question. Importing them into the
+# database, hector_results.db or HECTOR_RESULTS_DB, adds a run with one
+# row per station and program (trend, its sigma, N, gap percentage, BIC_c,
+# number of jumps and the full JSON), one row per noise parameter and one
+# per jump or offset. The tables have indexes on station, component, noise
+# model and run, so lookups over many runs take milliseconds. When
+# HECTOR_RESULTS_DB is set, analyse_and_plot.py and find_all_offsets.py
+# import their results at the end of a run. A run is tagged with the batch
+# of its checkpoint directory, and a later import of the same batch (by
+# another node with --queue, or after --resume) replaces it.
+#
+# Usage:
+#   results_db.py import [--label text] [--estimatetrend file]
+#                        [--removeoutliers file] [--offsets file]
+#   results_db.py runs
+#   results_db.py query [--run N|all] [--station ABCD] [--component 2]
+#                       [--noisemodel PLWN] [--program estimatetrend]
+#                       [--where 'trend_sigma > 1']
+#   results_db.py changed GGM d [--run N] [--since M] [--threshold 0.05]
+#
+#  This script is part of Hector 1.9
+# ===============================================================================
+
+import os
+import re
+import sys
+import json
+import time
+import sqlite3
+import argparse
+
+import results_store
+
+# ===============================================================================
+# Global constants
+# ===============================================================================
+
+DATABASE = 'hector_results.db'
+
+SCHEMA = ['''CREATE TABLE IF NOT EXISTS runs (
+                run_id          INTEGER PRIMARY KEY AUTOINCREMENT,
+                created         REAL NOT NULL,
+                label           TEXT,
+                batch           TEXT)''',
+          '''CREATE TABLE IF NOT EXISTS results (
+                run_id          INTEGER NOT NULL,
+                name            TEXT NOT NULL,
+                station         TEXT NOT NULL,
+                component       INTEGER,
+                program         TEXT NOT NULL,
+                noisemodel      TEXT,
+                N               INTEGER,
+                gap_percentage  REAL,
+                trend           REAL,
+                trend_sigma     REAL,
+                BIC_c           REAL,
+                n_jumps         INTEGER,
+                result          TEXT,
+                PRIMARY KEY (run_id, name, program))''',
+          '''CREATE TABLE IF NOT EXISTS noise (
+                run_id          INTEGER NOT NULL,
+                name            TEXT NOT NULL,
+                model           TEXT NOT NULL,
+                parameter       TEXT NOT NULL,
+                value           REAL,
+                PRIMARY KEY (run_id, name, model, parameter))''',
+          '''CREATE TABLE IF NOT EXISTS jumps (
+                run_id          INTEGER NOT NULL,
+                name            TEXT NOT NULL,
+                program         TEXT NOT NULL,
+                epoch           TEXT NOT NULL,
+                size            REAL,
+                sigma           REAL)''',
+          'CREATE INDEX IF NOT EXISTS results_station ON results (station, '
+                                                                'component)',
+          'CREATE INDEX IF NOT EXISTS results_component ON results (component)',
+          'CREATE INDEX IF NOT EXISTS results_noisemodel ON results '
+                                                                '(noisemodel)',
+          'CREATE INDEX IF NOT EXISTS noise_name ON noise (name, model, '
+                                                                'parameter)',
+          'CREATE INDEX IF NOT EXISTS jumps_name ON jumps (name, run_id)']
+
+# --- Columns shown by query (run_id is indexed by the primary key)
+COLUMNS = ['run_id', 'name', 'program', 'noisemodel', 'N', 'gap_percentage',
+           'trend', 'trend_sigma', 'BIC_c', 'n_jumps']
+
+# ===============================================================================
+# Subroutines
+# ===============================================================================
+
+
+# ------------------
+def database_name():
+    """
+    :return: name of the database, HECTOR_RESULTS_DB or hector_results.db
+    """
+
+    return os.environ.get('HECTOR_RESULTS_DB', DATABASE)
+
+
+# -------------------
+def split_name(name):
+    """
+    :param name: station name, possibly with a component, e.g. ABCD_2
+    :return: [station, component] with component None if there is none
+    """
+
+    m = re.match(r'^(.+)_(\d)$', name)
+    if m:
+        return [m.group(1), int(m.group(2))]
+    return [name, None]
+
+
+# --------------------------
+def noisemodel_name(result):
+    """
+    :param result: JSON output of estimatetrend
+    :return: the noise models of the analysis joined by +, e.g. GGM+White
+    """
+
+    models = result.get('NoiseModel')
+    if not isinstance(models, dict) or len(models) == 0:
+        return None
+    return '+'.join(models.keys())
+
+
+# --------------------------------------------------------------------------
+def import_run(label, estimatetrend=None, removeoutliers=None, offsets=None,
+                                                noisemodel=None, batch=None):
+    """
+    Import the results of a batch run when HECTOR_RESULTS_DB is set.
+    :param label: description of the run
+    :param estimatetrend: combined JSON file of estimatetrend
+    :param removeoutliers: combined JSON file of removeoutliers
+    :param offsets: offsets_BIC_c.dat of find_all_offsets.py
+    :param noisemodel: name of the noise models, e.g. PLWN
+    :param batch: name of the batch (see checkpoint.batch_id), the run
+                  replaces earlier runs of the same batch
+    :return: run_id, or None if nothing was imported
+    """
+
+    if 'HECTOR_RESULTS_DB' not in os.environ:
+        return None
+    try:
+        with ResultsDB(database_name()) as results_db:
+            [run_id, n] = results_db.import_files(label, estimatetrend,
+                                removeoutliers, offsets, noisemodel, batch)
+    except (IOError, ValueError, sqlite3.Error) as e:
+        print('Results not stored in {0:s}: {1:s}'.format(database_name(),
+                                                                    str(e)))
+        return None
+    print('run {0:d}: {1:d} results stored in {2:s}'.format(run_id, n,
+                                                            database_name()))
+
+    return run_id
+
+
+# ----------------------
+def read_offsets(fname):
+    """
+    :param fname: offsets_BIC_c.dat of find_all_offsets.py
+    :return: dictionary station -> list of [mjd, BIC_c], the first line
+             of each station has no offset (mjd 0)
+    """
+
+    offsets = {}
+    with open(fname, 'r') as fp:
+        for line in fp:
+            cols = line.split()
+            if len(cols) < 3:
+                continue
+            offsets.setdefault(cols[0], []).append([float(cols[1]),
+                                                            float(cols[2])])
+
+    return offsets
+
+
+# ===============================================================================
+# Classes
+# ===============================================================================
+
+
+class ResultsDB:
+    """ Analysis results of all stations and runs.
+    """
+
+    # ----------------------------------------
+    def __init__(self, fname, readonly=False):
+        """
+        :param fname: name of the database, e.g. ./hector_results.db
+        :param readonly: open an existing database without changing it
+        """
+
+        if readonly == True:
+            if not os.path.isfile(fname):
+                raise IOError('Cannot find {0:s}'.format(fname))
+            self.db = sqlite3.connect('file:{0:s}?mode=ro'.format(fname),
+                                                                     uri=True)
+        else:
+            self.db = sqlite3.connect(fname)
+            for statement in SCHEMA:
+                self.db.execute(statement)
+
+            # --- Databases made before runs had a batch
+            columns = [row[1] for row in \
+                                self.db.execute('PRAGMA table_info(runs)')]
+            if 'batch' not in columns:
+                self.db.execute('ALTER TABLE runs ADD COLUMN batch TEXT')
+            self.db.commit()
+        self.fname = fname
+
+    # --------------
+    def close(self):
+        self.db.close()
+
+    # ------------------
+    def __enter__(self):
+        return self
+
+    # ----------------------------
+    def __exit__(self, *exc_info):
+        self.close()
+
+    # ----------------------------------------
+    def new_run(self, label=None, batch=None):
+        """
+        :param label: description of the run, e.g. analyse_and_plot PLWN
+        :param batch: name of the batch of the run, or None
+        :return: run_id of the new run
+        """
+
+        cursor = self.db.execute('INSERT INTO runs (created, label, batch) '
+                        'VALUES (?, ?, ?)', (time.time(), label, batch))
+        return cursor.lastrowid
+
+    # ------------------------------
+    def remove_batch(self, batch):
+        """
+        Remove the runs of a batch and all their results.
+        :param batch: name of the batch
+        :return: number of runs removed
+        """
+
+        run_ids = [row[0] for row in self.db.execute('SELECT run_id FROM '
+                                        'runs WHERE batch = ?', (batch,))]
+        for run_id in run_ids:
+            for table in ['results', 'noise', 'jumps', 'runs']:
+                self.db.execute('DELETE FROM {0:s} WHERE run_id = ?'.\
+                                                    format(table), (run_id,))
+        return len(run_ids)
+
+    # -------------------------------------------------------------------
+    def add_result(self, run_id, name, program, result, noisemodel=None):
+        """
+        Add the JSON output of estimatetrend or removeoutliers of a station.
+        :param run_id: run of the result
+        :param name: station name (including _0, _1 or _2)
+        :param program: estimatetrend or removeoutliers
+        :param result: dictionary with the JSON output
+        :param noisemodel: name of the noise models, default from the result
+        """
+
+        [station, component] = split_name(name)
+        if noisemodel is None:
+            noisemodel = noisemodel_name(result)
+        epochs = result.get('jumps_epochs', [])
+        self.db.execute('INSERT OR REPLACE INTO results VALUES '
+                        '(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', (run_id,
+                        name, station, component, program, noisemodel,
+                        result.get('N'), result.get('gap_percentage'),
+                        result.get('trend'), result.get('trend_sigma'),
+                        result.get('BIC_c'), len(epochs), json.dumps(result)))
+
+        # --- Noise parameters, one row each
+        models = result.get('NoiseModel', {})
+        for model in models:
+            for parameter in models[model]:
+                value = models[model][parameter]
+                if isinstance(value, (int, float)):
+                    self.db.execute('INSERT OR REPLACE INTO noise VALUES '
+                        '(?, ?, ?, ?, ?)', (run_id, name, model, parameter,
+                                                                        value))
+
+        # --- Jumps
+        sizes = result.get('jumps_sizes', [None] * len(epochs))
+        sigmas = result.get('jumps_sigmas', [None] * len(epochs))
+        for i in range(0, len(epochs)):
+            self.db.execute('INSERT INTO jumps VALUES (?, ?, ?, ?, ?, ?)',
+                        (run_id, name, program, str(epochs[i]), sizes[i],
+                                                                sigmas[i]))
+
+    # -------------------------------------------
+    def add_offsets(self, run_id, name, offsets):
+        """
+        Add the offsets found by find_offset.py for a station.
+        :param run_id: run of the result
+        :param name: station name
+        :param offsets: list of [mjd, BIC_c], the first without an offset
+        """
+
+        [station, component] = split_name(name)
+        self.db.execute('INSERT OR REPLACE INTO results (run_id, name, '
+                        'station, component, program, BIC_c, n_jumps, '
+                        'result) VALUES (?, ?, ?, ?, ?, ?, ?, ?)', (run_id,
+                        name, station, component, 'findoffset',
+                        offsets[-1][1], len(offsets) - 1,
+                        json.dumps({'offsets': offsets})))
+        for [mjd, bic_c] in offsets[1:]:
+            self.db.execute('INSERT INTO jumps VALUES (?, ?, ?, ?, ?, ?)',
+                        (run_id, name, 'findoffset', '{0:.4f}'.format(mjd),
+                                                                bic_c, None))
+
+    # ----------------------------------------------------
+    def import_files(self, label=None, estimatetrend=None,
+                     removeoutliers=None, offsets=None, noisemodel=None,
+                     batch=None):
+        """
+        Add a run with the results of the given files, in one transaction.
+        :param label: description of the run
+        :param estimatetrend: combined JSON file or store of estimatetrend
+        :param removeoutliers: combined JSON file or store of removeoutliers
+        :param offsets: offsets_BIC_c.dat of find_all_offsets.py
+        :param noisemodel: name of the noise models, e.g. PLWN
+        :param batch: name of the batch, whose earlier runs are replaced
+        :return: [run_id, number of rows added to results]
+        """
+
+        # --- Read everything first, so a bad file adds nothing
+        todo = []
+        for [fname, program] in [[estimatetrend, 'estimatetrend'],
+                                 [removeoutliers, 'removeoutliers']]:
+            if fname is not None:
+                todo.append([program, results_store.load_results(fname)])
+        found = {} if offsets is None else read_offsets(offsets)
+
+        with self.db:
+            if batch is not None:
+                self.remove_batch(batch)
+            run_id = self.new_run(label, batch)
+            n = 0
+            for [program, results] in todo:
+                for name in results:
+                    self.add_result(run_id, name, program, results[name],
+                                    noisemodel if program == 'estimatetrend' \
+                                                                    else None)
+                    n += 1
+            for name in found:
+                self.add_offsets(run_id, name, found[name])
+                n += 1
+
+        return [run_id, n]
+
+    # -------------
+    def runs(self):
+        """
+        :return: list of [run_id, created, label, number of results]
+        """
+
+        return [list(row) for row in self.db.execute('SELECT runs.run_id, '
+                'created, label, COUNT(results.run_id) FROM runs LEFT JOIN '
+                'results ON results.run_id = runs.run_id GROUP BY '
+                'runs.run_id ORDER BY runs.run_id')]
+
+    # ------------------------------
+    def last_run(self, before=None):
+        """
+        :param before: only runs before this one
+        :return: run_id of the last run, None if there is none
+        """
+
+        if before is None:
+            row = self.db.execute('SELECT MAX(run_id) FROM runs').fetchone()
+        else:
+            row = self.db.execute('SELECT MAX(run_id) FROM runs WHERE '
+                                            'run_id < ?', (before,)).fetchone()
+        return row[0]
+
+    # --------------------------------------------------------
+    def query(self, run_id=None, station=None, component=None,
+              noisemodel=None, program=None, where=None, columns=COLUMNS):
+        """
+        :param run_id: only this run (None: all runs)
+        :param station: only this station, ABCD_2 is station ABCD and
+                        component 2, a glob pattern is allowed
+        :param component: only this component (0, 1 or 2)
+        :param noisemodel: only this noise model name
+        :param program: estimatetrend, removeoutliers or findoffset
+        :param where: extra SQL condition on the columns of results
+        :param columns: columns returned
+        :return: list of rows
+        """
+
+        conditions = []
+        values = []
+        if run_id is not None:
+            conditions.append('run_id = ?')
+            values.append(run_id)
+        if station is not None:
+            [name, number] = split_name(station)
+            if number is not None and component is None:
+                component = number
+            conditions.append('station GLOB ?')
+            values.append(name)
+        if component is not None:
+            conditions.append('component = ?')
+            values.append(int(component))
+        if noisemodel is not None:
+            conditions.append('noisemodel = ?')
+            values.append(noisemodel)
+        if program is not None:
+            conditions.append('program = ?')
+            values.append(program)
+        if where is not None:
+            conditions.append('(' + where + ')')
+
+        sql = 'SELECT {0:s} FROM results'.format(', '.join(columns))
+        if len(conditions) > 0:
+            sql += ' WHERE ' + ' AND '.join(conditions)
+        sql += ' ORDER BY run_id, name, program'
+
+        return [list(row) for row in self.db.execute(sql, values)]
+
+    # ----------------------------------------------------------------
+    def changed(self, model, parameter, run_id, since, threshold=0.0):
+        """
+        :param model: noise model, e.g. GGM
+        :param parameter: its parameter, e.g. d
+        :param run_id: the new run
+        :param since: the old run
+        :param threshold: minimum absolute change
+        :return: list of [name, old value, new value], stations that are in
+                 only one of the runs are left out
+        """
+
+        return [list(row) for row in self.db.execute('SELECT new.name, '
+                'old.value, new.value FROM noise AS new JOIN noise AS old ON '
+                'old.name = new.name AND old.model = new.model AND '
+                'old.parameter = new.parameter WHERE new.run_id = ? AND '
+                'old.run_id = ? AND new.model = ? AND new.parameter = ? AND '
+                'ABS(new.value - old.value) > ? ORDER BY new.name', (run_id,
+                since, model, parameter, threshold))]
+
+
+# ===============================================================================
+# Main program
+# ===============================================================================
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='SQLite index of the '
+                                     'analysis results of all stations')
+    parser.add_argument('--db', default=database_name(),
+                        help='database (default: HECTOR_RESULTS_DB or '
+                             '{0:s})'.format(DATABASE))
+    commands = parser.add_subparsers(dest='command')
+    p = commands.add_parser('import', help='add a run with the results of '
+                            'the given files (default: the files that exist)')
+    p.add_argument('--label', help='description of the run')
+    p.add_argument('--estimatetrend', help='default: '
+                                            'hector_estimatetrend.json')
+    p.add_argument('--removeoutliers', help='default: '
+                                            'hector_removeoutliers.json')
+    p.add_argument('--offsets', help='default: offsets_BIC_c.dat')
+    p.add_argument('--noisemodel', help='name of the noise models, e.g. PLWN')
+    p = commands.add_parser('runs', help='list the runs')
+    p = commands.add_parser('query', help='show results')
+    p.add_argument('--run', default='last', help='run_id, last or all')
+    p.add_argument('--station', help='station, e.g. ABCD, ABCD_2 or AB*')
+    p.add_argument('--component', type=int, choices=[0, 1, 2])
+    p.add_argument('--noisemodel')
+    p.add_argument('--program', choices=['estimatetrend', 'removeoutliers',
+                                                            'findoffset'])
+    p.add_argument('--where', help="SQL condition, e.g. 'trend_sigma > 1'")
+    p.add_argument('--json', action='store_true',
+                   help='show the full JSON of each result')
+    p = commands.add_parser('changed', help='stations of which a noise '
+                            'parameter changed between two runs')
+    p.add_argument('model', help='noise model, e.g. GGM')
+    p.add_argument('parameter', help='parameter, e.g. d')
+    p.add_argument('--run', type=int, help='new run (default: the last)')
+    p.add_argument('--since', type=int, help='old run (default: the one '
+                                                        'before the new run)')
+    p.add_argument('--threshold', type=float, default=0.0,
+                   help='minimum absolute change')
+    args = parser.parse_args()
+
+    if args.command == 'import':
+        files = [args.estimatetrend, args.removeoutliers, args.offsets]
+        if files == [None, None, None]:
+            files = [fname if os.path.isfile(fname) else None for fname in \
+                        ['hector_estimatetrend.json',
+                         'hector_removeoutliers.json', 'offsets_BIC_c.dat']]
+        if files == [None, None, None]:
+            print('No results to import')
+            sys.exit(1)
+        try:
+            with ResultsDB(args.db) as results_db:
+                [run_id, n] = results_db.import_files(args.label, files[0],
+                                            files[1], files[2], args.noisemodel)
+        except (IOError, ValueError) as e:
+            print(e)
+            sys.exit(1)
+        print('run {0:d}: {1:d} results stored in {2:s}'.format(run_id, n,
+                                                                    args.db))
+
+    elif args.command == 'runs':
+        with ResultsDB(args.db, readonly=True) as results_db:
+            for [run_id, created, label, n] in results_db.runs():
+                print('{0:5d}  {1:s} {2:7d}  {3:s}'.format(run_id,
+                        time.strftime('%Y-%m-%d %H:%M:%S',
+                        time.localtime(created)), n, label or ''))
+
+    elif args.command == 'query':
+        with ResultsDB(args.db, readonly=True) as results_db:
+            if args.run == 'last':
+                run_id = results_db.last_run()
+            elif args.run == 'all':
+                run_id = None
+            else:
+                run_id = int(args.run)
+            columns = COLUMNS + ['result'] if args.json == True else COLUMNS
+            try:
+                rows = results_db.query(run_id, args.station, args.component,
+                        args.noisemodel, args.program, args.where, columns)
+            except sqlite3.Error as e:
+                print(e)
+                sys.exit(1)
+        if args.json == True:
+            for row in rows:
+                print(json.dumps({'run_id': row[0], 'station': row[1],
+                        'program': row[2], 'result': json.loads(row[-1])}))
+        else:
+            print('# ' + ' '.join(COLUMNS))
+            for row in rows:
+                print(' '.join(['-' if value is None else str(value) for \
+                                                            value in row]))
+
+    elif args.command == 'changed':
+        with ResultsDB(args.db, readonly=True) as results_db:
+            run_id = args.run if args.run is not None else \
+                                                    results_db.last_run()
+            since = args.since if args.since is not None else \
+                                                results_db.last_run(run_id)
+            if run_id is None or since is None:
+                print('Need two runs to compare')
+                sys.exit(1)
+            rows = results_db.changed(args.model, args.parameter, run_id,
+                                                    since, args.threshold)
+        print('# run {0:d} -> {1:d}: {2:s} {3:s}'.format(since, run_id,
+                                                args.model, args.parameter))
+        for [name, old, new] in rows:
+            print('{0:20s} {1:12.6f} {2:12.6f} {3:+12.6f}'.format(name, old,
+                                                            new, new - old))
+
+    else:
+        parser.print_help()
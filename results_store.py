@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+#
+# Crash-safe storage of the JSON results of each station analysis.
+#
+# Every station is appended as one line ({"station": ..., "result": {...}})
+# to a line-delimited file which is flushed and fsync'd before returning.
+# A crash therefore loses at most the station that was being written and
+# the records written so far can always be read back. The combined JSON
+# file (station -> result) is produced by compacting the store.
+#
+# Usage: results_store.py compact store.jsonl [output.json]
+#        results_store.py cat store.jsonl [station]
+#        results_store.py list store.jsonl
+#
+#  This script is part of Hector 1.9
+# ===============================================================================
+
+import sys
+import os
+import json
+
+# ===============================================================================
+# Subroutines
+# ===============================================================================
+
+
+# ---------------------------------------
+def append_record(fname, station, result):
+    """
+    Append the result of one station to the store and make it durable.
+    :param fname: filename of the line-delimited store
+    :param station: station name (including _0, _1 or _2)
+    :param result: dictionary with the JSON output of the Hector program
+    """
+
+    line = json.dumps({'station': station, 'result': result}) + '\n'
+    with open(fname, 'ab') as fp:
+        # --- Terminate a line that was left truncated by a crash
+        if fp.tell() > 0:
+            with open(fname, 'rb') as fp_in:
+                fp_in.seek(-1, os.SEEK_END)
+                if fp_in.read(1) != b'\n':
+                    line = '\n' + line
+        fp.write(line.encode())
+        fp.flush()
+        os.fsync(fp.fileno())
+
+
+# ----------------------------------------------
+def append_json_file(fname, station, json_fname):
+    """
+    Append the JSON file written by a Hector program to the store.
+    :param fname: filename of the line-delimited store
+    :param station: station name (including _0, _1 or _2)
+    :param json_fname: JSON file to read, e.g. estimatetrend.json
+    """
+
+    with open(json_fname, 'r') as fp:
+        result = json.load(fp)
+    append_record(fname, station, result)
+
+
+# ----------------------
+def iter_records(fname):
+    """
+    Stream the records of the store without loading the whole file.
+    A truncated last line (crash while writing) is silently skipped.
+    :param fname: filename of the line-delimited store
+    :return: generator of (station, result) tuples
+    """
+
+    with open(fname, 'r') as fp:
+        for line in fp:
+            line = line.strip()
+            if len(line) == 0:
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            yield record['station'], record['result']
+
+
+# -------------------------------
+def compact(fname, output_fname):
+    """
+    Write the combined JSON file (station -> result) of the store. When a
+    station appears more than once, the last record wins. The output is
+    written to a temporary file first and then renamed so that readers
+    never see a half written file.
+    :param fname: filename of the line-delimited store, or a list of
+                  stores (e.g. one per node) that are read in that order
+    :param output_fname: filename of the combined JSON file
+    :return: number of stations written
+    """
+
+    fnames = [fname] if isinstance(fname, str) else fname
+    results = {}
+    for fname in fnames:
+        if not os.path.isfile(fname):
+            continue
+        for station, result in iter_records(fname):
+            results[station] = result
+
+    tmp_fname = '{0:s}.tmp{1:d}'.format(output_fname, os.getpid())
+    with open(tmp_fname, 'w') as fp:
+        json.dump(results, fp, indent=2)
+        fp.write('\n')
+        fp.flush()
+        os.fsync(fp.fileno())
+    os.replace(tmp_fname, output_fname)
+
+    return len(results)
+
+
+# ----------------------
+def load_results(fname):
+    """
+    Read the results of all stations from a combined JSON file or a store.
+    :param fname: combined JSON file (station -> result) or .jsonl store
+    :return: dictionary station -> result
+    """
+
+    if not os.path.isfile(fname):
+        raise IOError('Cannot find {0:s}'.format(fname))
+    if fname.endswith('.jsonl'):
+        results = {}
+        for station, result in iter_records(fname):
+            results[station] = result
+        return results
+
+    with open(fname, 'r') as fp:
+        return json.load(fp)
+
+
+# ---------------------------
+def stations_in_store(fname):
+    """
+    Return the set of station names that have a record in the store.
+    :param fname: filename of the line-delimited store
+    :return: set of station names
+    """
+
+    if not os.path.isfile(fname):
+        return set()
+    return set(station for station, result in iter_records(fname))
+
+
+# ===============================================================================
+# Main program
+# ===============================================================================
+
+if __name__ == '__main__':
+
+    # --- Read command line arguments
+    if len(sys.argv) < 3 or sys.argv[1] not in ['compact', 'cat', 'list']:
+        print('Correct usage: results_store.py compact store.jsonl [output.json]')
+        print('               results_store.py cat store.jsonl [station]')
+        print('               results_store.py list store.jsonl')
+        sys.exit()
+
+    command = sys.argv[1]
+    fname = sys.argv[2]
+    if not os.path.isfile(fname):
+        print('Cannot find {0:s}'.format(fname))
+        sys.exit()
+
+    if command == 'compact':
+        if len(sys.argv) == 4:
+            output_fname = sys.argv[3]
+        else:
+            output_fname = os.path.splitext(fname)[0] + '.json'
+        n = compact(fname, output_fname)
+        print('{0:d} stations written to {1:s}'.format(n, output_fname))
+    elif command == 'cat':
+        for station, result in iter_records(fname):
+            if len(sys.argv) == 4 and station != sys.argv[3]:
+                continue
+            print(json.dumps({station: result}))
+    else:
+        for station, result in iter_records(fname):
+            print(station)
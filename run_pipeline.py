@@ -0,0 +1,361 @@
+#!/usr/bin/env python3
+#
+# Run the complete processing chain for all (or some) stations and only
+# recompute what is out of date:
+#
+#   ori_files -> raw_files   (convert_neu2mom.py, convert_sol2mom.py,
+#                             convert_tenv32mom.py)
+#   raw_files -> obs_files   (find_offset.py, 3D)
+#   obs_files -> sea_files, fil_files   (apply_WF.py, optional)
+#   obs_files -> pre_files, mom_files, data_figures, psd_figures
+#                            (analyse_and_plot.py)
+#
+# Like make, a stage of a station is run when one of its outputs is missing
+# or older than one of its inputs. Changing the source file of one station
+# therefore only recomputes the outputs of that station. Stations are
+# independent and are processed in parallel, each in its own working
+# directory below ./work. The JSON results of the analysis are appended to
+# hector_estimatetrend.jsonl and hector_removeoutliers.jsonl.
+#
+# apply_WF.py runs analyse_timeseries.py with PLWN itself, which overwrites
+# mom_files. For that reason the Wiener filter is run before the final
+# analysis.
+#
+# The converters and analyse_and_plot.py are run as scripts. The offset
+# search and the Wiener filter are called in-process (see find_offset.py
+# and apply_WF.py), which saves starting a Python interpreter per station.
+#
+#  This script is part of Hector 1.9
+# ===============================================================================
+
+import sys
+import os
+import argparse
+import subprocess
+import concurrent.futures
+
+import apply_WF
+import compressed_io
+import find_offset
+import profiling
+import results_store
+import station_catalog
+import workspace
+
+# ===============================================================================
+# Global constants
+# ===============================================================================
+
+CONVERTERS = {'.neu': 'convert_neu2mom.py',
+              '.sol': 'convert_sol2mom.py',
+              '.tenv3': 'convert_tenv32mom.py'}
+
+STAGES = ['convert', 'offsets', 'filter', 'analyse']
+
+RESULT_STORES = ['hector_estimatetrend.jsonl', 'hector_removeoutliers.jsonl']
+
+# ===============================================================================
+# Subroutines
+# ===============================================================================
+
+
+# -----------------------
+def find_source(station):
+    """
+    Find the file of a station in ./ori_files.
+    :param station: station name
+    :return: filename (possibly compressed) or None
+    """
+
+    for extension in CONVERTERS.keys():
+        fname = './ori_files/{0:s}{1:s}'.format(station, extension)
+        fname = compressed_io.find_file(fname)
+        if fname is not None:
+            return fname
+    return None
+
+
+# ------------------
+def find_stations():
+    """
+    All stations that have a file in ./ori_files, ./raw_files or ./obs_files.
+    :return: sorted list of station names
+    """
+
+    stations = set()
+    for extension in CONVERTERS.keys():
+        for fname in compressed_io.glob_files('./ori_files/*{0:s}'.format(extension)):
+            fname = compressed_io.logical_name(fname)
+            stations.add(os.path.basename(fname)[:-len(extension)])
+    for dirname in ['raw_files', 'obs_files']:
+        for fname in compressed_io.glob_files('./{0:s}/*_0.mom'.format(dirname)):
+            fname = compressed_io.logical_name(fname)
+            stations.add(os.path.basename(fname)[:-len('_0.mom')])
+
+    return sorted(stations)
+
+
+# ---------------------------------------------------
+def component_files(dirname, station, suffix='.mom'):
+    """
+    Filenames of the East, North and Up component of a station.
+    :param dirname: data directory, e.g. obs_files
+    :param station: station name
+    :param suffix: end of the filename
+    :return: list with three filenames
+    """
+
+    return ['./{0:s}/{1:s}_{2:d}{3:s}'.format(dirname, station, comp, suffix) \
+                                                        for comp in range(0, 3)]
+
+
+# ---------------------------------------
+def stage_files(stage, station, options):
+    """
+    Inputs and outputs of one stage of a station.
+    :param stage: one of STAGES
+    :param station: station name
+    :param options: parsed command line arguments
+    :return: [inputs, outputs] (lists of filenames)
+    """
+
+    if stage == 'convert':
+        source = find_source(station)
+        inputs = [] if source is None else [source]
+        outputs = component_files('raw_files', station)
+    elif stage == 'offsets':
+        inputs = component_files('raw_files', station)
+        outputs = component_files('obs_files', station)
+    elif stage == 'filter':
+        inputs = component_files('obs_files', station)
+        outputs = component_files('fil_files', station) + \
+                  component_files('sea_files', station)
+    else:
+        inputs = component_files('obs_files', station)
+        outputs = component_files('pre_files', station) + \
+                  component_files('mom_files', station) + \
+                  component_files('data_figures', station, '.png') + \
+                  component_files('psd_figures', station, '.png')
+
+    return [inputs, outputs]
+
+
+# -------------------------------
+def is_outdated(inputs, outputs):
+    """
+    Make-like test: an output is missing or older than one of the inputs.
+    A compressed file counts as the file itself (see compressed_io.py).
+    :param inputs: list of filenames
+    :param outputs: list of filenames
+    :return: True if the outputs must be recomputed
+    """
+
+    inputs = [compressed_io.find_file(fname) or fname for fname in inputs]
+    outputs = [compressed_io.find_file(fname) for fname in outputs]
+    if None in outputs:
+        return True
+    if len(inputs) == 0:
+        return False
+    t_inputs = max([os.path.getmtime(fname) for fname in inputs])
+    t_outputs = min([os.path.getmtime(fname) for fname in outputs])
+
+    return t_outputs < t_inputs
+
+
+# ------------------------------------
+def run_script(args, workdir, fp_log):
+    """
+    Run one of the scripts in the working directory of a station.
+    :param args: list with script name and arguments
+    :param workdir: working directory
+    :param fp_log: file to which stdout and stderr are written
+    """
+
+    fp_log.write('>>> {0:s}\n'.format(' '.join(args)))
+    fp_log.flush()
+    status = subprocess.call(args, cwd=workdir, stdout=fp_log,
+                                                      stderr=subprocess.STDOUT)
+    if status != 0:
+        raise RuntimeError('{0:s} exited with status {1:d}'. \
+                                                      format(args[0], status))
+
+
+# ------------------------------------------------------
+def run_stage(stage, station, options, workdir, fp_log):
+    """
+    Compute the outputs of one stage of a station.
+    :param stage: one of STAGES
+    :param station: station name
+    :param options: parsed command line arguments
+    :param workdir: working directory of the station
+    :param fp_log: log file of the station
+    :return: list of [store, key, result] of the JSON results produced
+    """
+
+    records = []
+    log = lambda text: fp_log.write(text + '\n')
+
+    if stage == 'convert':
+        # --- The converters process all files in ./ori_files. Give them a
+        #    private ./ori_files that only contains this station.
+        source = find_source(station)
+        convdir = workspace.make_workdir('convert', root=workdir,
+                                                        local=['ori_files'])
+        for fname in os.listdir(os.path.join(convdir, 'ori_files')):
+            os.remove(os.path.join(convdir, 'ori_files', fname))
+        os.symlink(os.path.abspath(source), os.path.join(convdir, 'ori_files',
+                                                    os.path.basename(source)))
+        extension = os.path.splitext(compressed_io.logical_name(source))[1]
+        run_script([CONVERTERS[extension]], convdir, fp_log)
+
+    elif stage == 'offsets':
+        # --- Same rule as find_all_offsets.py: too many gaps, no search
+        entry = station_catalog.scan_file('./raw_files/{0:s}_0.mom'.format(station))
+        percentage = entry['gap_percentage']
+        if percentage is None or percentage > options.max_gap:
+            for comp in range(0, 3):
+                compressed_io.copy_to_directory('./raw_files/{0:s}_{1:d}.mom'. \
+                                        format(station, comp), './obs_files')
+        else:
+            log('>>> find_offsets {0:s} PLWN 3D {1:f}'.format(station,
+                                                            options.penalty))
+            find_offset.find_offsets(station, 'PLWN', True, options.penalty,
+                                                    False, workdir, log)
+
+    elif stage == 'filter':
+        for comp in range(0, 3):
+            name = '{0:s}_{1:d}'.format(station, comp)
+            log('>>> filter_station {0:s} {1:s}'.format(name, ' '.join(
+                        ['{0:f}'.format(value) for value in options.wf])))
+            [sigma_a, sigma_sa, phi] = options.wf
+            apply_WF.filter_station(name, sigma_a, sigma_sa, phi,
+                                            directory=workdir, log=log)
+
+    else:
+        for comp in range(0, 3):
+            run_script(['analyse_and_plot.py', options.noisemodel,
+                        '{0:s}_{1:d}'.format(station, comp)], workdir, fp_log)
+            for name in RESULT_STORES:
+                fname = os.path.join(workdir, name)
+                for key, result in results_store.iter_records(fname):
+                    records.append([name, key, result])
+
+    return records
+
+
+# ------------------------------------
+def process_station(station, options):
+    """
+    Run all stages of a station that are out of date, in order.
+    :param station: station name
+    :param options: parsed command line arguments
+    :return: [stages that were run, JSON results to store]
+    """
+
+    workdir = workspace.make_workdir(station, root=options.workdir)
+    stages_run = []
+    records = []
+    rebuild = options.force
+    with open(os.path.join(workdir, 'pipeline.log'), 'a') as fp_log:
+        for stage in options.stages:
+            [inputs, outputs] = stage_files(stage, station, options)
+            if stage == 'convert' and len(inputs) == 0:
+                continue
+            if rebuild == True or is_outdated(inputs, outputs):
+                if options.dry_run == False:
+                    records += run_stage(stage, station, options, workdir,
+                                                                       fp_log)
+                stages_run.append(stage)
+                # --- Everything downstream has to be redone as well
+                rebuild = True
+
+    return [stages_run, records]
+
+
+# ===============================================================================
+# Main program
+# ===============================================================================
+
+if __name__ == '__main__':
+
+    # --- Optional profiling with --profile or HECTOR_PROFILE (see profiling.py)
+    profiling.setup('run_pipeline')
+
+    parser = argparse.ArgumentParser(description='Run the processing ' + \
+                           'chain ori_files -> figures for outdated stations')
+    parser.add_argument('stations', nargs='*',
+                        help='stations to process (default: all)')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(),
+                        help='number of stations processed in parallel')
+    parser.add_argument('--noisemodel', default='PLWN',
+                        help='noise models for analyse_and_plot.py')
+    parser.add_argument('--penalty', type=float, default=8.0,
+                        help='BIC_c extra penalty of find_offset.py')
+    parser.add_argument('--max-gap', type=float, default=40.0,
+                        help='no offset search above this percentage of gaps')
+    parser.add_argument('--wf', type=float, nargs=3,
+                        metavar=('SIGMA_A', 'SIGMA_SA', 'PHI'),
+                        help='also run apply_WF.py with these parameters')
+    parser.add_argument('--until', choices=STAGES, default='analyse',
+                        help='last stage to run')
+    parser.add_argument('--force', action='store_true',
+                        help='rebuild everything')
+    parser.add_argument('-n', '--dry-run', action='store_true',
+                        help='only show what would be done')
+    parser.add_argument('--workdir', default='./work',
+                        help='directory for the working directories')
+    options = parser.parse_args()
+
+    # --- Stages to run
+    options.stages = STAGES[:STAGES.index(options.until) + 1]
+    if options.wf is None and 'filter' in options.stages:
+        options.stages.remove('filter')
+
+    # --- Stations
+    if len(options.stations) > 0:
+        stations = options.stations
+    else:
+        stations = find_stations()
+    if len(stations) == 0:
+        print('Did not find any station in ./ori_files, ./raw_files or ./obs_files')
+        sys.exit(1)
+
+    # --- Process stations in parallel
+    n_failed = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=options.jobs) \
+                                                                   as executor:
+        futures = {}
+        for station in stations:
+            future = executor.submit(process_station, station, options)
+            futures[future] = station
+        for future in concurrent.futures.as_completed(futures):
+            station = futures[future]
+            # --- Any error, e.g. a KeyError on a malformed JSON file, only
+            #    fails this station
+            try:
+                [stages_run, records] = future.result()
+            except Exception as e:
+                if isinstance(e, (IOError, ImportError, ValueError,
+                                                            RuntimeError)):
+                    message = str(e)
+                else:
+                    message = '{0:s}: {1:s}'.format(type(e).__name__, str(e))
+                print('{0:12s}  FAILED: {1:s}'.format(station, message))
+                n_failed += 1
+                continue
+            if len(stages_run) == 0:
+                print('{0:12s}  up to date'.format(station))
+            else:
+                print('{0:12s}  {1:s}'.format(station, ' '.join(stages_run)))
+            for [name, key, result] in records:
+                results_store.append_record(name, key, result)
+
+    # --- Produce the combined JSON files
+    for name in RESULT_STORES:
+        if os.path.isfile(name):
+            results_store.compact(name, name[:-1])
+
+    if n_failed > 0:
+        print('{0:d} station(s) failed, see ./work/<station>/pipeline.log'. \
+                                                             format(n_failed))
+        sys.exit(1)
@@ -0,0 +1,391 @@
+#!/usr/bin/env python3
+#
+# Velocities over moving windows, e.g. 3 year windows stepped by a month,
+# to monitor transients.
+#
+# The outliers of a station in ./obs_files are removed only once, for the
+# whole series. The outlier-free series is then cut in memory into the
+# windows and each window is written, with the header of the series, as
+# the only input of an estimatetrend run in its own small directory below
+# ./work/sliding/<station>. Offsets and other events of the header are only
+# kept in the windows that have observations on both sides of them. The
+# windows of all stations are fitted at the same time (-j, see
+# async_tools.py), so the cost is one estimatetrend run per window.
+#
+# For each component the trend and its uncertainty at the centre of each
+# window are written to ./vel_files/<station>.dat. The estimatetrend
+# results of all windows are appended to sliding_window.jsonl (see
+# results_store.py); with --resume, the windows found there are not fitted
+# again.
+#
+# Example: sliding_window.py ABCD --window 3 --step 30 -j 8
+#
+#  This script is part of Hector 1.9
+# ===============================================================================
+
+import os
+import re
+import sys
+import json
+import bisect
+import shutil
+import asyncio
+import argparse
+
+import analyse_timeseries
+import async_tools
+import compressed_io
+import profiling
+import results_store
+import workspace
+
+# ===============================================================================
+# Global constants
+# ===============================================================================
+
+STORE = 'sliding_window.jsonl'
+OUTPUT_DIR = './vel_files'
+
+# --- Header lines with an epoch that only belong in windows around it
+EVENT = re.compile(r'#\s*(offset|log|exp|tanh)\s+(\d+\.?\d*)')
+
+# ===============================================================================
+# Subroutines
+# ===============================================================================
+
+
+# ---------------------
+def read_series(fname):
+    """
+    Read a mom-file into memory, keeping the data lines as they are.
+    :param fname: name of the mom-file
+    :return: [header lines, list of MJD, list of data lines, DeltaT]
+    """
+
+    header = []
+    mjds = []
+    lines = []
+    DeltaT = None
+    with compressed_io.open_file(fname, 'r') as fp:
+        for line in fp:
+            if line.startswith('#'):
+                header.append(line)
+                m = re.match(r'# sampling period (\d+\.?\d*)', line)
+                if m:
+                    DeltaT = float(m.group(1))
+            elif len(line.strip()) > 0:
+                mjds.append(float(line.split()[0]))
+                lines.append(line)
+
+    return [header, mjds, lines, DeltaT]
+
+
+# ---------------------------------------------------------
+def make_windows(mjds, length, step, DeltaT, min_coverage):
+    """
+    Windows that lie completely inside the series.
+    :param mjds: sorted list of epochs (MJD)
+    :param length: length of a window [days]
+    :param step: shift between windows [days]
+    :param DeltaT: sampling period [days]
+    :param min_coverage: windows with less than this fraction of the
+                         possible observations are skipped
+    :return: list of [mjd_start, mjd_end, i0, i1] with the observations
+             i0 <= i < i1 inside the window
+    """
+
+    windows = []
+    if len(mjds) == 0:
+        return windows
+    n_min = min_coverage * length / DeltaT
+    t0 = mjds[0]
+    while t0 + length <= mjds[-1] + 0.5 * DeltaT:
+        i0 = bisect.bisect_left(mjds, t0 - 1.0e-6)
+        i1 = bisect.bisect_left(mjds, t0 + length - 1.0e-6)
+        if i1 - i0 >= max(n_min, 2):
+            windows.append([t0, t0 + length, i0, i1])
+        t0 += step
+
+    return windows
+
+
+# ---------------------------------------------
+def window_header(header, mjd_first, mjd_last):
+    """
+    :param header: header lines of the whole series
+    :param mjd_first: first observation of the window
+    :param mjd_last: last observation of the window
+    :return: header lines without the events outside the window
+    """
+
+    lines = []
+    for line in header:
+        m = EVENT.match(line)
+        if m:
+            mjd = float(m.group(2))
+            if mjd <= mjd_first or mjd > mjd_last:
+                continue
+        lines.append(line)
+
+    return lines
+
+
+# ------------------------------------------
+def window_key(station, window, noisemodel):
+    """
+    :param station: station name (including _0, _1 or _2)
+    :param window: [mjd_start, mjd_end, i0, i1]
+    :param noisemodel: noise model combination, e.g. PLWN
+    :return: key of the window in STORE
+    """
+
+    return '{0:s}:{1:s}:{2:.1f}:{3:.1f}'.format(station, noisemodel,
+                                                        window[0], window[1])
+
+
+# --------------------------------------------
+async def screen_station(station, pool, root):
+    """
+    Remove the outliers of the whole series of a station once.
+    :param station: station name (including _0, _1 or _2)
+    :param pool: async_tools.ToolPool that runs the external tools
+    :param root: directory that holds the working directories of this run
+    :return: [header lines, list of MJD, list of data lines, DeltaT]
+    """
+
+    workdir = workspace.make_workdir(station, root=root,
+                                        local=['pre_files', 'mom_files'])
+    data_directory = compressed_io.scratch_input(workdir, './obs_files',
+                                                    '{0:s}.mom'.format(station))
+    analyse_timeseries.create_removeoutliers_ctl_file(station, workdir,
+                                                            data_directory)
+    output = await pool.run(['removeoutliers'], cwd=workdir)
+    with open(os.path.join(workdir, 'removeoutliers.out'), 'w') as fp:
+        fp.write(output)
+
+    return read_series(os.path.join(workdir, 'pre_files',
+                                                '{0:s}.mom'.format(station)))
+
+
+# -----------------------------------------------------------------------
+async def fit_window(station, series, window, noisemodels, pool, workdir,
+                                                                keep=False):
+    """
+    Run estimatetrend for one window in its own directory.
+    :param station: station name (including _0, _1 or _2)
+    :param series: [header lines, list of MJD, list of data lines, DeltaT]
+    :param window: [mjd_start, mjd_end, i0, i1]
+    :param noisemodels: list of noise models
+    :param pool: async_tools.ToolPool that runs estimatetrend
+    :param workdir: directory of this window
+    :param keep: if False, the directory is removed after the fit
+    :return: contents of estimatetrend.json
+    """
+
+    [header, mjds, lines, DeltaT] = series
+    [mjd_start, mjd_end, i0, i1] = window
+    for dirname in ['pre_files', 'mom_files']:
+        if not os.path.exists(os.path.join(workdir, dirname)):
+            os.makedirs(os.path.join(workdir, dirname))
+    with open(os.path.join(workdir, 'pre_files', '{0:s}.mom'.format(station)),
+                                                                'w') as fp:
+        fp.writelines(window_header(header, mjds[i0], mjds[i1-1]))
+        fp.writelines(lines[i0:i1])
+
+    fname = os.path.join(workdir, 'estimatetrend.json')
+    if os.path.isfile(fname):
+        os.remove(fname)
+    analyse_timeseries.create_estimatetrend_ctl_file(station, noisemodels,
+                                                                    workdir)
+    output = await pool.run(['estimatetrend'], cwd=workdir)
+    with open(os.path.join(workdir, 'estimatetrend.out'), 'w') as fp:
+        fp.write(output)
+    with open(fname, 'r') as fp:
+        results = json.load(fp)
+
+    if keep == False:
+        shutil.rmtree(workdir)
+
+    return results
+
+
+# -----------------------------------------------------------------
+async def slide_station(station, options, noisemodels, pool, done):
+    """
+    Screen a station once and fit all its windows.
+    :param station: station name (including _0, _1 or _2)
+    :param options: parsed command line arguments
+    :param noisemodels: list of noise models
+    :param pool: async_tools.ToolPool that runs the external tools
+    :param done: dictionary key -> results of windows fitted before
+    :return: list of [window, results or None] in time order
+    """
+
+    root = options.workdir
+    series = await screen_station(station, pool, root)
+    DeltaT = series[3]
+    if DeltaT is None:
+        print('{0:s}: assuming daily observations'.format(station))
+        DeltaT = 1.0
+    windows = make_windows(series[1], 365.25 * options.window, options.step,
+                                                DeltaT, options.min_coverage)
+    print('{0:s}: {1:d} windows'.format(station, len(windows)))
+
+    async def fit_one(k, window):
+        key = window_key(station, window, options.noisemodel)
+        if key in done:
+            return done[key]
+        workdir = os.path.join(root, station, 'w{0:05d}'.format(k))
+        try:
+            results = await fit_window(station, series, window, noisemodels,
+                                                    pool, workdir, options.keep)
+        except (IOError, ValueError, RuntimeError) as e:
+            print('{0:s} window {1:.1f}-{2:.1f} failed: {3:s}'.format(
+                                    station, window[0], window[1], str(e)))
+            return None
+        results_store.append_record(STORE, key, results)
+        return results
+
+    fits = await asyncio.gather(*[fit_one(k, window) for k, window in \
+                                                        enumerate(windows)])
+
+    return list(zip(windows, fits))
+
+
+# -------------------------------------------
+def write_velocities(station, options, fits):
+    """
+    Write the trend of each window to OUTPUT_DIR/<station>.dat.
+    :param station: station name (including _0, _1 or _2)
+    :param options: parsed command line arguments
+    :param fits: list of [window, results or None]
+    :return: name of the file
+    """
+
+    if not os.path.exists(OUTPUT_DIR):
+        os.makedirs(OUTPUT_DIR)
+    fname = os.path.join(OUTPUT_DIR, '{0:s}.dat'.format(station))
+    with open(fname, 'w') as fp:
+        fp.write('# {0:s}: {1:s}, windows of {2:.2f} years, step {3:.1f} '
+                 'days\n'.format(station, options.noisemodel, options.window,
+                                                                options.step))
+        fp.write('# MJD_centre  MJD_start    MJD_end     N       trend'
+                 '       sigma\n')
+        for [window, results] in fits:
+            if results is None:
+                continue
+            fp.write('{0:10.1f} {1:10.1f} {2:10.1f} {3:5d} {4:11.4f} {5:11.4f}\n'.\
+                      format(0.5*(window[0] + window[1]), window[0], window[1],
+                             window[3] - window[2], results['trend'],
+                             results['trend_sigma']))
+
+    return fname
+
+
+# --------------------------------------------------------
+async def slide_all(stations, options, noisemodels, done):
+    """
+    Fit the windows of all stations. All external tools share one ToolPool,
+    so the windows of different stations run at the same time as well.
+    :param stations: list of station names
+    :param options: parsed command line arguments
+    :param noisemodels: list of noise models
+    :param done: dictionary key -> results of windows fitted before
+    :return: number of stations that failed
+    """
+
+    limits = async_tools.parse_limits(options.limits)
+    limits['estimatetrend'] = max(1, options.jobs)
+    pool = async_tools.ToolPool(limits)
+    failed = []
+
+    async def slide_one(station):
+        try:
+            fits = await slide_station(station, options, noisemodels, pool,
+                                                                        done)
+        except (IOError, ValueError, RuntimeError) as e:
+            print('{0:s} failed: {1:s}'.format(station, str(e)))
+            failed.append(station)
+            return
+        n = len([results for [window, results] in fits if results is not None])
+        fname = write_velocities(station, options, fits)
+        print('{0:s}: {1:d} of {2:d} windows fitted, see {3:s}'.format(
+                                            station, n, len(fits), fname))
+
+    await asyncio.gather(*[slide_one(station) for station in stations])
+
+    return len(failed)
+
+
+# ===============================================================================
+# Main program
+# ===============================================================================
+
+if __name__ == '__main__':
+
+    # --- Optional profiling with --profile or HECTOR_PROFILE (see profiling.py)
+    profiling.setup('sliding_window')
+
+    parser = argparse.ArgumentParser(description='Trend over moving windows '
+                                     'of the time series in ./obs_files')
+    parser.add_argument('station', nargs='*', help='station name, with _0, '
+                '_1 or _2 for one component, default all mom-files')
+    parser.add_argument('--noisemodel', default='PLWN',
+                help='noise model combination (default PLWN)')
+    parser.add_argument('--window', type=float, default=3.0,
+                help='length of a window in years (default 3)')
+    parser.add_argument('--step', type=float, default=30.0,
+                help='shift between windows in days (default 30)')
+    parser.add_argument('--min-coverage', type=float, default=0.5,
+                help='skip windows with less than this fraction of the '
+                     'possible observations (default 0.5)')
+    parser.add_argument('-j', '--jobs', type=int, default=async_tools.N_CPU,
+                help='number of windows fitted at the same time')
+    parser.add_argument('--limits', help='maximum number of running '
+                'instances of the other tools, e.g. removeoutliers=2')
+    parser.add_argument('--resume', action='store_true',
+                help='do not fit the windows found in ' + STORE + ' again')
+    parser.add_argument('--keep', action='store_true',
+                help='keep the directories of the windows')
+    parser.add_argument('--workdir', default='./work/sliding',
+                help='directory for the working directories')
+    options = parser.parse_args()
+
+    try:
+        noisemodels = analyse_timeseries.parse_noisemodels(options.noisemodel)
+    except ValueError as e:
+        print(e)
+        sys.exit(1)
+    if options.window <= 0.0 or options.step <= 0.0:
+        print('--window and --step must be positive')
+        sys.exit(1)
+
+    # --- Stations, a name without _0, _1 or _2 means all three components
+    stations = []
+    for name in options.station:
+        if compressed_io.find_file('./obs_files/{0:s}.mom'.format(name)):
+            stations.append(name)
+        elif compressed_io.find_file('./obs_files/{0:s}_0.mom'.format(name)):
+            stations += ['{0:s}_{1:d}'.format(name, comp) for comp in range(0, 3)]
+        else:
+            print('Cannot find {0:s}.mom in ./obs_files'.format(name))
+            sys.exit(1)
+    if len(options.station) == 0:
+        for fname in compressed_io.glob_files('./obs_files/*.mom'):
+            m = re.search(r'/(\w+)\.mom', compressed_io.logical_name(fname))
+            if m:
+                stations.append(m.group(1))
+    if len(stations) == 0:
+        print('Could not find any mom-file in ./obs_files')
+        sys.exit(1)
+
+    # --- Windows fitted in a previous run
+    done = {}
+    if options.resume == True and os.path.isfile(STORE):
+        for key, results in results_store.iter_records(STORE):
+            done[key] = results
+
+    n_failed = asyncio.run(slide_all(sorted(stations), options, noisemodels,
+                                                                        done))
+    if n_failed > 0:
+        sys.exit(1)
@@ -0,0 +1,294 @@
+#!/usr/bin/env python3
+#
+# Catalog of the mom-files in a directory with their metadata.
+#
+# For every file the catalog stores the sampling period, the first and last
+# epoch, the number of observations, the percentage of missing data, the
+# offsets listed in the header and a SHA1 hash of the contents. The catalog
+# is kept in <directory>/catalog.json and is updated incrementally: only
+# files whose size or modification time changed are read again. The batch
+# scripts use it to select stations without parsing every file.
+#
+# Usage:
+#   station_catalog.py update [directory ...]
+#   station_catalog.py query  directory [--max-gap P] [--min-count N]
+#                             [--min-years Y] [--offsets] [--names]
+#   station_catalog.py show   directory name
+#
+#  This script is part of Hector 1.9
+# ===============================================================================
+
+import os
+import re
+import sys
+import json
+import hashlib
+import argparse
+
+import compressed_io
+import profiling
+from checkpoint import write_atomic
+
+# ===============================================================================
+# Global constants
+# ===============================================================================
+
+CATALOG_NAME = 'catalog.json'
+CATALOG_VERSION = 1
+
+# ===============================================================================
+# Subroutines
+# ===============================================================================
+
+
+# -----------------------------------------
+def gap_percentage(dt, first, last, count):
+    """
+    Percentage of missing observations between the first and last epoch.
+    :param dt: sampling period (days)
+    :param first: first epoch (MJD)
+    :param last: last epoch (MJD)
+    :param count: number of observations
+    :return: percentage of gaps or None if there is less than one interval
+    """
+
+    if first is None:
+        return None
+    n = int((last - first) / dt + 1.0e-6)
+    if n <= 0:
+        return None
+
+    return 100 - (count - 1) / n * 100
+
+
+# -------------------
+def scan_file(fname):
+    """
+    Read a mom-file once and compute its catalog entry.
+    :param fname: name of the mom-file
+    :return: dictionary with the metadata of the file
+    """
+
+    dt = None
+    offsets = []
+    first = last = None
+    count = 0
+    sha1 = hashlib.sha1()
+    path = compressed_io.find_file(fname)
+    if path is None:
+        raise IOError('Cannot find {0:s}'.format(fname))
+    with compressed_io.open_file(path, 'rb') as fp:
+        for raw in fp:
+            sha1.update(raw)
+            line = raw.decode(errors='replace')
+            if line.startswith('#'):
+                m = re.match(r'# sampling period (\d+\.?\d*)', line)
+                if m:
+                    dt = float(m.group(1))
+                m = re.match(r'# offset\s+(\d+\.?\d*)', line)
+                if m:
+                    offsets.append(float(m.group(1)))
+            elif len(line.strip()) > 0:
+                mjd = float(line.split()[0])
+                if first is None:
+                    first = mjd
+                last = mjd
+                count += 1
+
+    st = os.stat(path)
+    entry = {'size': st.st_size,
+             'mtime': st.st_mtime,
+             'sha1': sha1.hexdigest(),
+             'sampling_period': dt,
+             'first': first,
+             'last': last,
+             'count': count,
+             'gap_percentage': gap_percentage(1.0 if dt is None else dt,
+                                                        first, last, count),
+             'offsets': offsets}
+
+    return entry
+
+
+# --------------------------
+def load_catalog(directory):
+    """
+    :param directory: directory with mom-files
+    :return: dictionary file name -> entry (empty if there is no catalog)
+    """
+
+    fname = os.path.join(directory, CATALOG_NAME)
+    try:
+        with open(fname, 'r') as fp:
+            catalog = json.load(fp)
+    except (IOError, ValueError):
+        return {}
+    if catalog.get('version') != CATALOG_VERSION:
+        return {}
+
+    return catalog['files']
+
+
+# ---------------------------------
+def save_catalog(directory, files):
+    """
+    :param directory: directory with mom-files
+    :param files: dictionary file name -> entry
+    """
+
+    text = json.dumps({'version': CATALOG_VERSION, 'files': files},
+                                                    indent=1, sort_keys=True)
+    write_atomic(os.path.join(directory, CATALOG_NAME), text + '\n')
+
+
+# ------------------------------------------------------------
+def update_catalog(directory, pattern='*.mom', verbose=False):
+    """
+    Bring the catalog of a directory up to date. Files whose size and
+    modification time did not change are not read again. Compressed files
+    are listed under their plain name (see compressed_io.py).
+    :param directory: directory with mom-files
+    :param pattern: glob pattern of the files in the catalog
+    :param verbose: show the files that are (re)scanned
+    :return: dictionary file name -> entry
+    """
+
+    old = load_catalog(directory)
+    files = {}
+    changed = False
+    for fname in compressed_io.glob_files(os.path.join(directory, pattern)):
+        name = compressed_io.logical_name(os.path.basename(fname))
+        st = os.stat(fname)
+        entry = old.get(name)
+        if entry is None or entry['size'] != st.st_size or \
+                                            entry['mtime'] != st.st_mtime:
+            if verbose == True:
+                print('scanning {0:s}'.format(fname))
+            entry = scan_file(fname)
+            changed = True
+        files[name] = entry
+
+    if changed == True or len(files) != len(old):
+        save_catalog(directory, files)
+
+    return files
+
+
+# -----------------------------------
+def lookup(catalog, directory, name):
+    """
+    Entry of one file, scanned again if the catalog is out of date. The
+    catalog file itself is not rewritten.
+    :param catalog: dictionary file name -> entry (see update_catalog)
+    :param directory: directory with mom-files
+    :param name: file name, e.g. ABCD_0.mom
+    :return: entry of the file
+    """
+
+    fname = os.path.join(directory, name)
+    entry = catalog.get(name)
+    path = compressed_io.find_file(fname)
+    if entry is not None and path is not None:
+        st = os.stat(path)
+        if entry['size'] == st.st_size and entry['mtime'] == st.st_mtime:
+            return entry
+    entry = scan_file(fname)
+    catalog[name] = entry
+
+    return entry
+
+
+# -------------------------------------------------------------
+def select(files, max_gap=None, min_count=None, min_years=None,
+                                                            offsets=False):
+    """
+    :param files: dictionary file name -> entry
+    :param max_gap: maximum percentage of missing data
+    :param min_count: minimum number of observations
+    :param min_years: minimum time span in years
+    :param offsets: only files with offsets in the header
+    :return: sorted list of file names that pass all criteria
+    """
+
+    names = []
+    for name in sorted(files.keys()):
+        entry = files[name]
+        if max_gap is not None and (entry['gap_percentage'] is None or \
+                                        entry['gap_percentage'] > max_gap):
+            continue
+        if min_count is not None and entry['count'] < min_count:
+            continue
+        if min_years is not None and (entry['first'] is None or \
+                    (entry['last'] - entry['first'])/365.25 < min_years):
+            continue
+        if offsets == True and len(entry['offsets']) == 0:
+            continue
+        names.append(name)
+
+    return names
+
+
+# ===============================================================================
+# Main program
+# ===============================================================================
+
+if __name__ == '__main__':
+
+    # --- Optional profiling with --profile or HECTOR_PROFILE (see profiling.py)
+    profiling.setup('station_catalog')
+
+    parser = argparse.ArgumentParser(description='Catalog of mom-files')
+    commands = parser.add_subparsers(dest='command')
+    p = commands.add_parser('update', help='scan new or changed files')
+    p.add_argument('directories', nargs='*', default=['./raw_files'])
+    p = commands.add_parser('query', help='list files in the catalog')
+    p.add_argument('directory')
+    p.add_argument('--max-gap', type=float, help='maximum gap percentage')
+    p.add_argument('--min-count', type=int, help='minimum number of epochs')
+    p.add_argument('--min-years', type=float, help='minimum time span')
+    p.add_argument('--offsets', action='store_true',
+                                    help='only files with offsets in header')
+    p.add_argument('--names', action='store_true',
+                                    help='only show the file names')
+    p = commands.add_parser('show', help='show the entry of one file')
+    p.add_argument('directory')
+    p.add_argument('name')
+    args = parser.parse_args()
+
+    if args.command == 'update':
+        for directory in args.directories:
+            if not os.path.isdir(directory):
+                print('{0:s} is not a directory'.format(directory))
+                sys.exit(1)
+            files = update_catalog(directory, verbose=True)
+            print('{0:s}: {1:d} files'.format(directory, len(files)))
+
+    elif args.command == 'query':
+        files = update_catalog(args.directory)
+        names = select(files, args.max_gap, args.min_count, args.min_years,
+                                                                args.offsets)
+        for name in names:
+            entry = files[name]
+            if args.names == True:
+                print(name)
+                continue
+            if entry['first'] is None:
+                print('{0:20s}  empty'.format(name))
+                continue
+            gap = entry['gap_percentage']
+            print('{0:20s} {1:5.2f} {2:10.3f} {3:10.3f} {4:7d} {5:>7s} {6:3d}'.\
+                    format(name, entry['sampling_period'] or 1.0,
+                    entry['first'], entry['last'], entry['count'],
+                    '-' if gap is None else '{0:6.2f}%'.format(gap),
+                    len(entry['offsets'])))
+
+    elif args.command == 'show':
+        files = update_catalog(args.directory)
+        name = args.name if args.name.endswith('.mom') else args.name + '.mom'
+        if name not in files:
+            print('{0:s} is not in {1:s}'.format(name, args.directory))
+            sys.exit(1)
+        print(json.dumps(files[name], indent=2, sort_keys=True))
+
+    else:
+        parser.print_help()
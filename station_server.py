@@ -0,0 +1,456 @@
+#!/usr/bin/env python3
+#
+# Long-running service that analyses stations on request.
+#
+# A pool of worker processes is started once. The workers have already
+# imported NumPy and the other modules and stay alive between jobs, so a job
+# is dispatched in milliseconds instead of starting a new Python interpreter
+# for every script. Jobs are sent over HTTP on the loopback interface, are
+# queued with a priority (higher first) and each worker runs its jobs in its
+# own working directory below ./work (see workspace.py).
+#
+# Job types:
+#   find_offsets      find_offset.find_offsets(station, noisemodel, 3D, penalty)
+#   analyse           analyse_timeseries.analyse(station, noisemodel)
+#   analyse_and_plot  analyse_and_plot.py noisemodel station
+#
+# The first two are function calls that return their results directly, the
+# last one runs the script inside the worker.
+#
+# Usage: station_server.py serve [--port 8642] [--workers N] [--profile]
+#        station_server.py submit TYPE STATION [NOISEMODEL] [--3D] [--penalty X]
+#                                 [--priority P] [--wait]
+#        station_server.py status [JOB_ID]
+#
+# HTTP interface:
+#   POST /jobs          {"type": ..., "station": ..., "noisemodel": ...,
+#                        "3D": true, "penalty": 8.0, "priority": 0}
+#   GET  /jobs          all jobs
+#   GET  /jobs/ID       one job, add ?wait=SECONDS to wait until it is done
+#   GET  /status        queue depth and busy workers
+#
+#  This script is part of Hector 1.9
+# ===============================================================================
+
+import sys
+import os
+import io
+import json
+import time
+import queue
+import runpy
+import argparse
+import threading
+import contextlib
+import multiprocessing
+import urllib.request
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import analyse_timeseries
+import find_offset
+import profiling
+import workspace
+
+# ===============================================================================
+# Global constants
+# ===============================================================================
+
+DEFAULT_PORT = 8642
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+JOB_TYPES = ['find_offsets', 'analyse', 'analyse_and_plot']
+
+# ===============================================================================
+# Worker processes
+# ===============================================================================
+
+
+# --------------------
+def init_worker(base):
+    """
+    Executed once in each worker process: import the heavy modules and
+    create the working directory of this worker.
+    :param base: directory with the shared data directories
+    """
+
+    try:
+        import numpy
+    except ImportError:
+        pass
+    name = 'worker{0:d}'.format(os.getpid())
+    workdir = workspace.make_workdir(name, root=os.path.join(base, 'work'),
+                                                                    base=base)
+    os.chdir(workdir)
+
+
+# ---------------------
+def job_arguments(job):
+    """
+    Script and command line arguments of a job.
+    :param job: dictionary with the job description
+    :return: [script name, argument list]
+    """
+
+    station = job['station']
+    noisemodel = job.get('noisemodel', 'PLWN')
+    if job['type'] == 'find_offsets':
+        args = [station, noisemodel]
+        if job.get('3D', False) == True:
+            args.append('3D')
+        if 'penalty' in job:
+            args.append('{0:f}'.format(float(job['penalty'])))
+        return ['find_offset.py', args]
+    elif job['type'] == 'analyse':
+        return ['analyse_timeseries.py', [station, noisemodel]]
+    else:
+        return ['analyse_and_plot.py', [noisemodel, station]]
+
+
+# ------------------
+def call_job(job):
+    """
+    Call the function of a find_offsets or analyse job in the working
+    directory of the worker.
+    :param job: dictionary with the job description
+    :return: dictionary with the results
+    """
+
+    station = job['station']
+    noisemodel = job.get('noisemodel', 'PLWN')
+    if job['type'] == 'find_offsets':
+        return find_offset.find_offsets(station, noisemodel,
+                                        job.get('3D', False) == True,
+                                        float(job.get('penalty', 8.0)))
+    else:
+        return analyse_timeseries.analyse(station, noisemodel)
+
+
+# ------------------
+def job_result(job):
+    """
+    Read the results that a finished script left in the working directory.
+    :param job: dictionary with the job description
+    :return: dictionary with the results
+    """
+
+    with open('estimatetrend.json', 'r') as fp:
+        return json.load(fp)
+
+
+# ---------------
+def run_job(job):
+    """
+    Run a job inside a warm worker process.
+    :param job: dictionary with the job description
+    :return: [status, result, error message, log]
+    """
+
+    [script, args] = job_arguments(job)
+    argv = sys.argv
+    sys.argv = [script] + args
+    log = io.StringIO()
+    status = 'done'
+    result = None
+    error = None
+    if profiling.mode() is not None:
+        session = profiling.Session(os.path.splitext(script)[0], job['station'])
+    else:
+        session = contextlib.nullcontext()
+    try:
+        with session, contextlib.redirect_stdout(log):
+            if job['type'] == 'analyse_and_plot':
+                runpy.run_path(os.path.join(SCRIPT_DIR, script),
+                                                          run_name='__main__')
+            else:
+                result = call_job(job)
+    except SystemExit as e:
+        if e.code not in [None, 0]:
+            status = 'failed'
+            error = '{0:s} exited with status {1:s}'.format(script, str(e.code))
+    except Exception as e:
+        status = 'failed'
+        error = '{0:s}: {1:s}'.format(type(e).__name__, str(e))
+    finally:
+        sys.argv = argv
+
+    if status == 'done' and result is None:
+        try:
+            result = job_result(job)
+        except (IOError, ValueError) as e:
+            status = 'failed'
+            error = 'no results: {0:s}'.format(str(e))
+
+    return [status, result, error, log.getvalue()]
+
+
+# ===============================================================================
+# Job queue
+# ===============================================================================
+
+
+class JobQueue:
+    """ Priority queue of jobs that are dispatched to the worker pool.
+    """
+
+    # ----------------------------------
+    def __init__(self, n_workers, base):
+        self.jobs = {}
+        self.lock = threading.Condition()
+        self.queue = queue.PriorityQueue()
+        self.slots = threading.Semaphore(n_workers)
+        self.n_workers = n_workers
+        self.n_busy = 0
+        self.counter = 0
+        self.pool = multiprocessing.Pool(n_workers, initializer=init_worker,
+                                                              initargs=(base,))
+        self.dispatcher = threading.Thread(target=self.dispatch, daemon=True)
+        self.dispatcher.start()
+
+    # --------------------
+    def submit(self, job):
+        """
+        Add a job to the queue.
+        :param job: dictionary with the job description
+        :return: job id
+        """
+
+        if job.get('type') not in JOB_TYPES:
+            raise ValueError('unknown job type: {0:s}'.format(str(job.get('type'))))
+        if 'station' not in job:
+            raise ValueError('no station given')
+        priority = int(job.get('priority', 0))
+        with self.lock:
+            self.counter += 1
+            job_id = self.counter
+            self.jobs[job_id] = {'id': job_id, 'job': job, 'status': 'queued',
+                                 'submitted': time.time(), 'result': None,
+                                 'error': None, 'log': ''}
+        self.queue.put((-priority, job_id))
+
+        return job_id
+
+    # -----------------
+    def dispatch(self):
+        """
+        Send the queued jobs, highest priority first, to free workers.
+        """
+
+        while True:
+            self.slots.acquire()
+            [priority, job_id] = self.queue.get()
+            with self.lock:
+                entry = self.jobs[job_id]
+                entry['status'] = 'running'
+                entry['started'] = time.time()
+                self.n_busy += 1
+            self.pool.apply_async(run_job, (entry['job'],),
+                      callback=lambda output, job_id=job_id: \
+                                                  self.finish(job_id, output),
+                      error_callback=lambda e, job_id=job_id: \
+                        self.finish(job_id, ['failed', None, str(e), '']))
+
+    # -------------------------------
+    def finish(self, job_id, output):
+        """
+        Store the outcome of a job and free its worker slot.
+        :param job_id: job id
+        :param output: [status, result, error message, log]
+        """
+
+        with self.lock:
+            entry = self.jobs[job_id]
+            [entry['status'], entry['result'], entry['error'],
+                                                        entry['log']] = output
+            entry['finished'] = time.time()
+            self.n_busy -= 1
+            self.lock.notify_all()
+        self.slots.release()
+
+    # ------------------------------
+    def get(self, job_id, wait=0.0):
+        """
+        Return the state of a job, optionally waiting until it has finished.
+        :param job_id: job id
+        :param wait: maximum number of seconds to wait
+        :return: dictionary or None if the job is unknown
+        """
+
+        deadline = time.time() + wait
+        with self.lock:
+            if job_id not in self.jobs:
+                return None
+            while self.jobs[job_id]['status'] in ['queued', 'running'] and \
+                                                      time.time() < deadline:
+                self.lock.wait(deadline - time.time())
+            return dict(self.jobs[job_id])
+
+    # ---------------
+    def status(self):
+        """
+        :return: dictionary with queue depth and worker usage
+        """
+
+        with self.lock:
+            counts = {}
+            for entry in self.jobs.values():
+                counts[entry['status']] = counts.get(entry['status'], 0) + 1
+            return {'queued': self.queue.qsize(), 'busy_workers': self.n_busy,
+                    'workers': self.n_workers, 'jobs': counts}
+
+
+# ===============================================================================
+# HTTP interface
+# ===============================================================================
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    """ Translate HTTP requests into calls of the JobQueue.
+    """
+
+    jobs = None
+
+    # ------------------------------
+    def send_json(self, code, data):
+        body = json.dumps(data).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    # ---------------
+    def do_GET(self):
+        url = urllib.parse.urlparse(self.path)
+        query = urllib.parse.parse_qs(url.query)
+        parts = [part for part in url.path.split('/') if len(part) > 0]
+        if parts == ['status']:
+            self.send_json(200, self.jobs.status())
+        elif parts == ['jobs']:
+            with self.jobs.lock:
+                summary = [{'id': e['id'], 'type': e['job']['type'],
+                            'station': e['job']['station'],
+                            'status': e['status']} for e in self.jobs.jobs.values()]
+            self.send_json(200, summary)
+        elif len(parts) == 2 and parts[0] == 'jobs' and parts[1].isdigit():
+            wait = float(query.get('wait', ['0'])[0])
+            entry = self.jobs.get(int(parts[1]), wait)
+            if entry is None:
+                self.send_json(404, {'error': 'unknown job'})
+            else:
+                self.send_json(200, entry)
+        else:
+            self.send_json(404, {'error': 'unknown path'})
+
+    # ----------------
+    def do_POST(self):
+        if self.path.rstrip('/') != '/jobs':
+            self.send_json(404, {'error': 'unknown path'})
+            return
+        length = int(self.headers.get('Content-Length', 0))
+        try:
+            job = json.loads(self.rfile.read(length).decode())
+            job_id = self.jobs.submit(job)
+        except ValueError as e:
+            self.send_json(400, {'error': str(e)})
+            return
+        self.send_json(202, {'id': job_id})
+
+    # -----------------------------------
+    def log_message(self, format, *args):
+        pass
+
+
+# -----------------------------------------------
+def request(port, path, data=None, timeout=None):
+    """
+    Send a request to the server.
+    :param port: port of the server on 127.0.0.1
+    :param path: e.g. /jobs/3
+    :param data: dictionary to POST, None for GET
+    :param timeout: timeout in seconds
+    :return: decoded JSON answer
+    """
+
+    url = 'http://127.0.0.1:{0:d}{1:s}'.format(port, path)
+    if data is not None:
+        req = urllib.request.Request(url, data=json.dumps(data).encode(),
+                                headers={'Content-Type': 'application/json'})
+    else:
+        req = urllib.request.Request(url)
+    with urllib.request.urlopen(req, timeout=timeout) as answer:
+        return json.loads(answer.read().decode())
+
+
+# ===============================================================================
+# Main program
+# ===============================================================================
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Warm worker service ' + \
+                                                         'for station jobs')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    subparsers = parser.add_subparsers(dest='command')
+    p_serve = subparsers.add_parser('serve', help='start the service')
+    p_serve.add_argument('--workers', type=int, default=os.cpu_count())
+    p_serve.add_argument('--profile', action='store_true',
+                         help='profile every job (see profiling.py)')
+    p_submit = subparsers.add_parser('submit', help='submit a job')
+    p_submit.add_argument('type', choices=JOB_TYPES)
+    p_submit.add_argument('station')
+    p_submit.add_argument('noisemodel', nargs='?', default='PLWN')
+    p_submit.add_argument('--3D', dest='use_3D', action='store_true')
+    p_submit.add_argument('--penalty', type=float)
+    p_submit.add_argument('--priority', type=int, default=0)
+    p_submit.add_argument('--wait', action='store_true',
+                          help='wait for the result')
+    p_status = subparsers.add_parser('status', help='show jobs')
+    p_status.add_argument('job_id', nargs='?', type=int)
+    options = parser.parse_args()
+
+    if options.command == 'serve':
+        if options.profile == True:
+            os.environ['HECTOR_PROFILE'] = 'all'
+        if profiling.mode() is not None:
+            os.environ.setdefault('HECTOR_PROFILE_DIR',
+                                        os.path.abspath(profiling.PROFILE_DIR))
+        RequestHandler.jobs = JobQueue(options.workers, os.getcwd())
+        server = ThreadingHTTPServer(('127.0.0.1', options.port),
+                                                               RequestHandler)
+        print('Serving on 127.0.0.1:{0:d} with {1:d} workers'. \
+                                          format(options.port, options.workers))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+
+    elif options.command == 'submit':
+        job = {'type': options.type, 'station': options.station,
+               'noisemodel': options.noisemodel, '3D': options.use_3D,
+               'priority': options.priority}
+        if options.penalty is not None:
+            job['penalty'] = options.penalty
+        answer = request(options.port, '/jobs', job)
+        if options.wait == False:
+            print(json.dumps(answer))
+        else:
+            while True:
+                entry = request(options.port,
+                                '/jobs/{0:d}?wait=60'.format(answer['id']))
+                if entry['status'] not in ['queued', 'running']:
+                    break
+            print(json.dumps({'status': entry['status'], 'error': entry['error'],
+                              'result': entry['result']}, indent=2))
+            if entry['status'] != 'done':
+                sys.exit(1)
+
+    elif options.command == 'status':
+        if options.job_id is None:
+            print(json.dumps(request(options.port, '/status'), indent=2))
+            print(json.dumps(request(options.port, '/jobs'), indent=2))
+        else:
+            print(json.dumps(request(options.port,
+                                '/jobs/{0:d}'.format(options.job_id)), indent=2))
+
+    else:
+        parser.print_help()
@@ -0,0 +1,388 @@
+#!/usr/bin/env python3
+#
+# One container file per stage directory with the time series of all
+# stations.
+#
+# A network run creates three small mom-files per station in each of the
+# directories raw_files, obs_files, pre_files, mom_files, fil_files and
+# sea_files. On a network file system scanning and opening all these files
+# takes more time than reading them. The container, e.g. ./raw_files.db,
+# is an SQLite database with one row per mom-file: the header, the columns
+# of numbers (packed as doubles and compressed) and the sampling period,
+# first and last epoch and number of observations. A single file is found
+# through the index of the table and can be replaced without touching the
+# others. The Hector programs still need plain mom-files; export writes
+# them where needed.
+#
+# Usage:
+#   station_store.py import directory [container] [--pattern '*.mom']
+#   station_store.py export container directory [name ...]
+#   station_store.py list   container [pattern]
+#   station_store.py show   container name
+#   station_store.py delete container name [name ...]
+#
+#  This script is part of Hector 1.9
+# ===============================================================================
+
+import os
+import re
+import sys
+import zlib
+import array
+import sqlite3
+import hashlib
+import argparse
+
+import compressed_io
+import profiling
+from station_catalog import gap_percentage
+
+# ===============================================================================
+# Global constants
+# ===============================================================================
+
+SCHEMA = '''CREATE TABLE IF NOT EXISTS series (
+                name            TEXT PRIMARY KEY,
+                header          TEXT NOT NULL,
+                ncols           INTEGER NOT NULL,
+                count           INTEGER NOT NULL,
+                first           REAL,
+                last            REAL,
+                sampling_period REAL,
+                sha1            TEXT NOT NULL,
+                data            BLOB NOT NULL)'''
+
+INFO_COLUMNS = ['name', 'ncols', 'count', 'first', 'last', 'sampling_period',
+                'sha1']
+
+# ===============================================================================
+# Subroutines
+# ===============================================================================
+
+
+# --------------------------
+def store_name(directory):
+    """
+    :param directory: stage directory, e.g. ./raw_files
+    :return: name of its container, e.g. ./raw_files.db
+    """
+
+    return directory.rstrip('/') + '.db'
+
+
+# ------------------------
+def read_mom(fname):
+    """
+    Read a (possibly compressed) mom-file.
+    :param fname: name of the mom-file
+    :return: [header lines, list of columns (array of doubles)]
+    """
+
+    header = []
+    columns = []
+    with compressed_io.open_file(fname, 'r') as fp:
+        for line in fp:
+            if line.startswith('#'):
+                header.append(line.rstrip('\n'))
+                continue
+            cols = line.split()
+            if len(cols) == 0:
+                continue
+            if len(columns) == 0:
+                columns = [array.array('d') for i in range(0, len(cols))]
+            for i in range(0, len(columns)):
+                columns[i].append(float(cols[i]))
+
+    return [header, columns]
+
+
+# ------------------------------------------
+def write_mom(fp, header, columns):
+    """
+    Write a mom-file. The numbers are written with the shortest text that
+    gives back the same double.
+    :param fp: file object opened for writing text
+    :param header: list of header lines
+    :param columns: list of columns (array of doubles)
+    """
+
+    for line in header:
+        fp.write(line + '\n')
+    if len(columns) == 0:
+        return
+    for row in zip(*columns):
+        fp.write(' '.join([repr(value) for value in row]) + '\n')
+
+
+# ===============================================================================
+# Classes
+# ===============================================================================
+
+
+class StationStore:
+    """ Container with the mom-files of one stage directory.
+    """
+
+    # ---------------------------------------
+    def __init__(self, fname, readonly=False):
+        """
+        :param fname: name of the container, e.g. ./raw_files.db
+        :param readonly: open an existing container without changing it
+        """
+
+        if readonly == True:
+            if not os.path.isfile(fname):
+                raise IOError('Cannot find {0:s}'.format(fname))
+            self.db = sqlite3.connect('file:{0:s}?mode=ro'.format(fname),
+                                                                     uri=True)
+        else:
+            self.db = sqlite3.connect(fname)
+            self.db.execute(SCHEMA)
+            self.db.commit()
+        self.fname = fname
+
+    # -----------------
+    def close(self):
+        self.db.close()
+
+    # ------------------
+    def __enter__(self):
+        return self
+
+    # ----------------------------
+    def __exit__(self, *exc_info):
+        self.close()
+
+    # -----------------------------
+    def names(self, pattern=None):
+        """
+        :param pattern: glob pattern, e.g. *_0.mom (default: all)
+        :return: sorted list of names of the mom-files in the container
+        """
+
+        if pattern is None:
+            rows = self.db.execute('SELECT name FROM series ORDER BY name')
+        else:
+            rows = self.db.execute('SELECT name FROM series WHERE name GLOB ? '
+                                   'ORDER BY name', (pattern,))
+        return [row[0] for row in rows]
+
+    # --------------------
+    def info(self, name):
+        """
+        :param name: name of the mom-file, e.g. ABCD_0.mom
+        :return: dictionary with the sampling period, first and last epoch
+                 and number of observations, or None if not present
+        """
+
+        row = self.db.execute('SELECT {0:s} FROM series WHERE name=?'.\
+                        format(', '.join(INFO_COLUMNS)), (name,)).fetchone()
+        if row is None:
+            return None
+        return dict(zip(INFO_COLUMNS, row))
+
+    # -------------------------------
+    def catalog(self, pattern=None):
+        """
+        Metadata of all mom-files in the container in the form used by
+        station_catalog.py, read with one query.
+        :param pattern: glob pattern, e.g. *_0.mom (default: all)
+        :return: dictionary name -> entry
+        """
+
+        query = 'SELECT {0:s} FROM series'.format(', '.join(INFO_COLUMNS))
+        if pattern is None:
+            rows = self.db.execute(query)
+        else:
+            rows = self.db.execute(query + ' WHERE name GLOB ?', (pattern,))
+        files = {}
+        for row in rows:
+            info = dict(zip(INFO_COLUMNS, row))
+            dt = info['sampling_period']
+            info['gap_percentage'] = gap_percentage(1.0 if dt is None else dt,
+                                    info['first'], info['last'], info['count'])
+            files[info.pop('name')] = info
+
+        return files
+
+    # -------------------
+    def get(self, name):
+        """
+        :param name: name of the mom-file, e.g. ABCD_0.mom
+        :return: [header lines, list of columns (array of doubles)]
+        """
+
+        row = self.db.execute('SELECT header, ncols, count, data FROM series '
+                              'WHERE name=?', (name,)).fetchone()
+        if row is None:
+            raise KeyError('{0:s} is not in {1:s}'.format(name, self.fname))
+        [header, ncols, count, data] = row
+        values = array.array('d')
+        values.frombytes(zlib.decompress(data))
+        columns = [values[i*count:(i+1)*count] for i in range(0, ncols)]
+        header = [] if len(header) == 0 else header.split('\n')
+
+        return [header, columns]
+
+    # -------------------------------------------------
+    def put(self, name, header, columns, commit=True):
+        """
+        Add a mom-file to the container or replace it.
+        :param name: name of the mom-file, e.g. ABCD_0.mom
+        :param header: list of header lines
+        :param columns: list of columns (array of doubles), equal length
+        :param commit: make the change permanent immediately
+        """
+
+        count = 0 if len(columns) == 0 else len(columns[0])
+        values = array.array('d')
+        for column in columns:
+            if len(column) != count:
+                raise ValueError('columns of {0:s} differ in length'.\
+                                                                format(name))
+            values.extend(column)
+        data = values.tobytes()
+        sampling_period = None
+        for line in header:
+            m = re.match(r'# sampling period (\d+\.?\d*)', line)
+            if m:
+                sampling_period = float(m.group(1))
+        if count > 0:
+            first = columns[0][0]
+            last = columns[0][-1]
+        else:
+            first = last = None
+        text = '\n'.join(header)
+        sha1 = hashlib.sha1(text.encode() + data).hexdigest()
+        self.db.execute('INSERT OR REPLACE INTO series VALUES '
+                        '(?, ?, ?, ?, ?, ?, ?, ?, ?)', (name, text,
+                        len(columns), count, first, last, sampling_period,
+                        sha1, zlib.compress(data, 1)))
+        if commit == True:
+            self.db.commit()
+
+    # ----------------------
+    def delete(self, name):
+        """
+        :param name: name of the mom-file
+        """
+
+        self.db.execute('DELETE FROM series WHERE name=?', (name,))
+        self.db.commit()
+
+    # ---------------------------------------------------
+    def import_file(self, fname, name=None, commit=True):
+        """
+        Copy a (possibly compressed) mom-file into the container.
+        :param fname: name of the mom-file
+        :param name: name in the container, default the plain file name
+        :param commit: make the change permanent immediately
+        """
+
+        if name is None:
+            name = os.path.basename(compressed_io.logical_name(fname))
+        [header, columns] = read_mom(fname)
+        self.put(name, header, columns, commit)
+
+    # --------------------------------------
+    def export_file(self, name, directory):
+        """
+        Write a mom-file of the container as plain file into a directory.
+        :param name: name of the mom-file
+        :param directory: output directory
+        :return: name of the written file
+        """
+
+        [header, columns] = self.get(name)
+        fname = os.path.join(directory, name)
+        with open(fname, 'w') as fp:
+            write_mom(fp, header, columns)
+
+        return fname
+
+
+# ===============================================================================
+# Main program
+# ===============================================================================
+
+if __name__ == '__main__':
+
+    # --- Optional profiling with --profile or HECTOR_PROFILE (see profiling.py)
+    profiling.setup('station_store')
+
+    parser = argparse.ArgumentParser(description='Container with the '
+                                     'mom-files of a stage directory')
+    commands = parser.add_subparsers(dest='command')
+    p = commands.add_parser('import', help='copy mom-files into a container')
+    p.add_argument('directory')
+    p.add_argument('container', nargs='?',
+                   help='default: <directory>.db')
+    p.add_argument('--pattern', default='*.mom')
+    p = commands.add_parser('export', help='write plain mom-files')
+    p.add_argument('container')
+    p.add_argument('directory')
+    p.add_argument('names', nargs='*', help='default: all')
+    p = commands.add_parser('list', help='list the mom-files')
+    p.add_argument('container')
+    p.add_argument('pattern', nargs='?')
+    p = commands.add_parser('show', help='show one mom-file')
+    p.add_argument('container')
+    p.add_argument('name')
+    p = commands.add_parser('delete', help='remove mom-files')
+    p.add_argument('container')
+    p.add_argument('names', nargs='+')
+    args = parser.parse_args()
+
+    if args.command == 'import':
+        container = args.container or store_name(args.directory)
+        fnames = compressed_io.glob_files(os.path.join(args.directory,
+                                                                args.pattern))
+        with StationStore(container) as store:
+            for fname in fnames:
+                store.import_file(fname, commit=False)
+            store.db.commit()
+        print('{0:d} files stored in {1:s}'.format(len(fnames), container))
+
+    elif args.command == 'export':
+        if not os.path.exists(args.directory):
+            os.makedirs(args.directory)
+        with StationStore(args.container, readonly=True) as store:
+            names = args.names
+            if len(names) == 0:
+                names = store.names()
+            for name in names:
+                if not name.endswith('.mom'):
+                    name += '.mom'
+                store.export_file(name, args.directory)
+        print('{0:d} files written to {1:s}'.format(len(names), args.directory))
+
+    elif args.command == 'list':
+        with StationStore(args.container, readonly=True) as store:
+            for name in store.names(args.pattern):
+                info = store.info(name)
+                if info['count'] == 0:
+                    print('{0:20s}  empty'.format(name))
+                    continue
+                print('{0:20s} {1:5.2f} {2:10.3f} {3:10.3f} {4:7d}'.format(
+                      name, info['sampling_period'] or 1.0, info['first'],
+                      info['last'], info['count']))
+
+    elif args.command == 'show':
+        name = args.name if args.name.endswith('.mom') else args.name + '.mom'
+        with StationStore(args.container, readonly=True) as store:
+            try:
+                [header, columns] = store.get(name)
+            except KeyError as e:
+                print(e.args[0])
+                sys.exit(1)
+            write_mom(sys.stdout, header, columns)
+
+    elif args.command == 'delete':
+        with StationStore(args.container) as store:
+            for name in args.names:
+                if not name.endswith('.mom'):
+                    name += '.mom'
+                store.delete(name)
+
+    else:
+        parser.print_help()
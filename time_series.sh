@@ -10,8 +10,10 @@ gmt basemap -R0/3000/-10/155 -JX15c/5c -Bxa100fg+l"time" -Bya5f1g1 -BWSrt+t" " -
 
 #awk '$1!="#" {print $1+18.43,$2*1000}' Lamb_norm_TH_last.dat | gmt plot -A -Wthicker,red
 
-awk '$1!="#" {print $1-54267,$2}' ./raw_files/MANM_0.mom | gmt plot -Sc0.01c -Wred -Gred
-awk '$1!="#" {print $1-54267,$2}' ./obs_files/MANM_0.mom | gmt plot -Sc0.01c -Wblue -Gblue
+# --- Downsampled series (HECTOR_PLOT_POINTS, see downsample.py) and offsets
+downsample.py ./raw_files/MANM_0.mom | awk '{print $1-54267,$2}' | gmt plot -Sc0.01c -Wred -Gred
+downsample.py ./obs_files/MANM_0.mom | awk '{print $1-54267,$2}' | gmt plot -Sc0.01c -Wblue -Gblue
+downsample.py ./obs_files/MANM_0.mom --offsets | awk '{print $1-54267,150}' | gmt plot -Si0.2c -Gblack
 
 #echo 18.43 1000.00 0.2c | gmt plot -Sa -Gyellow -Wred
 #echo 5.113 1000.00 0.2c | gmt plot -Sa -Gyellow -Wred
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+#
+# Run the Hector programs and other external tools without a shell.
+#
+# The tools are started directly (no /bin/sh in between), their output is
+# captured in memory so that it can be parsed without writing it to a file
+# first, and a non-zero exit status raises ToolError instead of being
+# ignored. Copying, moving and removing files is done in Python.
+#
+#  This script is part of Hector 1.9
+# ===============================================================================
+
+import os
+import glob
+import shutil
+import subprocess
+
+# ===============================================================================
+# Classes
+# ===============================================================================
+
+
+class ToolError(RuntimeError):
+    """ An external tool could not be started or returned a non-zero status.
+    """
+
+    def __init__(self, args, returncode, output=''):
+        self.args_run = args
+        self.returncode = returncode
+        self.output = output
+        message = '{0:s} exited with status {1:d}'.format(' '.join(args),
+                                                                   returncode)
+        # --- Show the last lines of the output, they normally explain why
+        lines = output.strip().splitlines()[-3:]
+        if len(lines) > 0:
+            message += ': ' + ' | '.join(lines)
+        RuntimeError.__init__(self, message)
+
+
+# ===============================================================================
+# Subroutines
+# ===============================================================================
+
+
+# -----------------------------------------------------------------------
+def run_tool(args, input=None, cwd=None, capture=True, check=True):
+    """
+    Run an external tool and return what it wrote to stdout.
+    :param args: list with the name of the tool and its arguments
+    :param input: text that is sent to stdin of the tool
+    :param cwd: directory in which the tool is run (default: current one)
+    :param capture: if False, stdout and stderr are not captured but shown
+    :param check: raise ToolError if the exit status is not zero
+    :return: stdout of the tool (empty string if not captured)
+    """
+
+    if capture == True:
+        stdout = subprocess.PIPE
+        stderr = subprocess.PIPE
+    else:
+        stdout = None
+        stderr = None
+
+    try:
+        p = subprocess.run(args, input=input, cwd=cwd, stdout=stdout,
+                           stderr=stderr, universal_newlines=True)
+    except OSError as e:
+        raise ToolError(args, 127, str(e))
+
+    output = p.stdout if capture == True else ''
+    if check == True and p.returncode != 0:
+        errors = p.stderr if capture == True else ''
+        raise ToolError(args, p.returncode, output + errors)
+
+    return output
+
+
+# ---------------------------
+def move_file(src, dst):
+    """
+    Move a file, replacing the destination if it exists (like mv).
+    :param src: name of the source file
+    :param dst: name of the destination file
+    """
+
+    try:
+        os.replace(src, dst)
+    except OSError:
+        # --- Different file systems
+        shutil.move(src, dst)
+
+
+# ---------------------------
+def remove_files(pattern):
+    """
+    Remove all files matching a pattern (like rm -f).
+    :param pattern: glob pattern, e.g. dummy*.mom
+    """
+
+    for fname in glob.glob(pattern):
+        os.remove(fname)
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+#
+# Private working directories for jobs that run at the same time.
+#
+# The Hector programs and the scripts of this directory read their control
+# files and write their scratch files (removeoutliers.ctl, estimatetrend.json,
+# dummy*.mom, ...) in the current directory. Two stations can therefore only
+# be processed at the same time when each has its own working directory.
+# Such a directory contains symbolic links to the shared data directories
+# (./raw_files, ./obs_files, ...) so the usual relative paths keep working.
+#
+#  This script is part of Hector 1.9
+# ===============================================================================
+
+import os
+
+# ===============================================================================
+# Global constants
+# ===============================================================================
+
+DATA_DIRECTORIES = ['ori_files', 'raw_files', 'obs_files', 'pre_files',
+                    'mom_files', 'sea_files', 'fil_files', 'data_figures',
+                    'psd_figures']
+
+# ===============================================================================
+# Subroutines
+# ===============================================================================
+
+
+# ----------------------------------------------------------------------
+def make_workdir(name, root='./work', links=None, local=None, base='.'):
+    """
+    Create (or reuse) a working directory with links to the data directories.
+    :param name: name of the job, e.g. the station name
+    :param root: directory that holds all working directories
+    :param links: data directories to link, default DATA_DIRECTORIES
+    :param local: directories that must be private to this job
+    :param base: directory that contains the shared data directories
+    :return: path of the working directory
+    """
+
+    if links is None:
+        links = DATA_DIRECTORIES
+    if local is None:
+        local = []
+
+    workdir = os.path.join(root, name)
+    if not os.path.exists(workdir):
+        os.makedirs(workdir)
+
+    # --- The shared directory must exist, otherwise the scripts would try
+    #    to create a directory on top of a dangling link.
+    for dirname in links:
+        if dirname in local:
+            continue
+        target = os.path.abspath(os.path.join(base, dirname))
+        if not os.path.exists(target):
+            os.makedirs(target, exist_ok=True)
+        link = os.path.join(workdir, dirname)
+        if os.path.islink(link) and os.readlink(link) != target:
+            os.remove(link)
+        if not os.path.lexists(link):
+            os.symlink(target, link)
+
+    for dirname in local:
+        path = os.path.join(workdir, dirname)
+        if os.path.islink(path):
+            os.remove(path)
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+    return workdir